@@ -1,11 +1,35 @@
 import os
+import time
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, jsonify, url_for, abort, Response, stream_with_context)
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import (db, connect_db, User, Message, AUTHOR_COLUMNS,
+                    tombstoned_user_ids)
+from timelines import fan_out, retract, rebuild_timelines
+import counters
+import feeds
+import follows
+from like_state import get_like_state
+from likes import toggle_like
+from follow_graph import follow_graph
+from instrumentation import init_instrumentation, query_budget, metrics
+from user_search import search_users, typeahead
+from message_search import message_search, search_messages
+from user_cache import configure_user_cache, get_current_user
+from passwords import configure_passwords, PasswordPoolBusy
+from fragment_cache import configure_fragment_cache, render_card
+from http_caching import init_http_caching, cache_policy, conditional
+from replicas import init_replicas
+from migrations import migrate
+from purge import tombstone, purge_user, pending_purges, PURGE_BATCH
+from recommendations import recommended_users, refresh_recommendations
 
 
 CURR_USER_KEY = "curr_user"
@@ -17,13 +41,85 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# Read-only requests go to these replicas, if any (space-separated URIs in
+# DATABASE_REPLICA_URLS). Users who write are pinned to the primary for
+# PRIMARY_PIN_SECONDS so that they see their own changes.
+app.config['SQLALCHEMY_REPLICA_URIS'] = (
+    os.environ.get('DATABASE_REPLICA_URLS', '').split())
+app.config['PRIMARY_PIN_SECONDS'] = 10
+
+# Connection pool settings, for the primary and each replica. SQLite's
+# pools (for local setups) can't be sized.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1',
+    'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)),
+}
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=int(os.environ.get('DATABASE_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DATABASE_MAX_OVERFLOW', 10)))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+
+# Milliseconds a typeahead lookup may take before it is abandoned.
+app.config['TYPEAHEAD_BUDGET_MS'] = 100
+
+# Full-text search of messages: 'postgres' (tsvector) or 'memory' (an
+# in-process inverted index, for other databases). Defaults by database.
+app.config['MESSAGE_SEARCH_BACKEND'] = os.environ.get('MESSAGE_SEARCH_BACKEND')
+
+# Logged-in users are cached between requests for USER_CACHE_TTL seconds,
+# up to USER_CACHE_SIZE users per process. Set USER_CACHE_BACKEND to a
+# shared store (e.g. user_cache.RedisBackend) to share it between processes.
+app.config['USER_CACHE_TTL'] = 60
+app.config['USER_CACHE_SIZE'] = 10000
+app.config['USER_CACHE_BACKEND'] = None
+
+# Passwords are hashed in a pool of PASSWORD_POOL_WORKERS processes (0 to
+# hash in the request thread), with at most PASSWORD_POOL_QUEUE more jobs
+# waiting. Changing BCRYPT_LOG_ROUNDS rehashes passwords as users log in.
+app.config['PASSWORD_POOL_WORKERS'] = int(
+    os.environ.get('PASSWORD_POOL_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_POOL_QUEUE'] = 64
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# Rendered message cards are cached, up to this many bytes of HTML.
+app.config['FRAGMENT_CACHE_BYTES'] = 16 * 1024 * 1024
+
+# Static files linked with `static_url`, whose URL changes whenever the
+# file's contents do, may be cached for a year. Others (such as images the
+# stylesheet names) for an hour.
+app.config['STATIC_FINGERPRINTED_MAX_AGE'] = 365 * 24 * 60 * 60
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 60 * 60
+
+# Most rows a single JSON API response may stream (its `limit` param).
+app.config['API_MAX_LIMIT'] = 100000
+
+# Most users that one bulk follow or unfollow API request may name.
+app.config['FOLLOW_BATCH_MAX'] = 1000
+
+# If set, /metrics requires this as a bearer token. If not, /metrics only
+# answers requests from this machine (loopback addresses).
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# The debug toolbar is for development only: it is slow, and shows
+# requests' SQL to anyone. Server-Timing headers and /metrics (see
+# instrumentation.py) are always on.
+if os.environ.get('DEBUG_TOOLBAR') == '1':
+    from flask_debugtoolbar import DebugToolbarExtension
+    toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+init_instrumentation(app)
+init_replicas(app, db)
+configure_user_cache(app)
+configure_passwords(app)
+configure_fragment_cache(app)
+init_http_caching(app)
 
 
 ##############################################################################
@@ -32,15 +128,48 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    The user usually comes from the user cache, without a query.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = get_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+@app.context_processor
+def add_like_state():
+    """Let templates check `message.id in liked` for the current viewer."""
+
+    return {'liked': get_like_state()}
+
+
+@app.template_global()
+def url_with(**params):
+    """URL of the current page, with its paging params replaced by `params`."""
+
+    # Query params that would clash with the route's own arguments, or be
+    # taken as url_for options (_external, _anchor...), are dropped.
+    args = {key: value for key, value in request.args.items()
+            if key not in ('endpoint', 'before', 'after')
+            and key not in request.view_args
+            and not key.startswith('_')}
+    args.update(request.view_args)
+    args.update(params)
+
+    return url_for(request.endpoint, **args)
+
+
+@app.template_global()
+def message_card(message):
+    """The cached, viewer-independent part of `message`'s card in a feed."""
+
+    return render_card(message)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -55,6 +184,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@query_budget(3)
 def signup():
     """Handle user signup.
 
@@ -82,6 +212,10 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except PasswordPoolBusy:
+            flash("We're busy right now; please try again.", 'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -91,16 +225,23 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@query_budget(4)
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except PasswordPoolBusy:
+            flash("We're busy right now; please try again.", 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            # Saves the password if it was rehashed at a new cost.
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -111,6 +252,7 @@ def login():
 
 
 @app.route('/logout')
+@query_budget(1)
 def logout():
     """Handle logout of user."""
 
@@ -122,65 +264,162 @@ def logout():
 ##############################################################################
 # General user routes:
 
+def get_user_or_404(user_id):
+    """The user with `user_id`; a 404 if there is none, or they're deleted."""
+
+    user = User.query.get_or_404(user_id)
+
+    if user.deleted_at is not None:
+        abort(404)
+
+    return user
+
+
+def viewer_following(users):
+    """Set of the ids among `users` that the logged-in user follows."""
+
+    if not g.user:
+        return set()
+
+    return follow_graph.following_among(g.user.id, [u.id for u in users])
+
+
+def wants_json():
+    """Did the client ask for JSON, with `?format=json` or Accept?"""
+
+    if request.args.get('format') == 'json':
+        return True
+
+    best = request.accept_mimetypes.best_match(['text/html',
+                                                'application/json'])
+    return best == 'application/json'
+
+
+def user_list(user, query, template):
+    """A page of the users in `query`, listed on `user`'s profile.
+
+    Pages from the request's 'after' cursor. As JSON (see `wants_json`),
+    this is {"users": [...], "next": cursor}, for infinite scroll.
+    """
+
+    users, cursor = feeds.user_page(query, after=request.args.get('after'))
+    following = viewer_following(users)
+
+    if wants_json():
+        return jsonify(
+            users=[dict(feeds.user_json(u), following=u.id in following)
+                   for u in users],
+            next=cursor)
+
+    return render_template(template, user=user, users=users, cursor=cursor,
+                           following=following)
+
+
 @app.route('/users')
+@query_budget(3)
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and an
+    'after' cursor for the next page of results.
     """
 
     search = request.args.get('q')
 
+    users, cursor = search_users(search, after=request.args.get('after'))
+
+    return render_template('users/index.html',
+                           users=users, search=search, cursor=cursor,
+                           following=viewer_following(users))
+
+
+@app.route('/users/typeahead')
+@query_budget(3)
+def users_typeahead():
+    """JSON list of users whose username starts with the 'q' param."""
+
+    search = request.args.get('q', '')
+
     if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        return jsonify(users=[], timed_out=False)
+
+    users, timed_out = typeahead(search, app.config['TYPEAHEAD_BUDGET_MS'])
 
-    return render_template('users/index.html', users=users)
+    return jsonify(
+        users=[{'id': u.id, 'username': u.username, 'image_url': u.image_url}
+               for u in users],
+        timed_out=timed_out)
 
 
 @app.route('/users/<int:user_id>')
+@query_budget(5)
+@cache_policy(anonymous_max_age=60)
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
 
-    user = User.query.get_or_404(user_id)
+    The page is a 304 if the viewer already has it: it only changes with
+    the user's profile and counters, and the messages, likes and follow
+    shown on it.
+    """
+
+    user = get_user_or_404(user_id)
 
-    # snagging messages in order from the database;
+    # snagging messages in order from the database, a page at a time;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = feeds.user_messages(user_id).page(
+        before=request.args.get('before'),
+        after=request.args.get('after'))
+
+    liked = get_like_state()
+    liked.prime(page.items)
+
+    message_ids = [msg.id for msg in page.items]
+
+    return conditional(
+        lambda: render_template('users/show.html',
+                                user=user, messages=page.items, page=page),
+        user.id, user.updated_at, user.messages_count, user.following_count,
+        user.followers_count, user.likes_count, message_ids,
+        [id for id in message_ids if id in liked],
+        bool(g.user) and g.user.is_following(user))
 
 
 @app.route('/users/<int:user_id>/following')
+@query_budget(3)
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show a page of the people this user is following."""
 
     if not g.user:
+        if wants_json():
+            return api_error(401, "Login required.")
+
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = get_user_or_404(user_id)
+
+    return user_list(user, feeds.following(user_id), 'users/following.html')
 
 
 @app.route('/users/<int:user_id>/followers')
+@query_budget(3)
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show a page of the followers of this user."""
 
     if not g.user:
+        if wants_json():
+            return api_error(401, "Login required.")
+
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = get_user_or_404(user_id)
+
+    return user_list(user, feeds.followers(user_id), 'users/followers.html')
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@query_budget(7)
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -188,14 +427,19 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    user_id = g.user.id
+
+    if not follows.follow(user_id, [follow_id]):
+        # Already followed, or no such user.
+        get_user_or_404(follow_id)
+
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}/following")
+    return redirect(f"/users/{user_id}/following")
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@query_budget(7)
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -203,14 +447,16 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    user_id = g.user.id
+
+    follows.unfollow(user_id, [follow_id])
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}/following")
+    return redirect(f"/users/{user_id}/following")
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@query_budget(4)
 def profile():
     """Update profile for current user."""
 
@@ -222,18 +468,26 @@ def profile():
     form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
-        if User.authenticate(user.username, form.password.data):
+        try:
+            is_auth = User.authenticate(user.username, form.password.data)
+        except PasswordPoolBusy:
+            flash("We're busy right now; please try again.", 'danger')
+            return render_template('users/edit.html', user_id=user.id,
+                                   form=form), 503
 
-                user.username=form.username.data,
-                user.email=form.email.data,
-                user.image_url=form.image_url.data or User.image_url.default.arg,
-                user.header_image_url=form.header_image_url.data,
-                user.bio=form.bio.data
+        if is_auth:
+
+                user.username = form.username.data
+                user.email = form.email.data
+                user.image_url = form.image_url.data or User.image_url.default.arg
+                user.header_image_url = form.header_image_url.data
+                user.bio = form.bio.data
+                user.updated_at = datetime.utcnow()
 
                 db.session.commit()
                 flash('You have updated your profile!', 'success')
 
-                return redirect(f'users/{g.user.id}')
+                return redirect(f'/users/{g.user.id}')
         else:
             flash('Your password does not match!', 'danger')
 
@@ -241,44 +495,64 @@ def profile():
 
 
 @app.route('/users/add_like/<int:msg_id>', methods=["POST"])
+@query_budget(2)
 def add_like(msg_id):
-    """Add message to user's likes, or remove if already in likes"""
-    
+    """Add message to user's likes, or remove if already in likes.
+
+    Responds with {"message_id", "liked", "likes"} if JSON was asked for
+    (see `wants_json`), so that the page needn't be reloaded.
+    """
+
     if not g.user:
+        if wants_json():
+            return api_error(401, "Login required.")
+
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    else:
-        msg = Message.query.get(msg_id)
-        user = g.user
-        if msg not in user.likes:
+    result = toggle_like(g.user.id, msg_id)
 
-            like = Likes(user_id=user.id, message_id=msg_id)
-            db.session.add(like)
-            db.session.commit()
-            
-        else:
-            Likes.query.filter_by(message_id=msg_id).delete()
-            db.session.commit()
+    if result is None:
+        abort(404)
 
-        return redirect('/')
+    db.session.commit()
+    liked, likes = result
+
+    if wants_json():
+        return jsonify(message_id=msg_id, liked=liked, likes=likes)
+
+    return redirect('/')
 
 
 @app.route('/users/<int:user_id>/likes')
+@query_budget(4)
 def show_likes(user_id):
     """Show messages that user has liked"""
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template(f'users/likes.html', user=user)
+    user = get_user_or_404(user_id)
+
+    page = feeds.user_likes(user_id).page(
+        before=request.args.get('before'),
+        after=request.args.get('after'))
+
+    get_like_state().prime(page.items)
+
+    return render_template('users/likes.html',
+                           user=user, messages=page.items, page=page)
 
 
 
 @app.route('/users/delete', methods=["POST"])
+@query_budget(3)
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The user is tombstoned (and so hidden) at once; their messages, likes
+    and follows are purged later, by `flask purge-users`.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -286,7 +560,7 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    tombstone(g.user)
     db.session.commit()
 
     return redirect("/signup")
@@ -296,6 +570,7 @@ def delete_user():
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@query_budget(6)
 def messages_add():
     """Add a message:
 
@@ -311,22 +586,71 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        fan_out(msg)
+        counters.message_added(msg)
         db.session.commit()
+        message_search().add(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+@query_budget(4)
+def messages_search():
+    """Search messages by their text.
+
+    Takes a 'q' param, plus optional 'author' (a username), 'since' and
+    'until' (YYYY-MM-DD) and 'scope=following' (only messages in the
+    logged-in user's timeline) filters, and 'before' / 'after' cursors.
+    """
+
+    search = request.args.get('q', '').strip()
+    following_only = request.args.get('scope') == 'following' and g.user
+
+    if not search:
+        return render_template('messages/search.html', messages=[], page=None)
+
+    page = search_messages(search,
+                           author=request.args.get('author'),
+                           since=request.args.get('since'),
+                           until=request.args.get('until'),
+                           timeline_of=g.user.id if following_only else None,
+                           before=request.args.get('before'),
+                           after=request.args.get('after'))
+
+    get_like_state().prime(page.items)
+
+    return render_template('messages/search.html',
+                           messages=page.items, page=page)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@query_budget(4)
+@cache_policy(anonymous_max_age=300)
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message; a 304 if the viewer already has this version."""
+
+    msg = (Message
+           .query
+           .filter(Message.id == message_id)
+           .filter(Message.user_id.notin_(tombstoned_user_ids()))
+           .options(joinedload(Message.user).load_only(*AUTHOR_COLUMNS))
+           .first_or_404())
+
+    liked = get_like_state()
+    liked.prime([msg])
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    return conditional(
+        lambda: render_template('messages/show.html', message=msg),
+        msg.id, msg.user.updated_at, msg.id in liked,
+        bool(g.user) and g.user.is_following(msg.user))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@query_budget(7)
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -340,51 +664,288 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    retract(msg.id)
+    counters.message_deleted(msg)
     db.session.delete(msg)
     db.session.commit()
+    message_search().remove(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# JSON API
+#
+# Feeds are streamed as newline-delimited JSON, one message or user per
+# line, read from a server-side cursor. `limit` (default 100) caps the rows
+# returned; if more remain, the last line is {"next": <cursor>}, to be
+# passed back as `before` (messages) or `after` (users).
+
+def api_limit():
+    """The `limit` param of an API request; 400 if invalid."""
+
+    limit = request.args.get('limit', feeds.PAGE_SIZE, type=int)
+
+    if not 0 < limit <= app.config['API_MAX_LIMIT']:
+        abort(400)
+
+    return limit
+
+
+def api_error(status, message):
+    return jsonify(error=message), status
+
+
+def stream_messages(feed):
+    """NDJSON response streaming `feed`, from the request's `before`."""
+
+    limit = api_limit()
+    rows = feed.rows(before=request.args.get('before'), limit=limit + 1)
+
+    return Response(
+        stream_with_context(feeds.ndjson_lines(
+            rows, feeds.message_json, feeds.message_cursor, limit)),
+        mimetype='application/x-ndjson')
+
+
+def stream_users(query):
+    """NDJSON response streaming users, from the request's `after`."""
+
+    limit = api_limit()
+    rows = feeds.user_rows(query, after=request.args.get('after'),
+                           limit=limit + 1)
+
+    return Response(
+        stream_with_context(feeds.ndjson_lines(
+            rows, feeds.user_json, feeds.user_cursor, limit)),
+        mimetype='application/x-ndjson')
+
+
+@app.route('/api/v1/timeline')
+@query_budget(2)
+def api_timeline():
+    """Stream the logged-in user's home timeline."""
+
+    if not g.user:
+        return api_error(401, "Login required.")
+
+    return stream_messages(feeds.home_feed(g.user.id))
+
+
+@app.route('/api/v1/users/<int:user_id>/messages')
+@query_budget(2)
+def api_user_messages(user_id):
+    """Stream a user's messages."""
+
+    return stream_messages(feeds.user_messages(user_id))
+
+
+@app.route('/api/v1/users/<int:user_id>/likes')
+@query_budget(2)
+def api_user_likes(user_id):
+    """Stream the messages a user has liked."""
+
+    if not g.user:
+        return api_error(401, "Login required.")
+
+    return stream_messages(feeds.user_likes(user_id))
+
+
+@app.route('/api/v1/users/<int:user_id>/followers')
+@query_budget(2)
+def api_user_followers(user_id):
+    """Stream a user's followers."""
+
+    if not g.user:
+        return api_error(401, "Login required.")
+
+    return stream_users(feeds.followers(user_id))
+
+
+@app.route('/api/v1/users/<int:user_id>/following')
+@query_budget(2)
+def api_user_following(user_id):
+    """Stream the users a user follows."""
+
+    if not g.user:
+        return api_error(401, "Login required.")
+
+    return stream_users(feeds.following(user_id))
+
+
+@app.route('/api/v1/follows', methods=['POST', 'DELETE'])
+@query_budget(7)
+def api_follows():
+    """Follow (POST) or unfollow (DELETE) many users at once, for imports.
+
+    Takes a JSON body of {"user_ids": [...]}, and returns the ids whose
+    follow state changed, as {"followed": [...]} or {"unfollowed": [...]}.
+    Ids already in the requested state, or of no user, are skipped.
+    """
+
+    if not g.user:
+        return api_error(401, "Login required.")
+
+    body = request.get_json(silent=True)
+    user_ids = body.get('user_ids') if isinstance(body, dict) else None
+
+    if not (isinstance(user_ids, list)
+            and all(type(id) is int for id in user_ids)):
+        return api_error(400, 'Expected {"user_ids": [<id>, ...]}.')
+
+    if len(user_ids) > app.config['FOLLOW_BATCH_MAX']:
+        return api_error(
+            400, f"At most {app.config['FOLLOW_BATCH_MAX']} ids at a time.")
+
+    if request.method == 'POST':
+        result = {'followed': follows.follow(g.user.id, user_ids)}
+    else:
+        result = {'unfollowed': follows.unfollow(g.user.id, user_ids)}
+
+    db.session.commit()
+
+    return jsonify(result)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
 @app.route('/')
+@query_budget(5)
+@cache_policy(anonymous_max_age=300)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, with
+      `before` / `after` cursors for older and newer pages, and users to
+      follow
+
+    Messages are read from the user's materialized timeline, which is
+    filled in as messages are posted (see timelines.py). Users to follow
+    are precomputed (see recommendations.py).
     """
 
     if g.user:
-        messages = (Message
-                    .query                    
-                    .filter(Message.user_id.in_([f.id for f in g.user.following] + [g.user.id]))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        page = feeds.home_feed(g.user.id).page(
+            before=request.args.get('before'),
+            after=request.args.get('after'))
 
-        return render_template('home.html', messages=messages)
+        get_like_state().prime(page.items)
+
+        return render_template('home.html', messages=page.items, page=page,
+                               recommended=recommended_users(g.user.id))
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Monitoring
+
+
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+
+@app.route('/metrics')
+@query_budget(1)
+def metrics_show():
+    """Per-route request histograms, in Prometheus text format."""
+
+    token = app.config['METRICS_TOKEN']
+
+    if token:
+        if request.headers.get('Authorization') != f"Bearer {token}":
+            abort(401)
+
+    elif request.remote_addr not in LOOPBACK_ADDRESSES:
+        abort(403)
+
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Bring the schema of an existing database up to date."""
+
+    with db.engine.begin() as conn:
+        names = migrate(conn)
+
+    for name in names:
+        print(f"Applied {name}.")
+
+    print(f"Applied {len(names)} migrations.")
+
+
+@app.cli.command('purge-users')
+@click.option('--batch-size', default=PURGE_BATCH,
+              help="Rows to delete per transaction.")
+@click.option('--watch', type=float, metavar='SECONDS',
+              help="Keep purging, checking for deleted users this often.")
+def purge_users_command(batch_size, watch):
+    """Purge the rows of deleted users, resuming any interrupted purge.
+
+    Users take turns, a batch each, so one prolific user doesn't hold up
+    the rest.
+    """
+
+    while True:
+        user_ids = pending_purges()
+
+        while user_ids:
+            user_ids = [user_id for user_id in user_ids
+                        if not purge_user(user_id, batch_size=batch_size,
+                                          max_batches=1)]
+
+        if watch is None:
+            break
+
+        time.sleep(watch)
+
+    print("Purged deleted users.")
+
+
+@app.cli.command('refresh-recommendations')
+@click.option('--all', 'everyone', is_flag=True,
+              help="Refresh every user, not just those queued.")
+@click.option('--watch', type=float, metavar='SECONDS',
+              help="Keep refreshing queued users this often.")
+def refresh_recommendations_command(everyone, watch):
+    """Recompute the users recommended to follow."""
+
+    while True:
+        count = refresh_recommendations(everyone=everyone)
+        print(f"Refreshed recommendations of {count} users.")
+
+        if watch is None:
+            break
+
+        everyone = False
+        time.sleep(watch)
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Repopulate every home timeline from messages and follows."""
+
+    count = rebuild_timelines()
+    db.session.commit()
+
+    print(f"Rebuilt timelines with {count} entries.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute denormalized counters from messages, follows and likes."""
+
+    counters.reconcile_counters()
+    db.session.commit()
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+    print("Reconciled counters.")
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
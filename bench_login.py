@@ -0,0 +1,83 @@
+"""Benchmark login throughput with and without the password worker pool.
+
+Logs a user in repeatedly from several client threads, first hashing in
+the request threads and then in a pool of worker processes, and prints
+logins per second for each. Runs against the warbler-test database.
+
+    python bench_login.py --threads 8 --logins 200 --workers 4
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db, User
+from passwords import password_hasher
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+USERNAME = 'benchuser'
+PASSWORD = 'benchpassword'
+
+
+def setup_user(rounds):
+    """(Re)create the benchmark user, hashed at `rounds`."""
+
+    password_hasher.configure(workers=0, rounds=rounds)
+    User.query.filter_by(username=USERNAME).delete()
+    User.signup(username=USERNAME, email='bench@test.com',
+                password=PASSWORD, image_url=None)
+    db.session.commit()
+
+
+def login(_):
+    with app.test_client() as client:
+        resp = client.post('/login', data={'username': USERNAME,
+                                           'password': PASSWORD})
+        return resp.status_code
+
+
+def run(workers, threads, logins, rounds):
+    """Logins per second, and how many failed, with `workers` processes."""
+
+    password_hasher.configure(workers=workers, rounds=rounds,
+                              max_queue=logins)
+
+    # Warm up, starting the worker processes.
+    login(None)
+
+    start = perf_counter()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        statuses = list(pool.map(login, range(logins)))
+
+    elapsed = perf_counter() - start
+    password_hasher.shutdown()
+
+    failed = sum(status != 302 for status in statuses)
+    return logins / elapsed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--rounds', type=int, default=12)
+    args = parser.parse_args()
+
+    db.create_all()
+    setup_user(args.rounds)
+
+    for workers in (0, args.workers):
+        rate, failed = run(workers, args.threads, args.logins, args.rounds)
+        label = f"{workers} workers" if workers else "inline"
+        print(f"{label:>12}: {rate:8.1f} logins/s ({failed} failed)")
+
+
+if __name__ == '__main__':
+    main()
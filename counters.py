@@ -0,0 +1,95 @@
+"""Denormalized counters for Warbler.
+
+Users carry counts of their messages, follows, followers and likes, and
+messages carry a count of their likes. These are adjusted with atomic
+``SET col = col + n`` updates in the same transaction as the change they
+count, and can be recomputed from the source tables with
+`reconcile_counters`. Likes are counted by `likes.toggle_like`, in the same
+statement as the like itself, and a deleted user's rows are uncounted as
+they are purged, by purge.py.
+"""
+
+from sqlalchemy import select, func
+
+from models import db, User, Message, Follows, Likes
+
+users = User.__table__
+messages = Message.__table__
+follows = Follows.__table__
+likes = Likes.__table__
+
+
+def adjust(model, ids, **deltas):
+    """Add `deltas` to the counter columns of the `model` rows in `ids`.
+
+    `ids` may be a single id, a list of ids or a select of ids. Deltas
+    may be numbers or SQL expressions.
+    """
+
+    table = model.__table__
+
+    if isinstance(ids, int):
+        criterion = table.c.id == ids
+    else:
+        criterion = table.c.id.in_(ids)
+
+    values = {name: table.c[name] + delta for name, delta in deltas.items()}
+
+    db.session.execute(table.update().where(criterion).values(values))
+
+
+def message_added(msg):
+    """Count a newly posted message."""
+
+    adjust(User, msg.user_id, messages_count=1)
+
+
+def message_deleted(msg):
+    """Uncount a message that is about to be deleted, and its likes."""
+
+    adjust(User, msg.user_id, messages_count=-1)
+    adjust(User,
+           select([likes.c.user_id]).where(likes.c.message_id == msg.id),
+           likes_count=-1)
+
+
+def followed(follower_id, followed_ids):
+    """Count new follows of each of `followed_ids`."""
+
+    if followed_ids:
+        adjust(User, follower_id, following_count=len(followed_ids))
+        adjust(User, list(followed_ids), followers_count=1)
+
+
+def unfollowed(follower_id, followed_ids):
+    """Uncount removed follows of each of `followed_ids`."""
+
+    if followed_ids:
+        adjust(User, follower_id, following_count=-len(followed_ids))
+        adjust(User, list(followed_ids), followers_count=-1)
+
+
+def _count(table, column, matches):
+    """Scalar subquery counting rows of `table` whose `column` is `matches`."""
+
+    return (select([func.count()])
+            .select_from(table)
+            .where(column == matches)
+            .as_scalar())
+
+
+def reconcile_counters():
+    """Recompute every counter from the messages, follows and likes tables."""
+
+    db.session.execute(users.update().values(
+        messages_count=_count(messages, messages.c.user_id, users.c.id),
+        following_count=_count(
+            follows, follows.c.user_following_id, users.c.id),
+        followers_count=_count(
+            follows, follows.c.user_being_followed_id, users.c.id),
+        likes_count=_count(likes, likes.c.user_id, users.c.id),
+    ))
+
+    db.session.execute(messages.update().values(
+        likes_count=_count(likes, likes.c.message_id, messages.c.id),
+    ))
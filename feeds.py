@@ -0,0 +1,223 @@
+"""The queries behind Warbler's feeds, shared by the HTML pages and the API.
+
+A message feed (a home timeline, a user's messages or likes) is a Feed: a
+query on Message with its authors eager-loaded, plus the (timestamp, id)
+columns it is ordered on, newest first. A user's likes are ordered by when
+they were liked. Pages render a Feed a Page at a
+time; the API streams it row by row from a server-side cursor.
+
+Lists of users (followers, following) are ordered by user id, and paged
+or streamed from an `after` cursor holding the last id seen.
+
+Deleted users, and their messages, are left out of every feed and list,
+until they are purged (see purge.py).
+"""
+
+import json
+
+from flask import abort
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload, load_only
+
+from models import Follows, Likes, Message, Timelines, User
+from models import tombstoned_user_ids
+from models import AUTHOR_COLUMNS, CARD_COLUMNS
+from pagination import (PAGE_SIZE, decode_cursor, decode_token, encode_cursor,
+                        encode_token, paginate)
+
+# Rows fetched from the database at a time when streaming.
+STREAM_BATCH = 500
+
+
+class Feed:
+    """Messages from `query`, newest-first on (timestamp_col, id_col).
+
+    The query's rows are (message, timestamp, id): each message with its
+    position in the feed, which cursors are made from.
+    """
+
+    def __init__(self, query, timestamp_col, id_col):
+        self.query = (query
+                      .filter(Message.user_id.notin_(tombstoned_user_ids()))
+                      .options(joinedload(Message.user)
+                               .load_only(*AUTHOR_COLUMNS))
+                      .add_columns(timestamp_col, id_col))
+        self.timestamp_col = timestamp_col
+        self.id_col = id_col
+
+    def page(self, before=None, after=None, per_page=PAGE_SIZE):
+        """A Page of the feed's messages, from a previous Page's cursors."""
+
+        page = paginate(self.query, self.timestamp_col, self.id_col,
+                        before=before, after=after, per_page=per_page,
+                        key=row_key)
+        page.items = [msg for msg, _, _ in page.items]
+
+        return page
+
+    def rows(self, before=None, limit=None):
+        """Iterate over the feed, older than the `before` cursor if given.
+
+        Rows are fetched STREAM_BATCH at a time, so the whole feed is
+        never held in memory.
+        """
+
+        query = self.query
+
+        if before:
+            query = query.filter(tuple_(self.timestamp_col, self.id_col) <
+                                 tuple_(*decode_cursor(before)))
+
+        query = query.order_by(self.timestamp_col.desc(), self.id_col.desc())
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        return query.yield_per(STREAM_BATCH)
+
+
+def home_feed(user_id):
+    """Messages in `user_id`'s home timeline: theirs and their followees'."""
+
+    return Feed((Message
+                 .query
+                 .join(Timelines, Timelines.message_id == Message.id)
+                 .filter(Timelines.user_id == user_id)),
+                Timelines.timestamp, Timelines.message_id)
+
+
+def user_messages(user_id):
+    """Messages written by `user_id`."""
+
+    return Feed(Message.query.filter(Message.user_id == user_id),
+                Message.timestamp, Message.id)
+
+
+def user_likes(user_id):
+    """Messages liked by `user_id`, most recently liked first."""
+
+    return Feed((Message
+                 .query
+                 .join(Likes, Likes.message_id == Message.id)
+                 .filter(Likes.user_id == user_id)),
+                Likes.liked_at, Likes.message_id)
+
+
+def followers(user_id):
+    """Query of the users following `user_id`, by user id."""
+
+    return (User
+            .query
+            .join(Follows, Follows.user_following_id == User.id)
+            .filter(Follows.user_being_followed_id == user_id)
+            .filter(User.deleted_at.is_(None))
+            .options(load_only(*CARD_COLUMNS))
+            .order_by(User.id))
+
+
+def following(user_id):
+    """Query of the users `user_id` follows, by user id."""
+
+    return (User
+            .query
+            .join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == user_id)
+            .filter(User.deleted_at.is_(None))
+            .options(load_only(*CARD_COLUMNS))
+            .order_by(User.id))
+
+
+def user_rows(query, after=None, limit=None):
+    """Iterate over a query from `followers` / `following`, streaming.
+
+    `after` is a cursor from `user_cursor`.
+    """
+
+    if after:
+        try:
+            after_id, = decode_token(after)
+            query = query.filter(User.id > int(after_id))
+        except (TypeError, ValueError):
+            abort(400)
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.yield_per(STREAM_BATCH)
+
+
+def user_page(query, after=None, per_page=PAGE_SIZE):
+    """A page of users from `followers` / `following`.
+
+    Returns (users, cursor), where cursor is the `after` token for the next
+    page, or None if this is the last page.
+    """
+
+    users = list(user_rows(query, after=after, limit=per_page + 1))
+
+    if len(users) > per_page:
+        return users[:per_page], user_cursor(users[per_page - 1])
+
+    return users, None
+
+
+##############################################################################
+# Serializing feeds as newline-delimited JSON
+
+
+def row_key(row):
+    """Position of a (message, timestamp, id) row in its feed."""
+
+    _, timestamp, id = row
+    return timestamp, id
+
+
+def message_json(row):
+    """Compact JSON-able form of a feed row's message and its author."""
+
+    msg, _, _ = row
+
+    return {
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'user': {
+            'id': msg.user.id,
+            'username': msg.user.username,
+            'image_url': msg.user.image_url,
+        },
+    }
+
+
+def user_json(user):
+    """Compact JSON-able form of a user's card."""
+
+    return {column: getattr(user, column) for column in CARD_COLUMNS}
+
+
+def message_cursor(row):
+    return encode_cursor(*row_key(row))
+
+
+def user_cursor(user):
+    return encode_token([user.id])
+
+
+def ndjson_lines(rows, serialize, cursor, limit):
+    """Yield up to `limit` of `rows` as lines of JSON.
+
+    `rows` should yield one row more than `limit` if there are more to
+    come; the last line is then `{"next": <cursor>}`, the cursor to pass
+    back for the following rows.
+    """
+
+    last = None
+
+    for count, row in enumerate(rows):
+        if count == limit:
+            yield json.dumps({'next': cursor(last)},
+                             separators=(',', ':')) + '\n'
+            break
+
+        yield json.dumps(serialize(row), separators=(',', ':')) + '\n'
+        last = row
@@ -0,0 +1,533 @@
+"""In-memory index of the follow graph.
+
+The follows table is loaded into two compact adjacency structures (who each
+user follows, and who follows each user). Each is stored CSR-style: one
+array of user ids holding every adjacency list back to back, sorted within
+each list, plus an array of offsets where `offsets[u]:offsets[u + 1]` is
+user `u`'s slice. Membership is then a binary search and degree a
+subtraction, with no database round trip.
+
+Changes after loading are applied to a small overlay, from the
+follow_changes table: a trigger on follows appends every follow and
+unfollow to it, however it was written and by whichever process (see
+models.py). Each process catches up from it:
+
+- synchronously, when a transaction of its own that changed follows
+  commits, so a user sees their own follows at once;
+- every `poll_interval` seconds in a background thread, for follows made
+  by other processes.
+
+Changes to one edge are committed in the order of their ids, and applying
+a change twice is harmless, so catching up only needs to remember which
+recent changes it has applied. A change may commit after changes with
+later ids; those more than SETTLE_SECONDS old are taken to have been rolled
+back, if not seen yet.
+
+The arrays are reloaded by the background thread every `max_age` seconds
+(as a backstop) and once the overlay grows large, while the old index keeps
+serving. Changes applied during the reload are replayed onto the new one.
+Only the first load blocks, once, however many threads are waiting on it.
+
+On databases other than PostgreSQL there is no feed: the index is reloaded
+whenever a transaction of this process changes follows, and when it is
+older than `max_age`.
+"""
+
+import os
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from threading import Condition, RLock, Thread
+from time import monotonic, sleep
+
+from sqlalchemy import event, select, text
+from sqlalchemy.orm import Session, attributes
+
+from models import db, Follows, User
+
+# Seconds before the index is reloaded from the database.
+MAX_AGE = 300
+
+# Number of overlay changes after which the index is reloaded.
+COMPACT_AFTER = 10000
+
+# Seconds between checks of the change feed for other processes' follows.
+POLL_INTERVAL = 1
+
+# Seconds after which a change is assumed to have committed, if it ever
+# will. Any missed later is picked up by the next reload.
+SETTLE_SECONDS = 10
+
+# Seconds of changes kept in the feed.
+FEED_RETENTION = 24 * 60 * 60
+
+PENDING_KEY = 'follow_graph_pending'
+
+FETCH_CHANGES = text("""
+    SELECT id, follower_id, followed_id, following,
+           changed_at < clock_timestamp() - make_interval(secs => :settle)
+               AS settled
+    FROM follow_changes
+    WHERE id > :after
+    ORDER BY id
+""")
+
+# The id up to which a reload starts catching up: the newest change that
+# has settled, so that changes which may still commit are fetched again.
+FEED_POSITION = text("""
+    SELECT id FROM follow_changes
+    WHERE changed_at < clock_timestamp() - make_interval(secs => :settle)
+    ORDER BY id DESC
+    LIMIT 1
+""")
+
+TRIM_FEED = text("""
+    DELETE FROM follow_changes
+    WHERE changed_at < clock_timestamp() - make_interval(secs => :retention)
+""")
+
+
+def follow_edges():
+    """Every committed (follower_id, followed_id) pair, in order.
+
+    Reads on a connection of its own, so that only committed follows are
+    loaded.
+    """
+
+    follows = Follows.__table__
+    query = (select([follows.c.user_following_id,
+                     follows.c.user_being_followed_id])
+             .order_by(follows.c.user_following_id,
+                       follows.c.user_being_followed_id))
+
+    with db.engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(query)]
+
+
+class Adjacency:
+    """Sorted adjacency lists of every user, packed into two arrays."""
+
+    def __init__(self, edges):
+        """Pack `edges`, (source, target) pairs sorted by source then target."""
+
+        self.offsets = array('l')
+        self.targets = array('l')
+
+        for source, target in edges:
+            while len(self.offsets) <= source:
+                self.offsets.append(len(self.targets))
+            self.targets.append(target)
+
+        self.offsets.append(len(self.targets))
+
+    def bounds(self, source):
+        """Start and end of `source`'s slice of targets."""
+
+        if source + 1 >= len(self.offsets):
+            return 0, 0
+
+        return self.offsets[source], self.offsets[source + 1]
+
+    def has(self, source, target):
+        """Is there an edge from `source` to `target`?"""
+
+        lo, hi = self.bounds(source)
+        i = bisect_left(self.targets, target, lo, hi)
+        return i < hi and self.targets[i] == target
+
+    def degree(self, source):
+        """Number of edges out of `source`."""
+
+        lo, hi = self.bounds(source)
+        return hi - lo
+
+    def neighbours(self, source):
+        """Array of the targets of `source`, in ascending order."""
+
+        lo, hi = self.bounds(source)
+        return self.targets[lo:hi]
+
+
+class FollowGraph:
+    """Follow relationships between users, answered from memory.
+
+    Edges are (follower_id, followed_id) pairs.
+    """
+
+    def __init__(self, max_age=MAX_AGE, compact_after=COMPACT_AFTER,
+                 poll_interval=POLL_INTERVAL):
+        self.max_age = max_age
+        self.compact_after = compact_after
+        self.poll_interval = poll_interval
+        self._lock = RLock()
+        self._loaded = Condition(self._lock)
+        self._following = None
+        self._followers = None
+        self._built_at = None
+        self._loading = False
+        self._generation = 0
+        self._replay = None
+        self._poller_pid = None
+
+        # Every change with an id up to `_position` has been applied, as
+        # have the ids in `_seen`.
+        self._position = None
+        self._seen = set()
+
+        self._reset_overlay()
+
+    def _reset_overlay(self):
+        self._added = defaultdict(set)
+        self._added_to = defaultdict(set)
+        self._removed = set()
+        self._following_delta = Counter()
+        self._followers_delta = Counter()
+        self._changes = 0
+
+    def _has_feed(self):
+        return db.engine.dialect.name == 'postgresql'
+
+    def _ensure_loaded(self):
+        """Load the index if it isn't, and keep it up to date from now on.
+
+        Call without holding the lock.
+        """
+
+        while self._following is None:
+            self.rebuild()
+
+        if not self._has_feed():
+            if (monotonic() - self._built_at > self.max_age or
+                    self._changes > self.compact_after):
+                self.rebuild()
+        elif self._poller_pid != os.getpid():
+            self._start_poller()
+
+    def rebuild(self):
+        """Reload the whole graph from the follows table.
+
+        The current index keeps answering until the new one is ready. If a
+        reload is already under way, waits for it instead.
+        """
+
+        with self._lock:
+            if self._loading:
+                while self._loading:
+                    self._loaded.wait()
+                return
+
+            self._loading = True
+            self._replay = []
+            generation = self._generation
+
+        try:
+            position = None
+
+            if self._has_feed() and self._position is None:
+                with db.engine.connect() as conn:
+                    position = conn.execute(
+                        FEED_POSITION, settle=SETTLE_SECONDS).scalar() or 0
+
+            edges = follow_edges()
+            following = Adjacency(edges)
+            followers = Adjacency(sorted((b, a) for a, b in edges))
+
+        except Exception:
+            with self._lock:
+                self._loading = False
+                self._replay = None
+                self._loaded.notify_all()
+            raise
+
+        with self._lock:
+            replay, self._replay = self._replay, None
+            self._loading = False
+            self._loaded.notify_all()
+
+            # Invalidated while loading: the edges read may be out of date.
+            if generation != self._generation:
+                return
+
+            self._following = following
+            self._followers = followers
+            self._built_at = monotonic()
+            self._reset_overlay()
+
+            if position is not None:
+                self._position = position
+
+            for change in replay:
+                self._apply(*change)
+
+    def invalidate(self):
+        """Drop the index, so that it is reloaded on next use."""
+
+        with self._lock:
+            self._generation += 1
+            self._following = None
+            self._followers = None
+            self._reset_overlay()
+
+    def _apply(self, following, follower_id, followed_id):
+        if self._replay is not None:
+            self._replay.append((following, follower_id, followed_id))
+
+        if following:
+            self.add(follower_id, followed_id)
+        else:
+            self.remove(follower_id, followed_id)
+
+    def sync(self):
+        """Apply the changes in the feed that haven't been applied yet."""
+
+        if self._position is None:
+            return
+
+        with db.engine.connect() as conn:
+            rows = conn.execute(FETCH_CHANGES, after=self._position,
+                                settle=SETTLE_SECONDS).fetchall()
+
+        with self._lock:
+            position = self._position
+            settling = False
+
+            for id, follower_id, followed_id, following, settled in rows:
+                if id > self._position and id not in self._seen:
+                    self._seen.add(id)
+                    self._apply(following, follower_id, followed_id)
+
+                # Changes before one that may still be joined by others
+                # are fetched again next time.
+                settling = settling or not settled
+                if not settling:
+                    position = max(position, id)
+
+            self._position = position
+            self._seen = {id for id in self._seen if id > position}
+
+    def changed(self):
+        """Catch up with a transaction of this process that changed follows."""
+
+        if self._has_feed():
+            self.sync()
+        else:
+            self.invalidate()
+
+    def _start_poller(self):
+        with self._lock:
+            if self._poller_pid == os.getpid():
+                return
+
+            self._poller_pid = os.getpid()
+
+        Thread(target=self._poll, args=(db.get_app(),),
+               name='follow-graph', daemon=True).start()
+
+    def _poll(self, app):
+        """Keep the index up to date with other processes' follows."""
+
+        with app.app_context():
+            while True:
+                sleep(self.poll_interval)
+
+                try:
+                    if self._following is None:
+                        continue
+
+                    if (monotonic() - self._built_at > self.max_age or
+                            self._changes > self.compact_after):
+                        self.rebuild()
+                        trim_feed()
+
+                    self.sync()
+
+                except Exception:
+                    app.logger.exception("Couldn't update the follow graph")
+
+    def add(self, follower_id, followed_id):
+        """Record that `follower_id` now follows `followed_id`."""
+
+        with self._lock:
+            if self._following is None:
+                return
+
+            edge = (follower_id, followed_id)
+
+            if edge in self._removed:
+                self._removed.discard(edge)
+            elif (self._following.has(*edge) or
+                  followed_id in self._added[follower_id]):
+                return
+            else:
+                self._added[follower_id].add(followed_id)
+                self._added_to[followed_id].add(follower_id)
+
+            self._following_delta[follower_id] += 1
+            self._followers_delta[followed_id] += 1
+            self._changes += 1
+
+    def remove(self, follower_id, followed_id):
+        """Record that `follower_id` no longer follows `followed_id`."""
+
+        with self._lock:
+            if self._following is None:
+                return
+
+            edge = (follower_id, followed_id)
+
+            if followed_id in self._added[follower_id]:
+                self._added[follower_id].discard(followed_id)
+                self._added_to[followed_id].discard(follower_id)
+            elif self._following.has(*edge) and edge not in self._removed:
+                self._removed.add(edge)
+            else:
+                return
+
+            self._following_delta[follower_id] -= 1
+            self._followers_delta[followed_id] -= 1
+            self._changes += 1
+
+    @contextmanager
+    def _index(self):
+        """Hold the lock on a loaded index."""
+
+        while True:
+            self._ensure_loaded()
+
+            with self._lock:
+                if self._following is not None:
+                    yield
+                    return
+
+    def _is_following(self, follower_id, followed_id):
+        if followed_id in self._added.get(follower_id, ()):
+            return True
+
+        return (self._following.has(follower_id, followed_id) and
+                (follower_id, followed_id) not in self._removed)
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        with self._index():
+            return self._is_following(follower_id, followed_id)
+
+    def following_among(self, follower_id, user_ids):
+        """Which of `user_ids` does `follower_id` follow? Returns a set."""
+
+        with self._index():
+            return {user_id for user_id in user_ids
+                    if self._is_following(follower_id, user_id)}
+
+    def followers_among(self, followed_id, user_ids):
+        """Which of `user_ids` follow `followed_id`? Returns a set."""
+
+        with self._index():
+            return {user_id for user_id in user_ids
+                    if self._is_following(user_id, followed_id)}
+
+    def following_ids(self, follower_id):
+        """Ids of everyone `follower_id` follows, in ascending order."""
+
+        with self._index():
+            ids = [user_id
+                   for user_id in self._following.neighbours(follower_id)
+                   if (follower_id, user_id) not in self._removed]
+
+            return sorted(ids + list(self._added.get(follower_id, ())))
+
+    def follower_ids(self, followed_id):
+        """Ids of everyone following `followed_id`, in ascending order."""
+
+        with self._index():
+            ids = [user_id
+                   for user_id in self._followers.neighbours(followed_id)
+                   if (user_id, followed_id) not in self._removed]
+
+            return sorted(ids + list(self._added_to.get(followed_id, ())))
+
+    def following_count(self, user_id):
+        """How many users `user_id` follows."""
+
+        with self._index():
+            return (self._following.degree(user_id) +
+                    self._following_delta[user_id])
+
+    def followers_count(self, user_id):
+        """How many users follow `user_id`."""
+
+        with self._index():
+            return (self._followers.degree(user_id) +
+                    self._followers_delta[user_id])
+
+
+def trim_feed():
+    """Delete the changes older than FEED_RETENTION from the feed."""
+
+    with db.engine.begin() as conn:
+        conn.execute(TRIM_FEED, retention=FEED_RETENTION)
+
+
+follow_graph = FollowGraph()
+
+
+##############################################################################
+# Keeping the index in step with the database.
+#
+# A session that changes follows is flagged as it flushes; once it commits,
+# the index catches up with the feed (which has its changes by then).
+
+
+def mark_pending(session=None):
+    """Have the index catch up with the feed when the session commits.
+
+    Only needed for follows written without the ORM (e.g. Core inserts);
+    ORM changes are picked up automatically.
+    """
+
+    (session or db.session()).info[PENDING_KEY] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_follow_changes(session, flush_context):
+    """Flag the session if this flush changed any follows."""
+
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Follows) or (isinstance(obj, User) and
+                                        obj in session.deleted):
+            session.info[PENDING_KEY] = True
+            return
+
+    for obj in session.new | session.dirty:
+        if not isinstance(obj, User):
+            continue
+
+        for key in ('following', 'followers'):
+            if attributes.get_history(
+                    obj, key, attributes.PASSIVE_NO_INITIALIZE).has_changes():
+                session.info[PENDING_KEY] = True
+                return
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def collect_bulk_delete(delete_context):
+    """Bulk deletes of follows or users may remove any number of edges."""
+
+    if delete_context.mapper.class_ in (Follows, User):
+        delete_context.session.info[PENDING_KEY] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_follow_changes(session):
+    """Catch up with the follows committed by the session."""
+
+    if session.info.pop(PENDING_KEY, False):
+        follow_graph.changed()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_follow_changes(session):
+    """Forget follow changes that were rolled back."""
+
+    session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,74 @@
+"""Following and unfollowing users.
+
+Follows are inserted and deleted as rows of the follows table, with set-based
+statements, rather than through `User.following`, which would load everyone
+the user already follows just to add or remove one of them. Inserts use
+``ON CONFLICT DO NOTHING`` and deletes ``RETURNING``, so repeating a follow
+or unfollow is harmless and only real changes are passed on: to the
+counters, the follower's home timeline, the follow graph index and the
+queue of recommendations to refresh, all in the caller's transaction.
+"""
+
+from sqlalchemy import select, literal
+from sqlalchemy.dialects.postgresql import insert
+
+import counters
+from follow_graph import mark_pending
+from models import db, Follows, User
+from recommendations import mark_stale
+from timelines import backfill, prune
+
+table = Follows.__table__
+
+
+def follow(follower_id, user_ids):
+    """Have `follower_id` follow each of `user_ids`.
+
+    Ids of missing or deleted users, of users already followed and of the
+    follower themselves are skipped. Returns the ids newly followed. The caller
+    commits.
+    """
+
+    targets = (select([literal(follower_id), User.id])
+               .where(User.id.in_(set(user_ids)))
+               .where(User.id != follower_id)
+               .where(User.deleted_at.is_(None)))
+
+    rows = db.session.execute(
+        insert(table)
+        .from_select(['user_following_id', 'user_being_followed_id'], targets)
+        .on_conflict_do_nothing()
+        .returning(table.c.user_being_followed_id))
+
+    followed = sorted(id for id, in rows)
+
+    if followed:
+        counters.followed(follower_id, followed)
+        backfill(follower_id, followed)
+        mark_stale(follower_id)
+        mark_pending()
+
+    return followed
+
+
+def unfollow(follower_id, user_ids):
+    """Have `follower_id` stop following each of `user_ids`.
+
+    Returns the ids that were followed, and now aren't. The caller commits.
+    """
+
+    rows = db.session.execute(
+        table.delete()
+        .where(table.c.user_following_id == follower_id)
+        .where(table.c.user_being_followed_id.in_(set(user_ids)))
+        .returning(table.c.user_being_followed_id))
+
+    unfollowed = sorted(id for id, in rows)
+
+    if unfollowed:
+        counters.unfollowed(follower_id, unfollowed)
+        prune(follower_id, unfollowed)
+        mark_stale(follower_id)
+        mark_pending()
+
+    return unfollowed
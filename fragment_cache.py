@@ -0,0 +1,190 @@
+"""Cache of rendered message cards.
+
+The feeds on the home page, profiles and likes pages render a card for
+every message on them, which is the same for every viewer: the author's
+picture and name, the date and the text. Only the like button (and the
+home page's star) depends on who is looking, so those are rendered around
+the cached card on each request.
+
+Cards are cached by message id, along with a version: the author's
+`updated_at`, which `profile` bumps whenever it changes a user. A card
+whose author has since edited their profile is a miss and is re-rendered,
+so edits never need to find every card of their author. Deleted messages'
+cards are dropped when the deleting transaction commits.
+
+The cache is bounded by the bytes of HTML it holds, evicting the least
+recently used cards first, and counts its hits and misses.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Message
+
+CARD_TEMPLATE = 'messages/card.html'
+
+DEFAULT_BYTES = 16 * 1024 * 1024
+
+PENDING_KEY = 'fragment_cache_pending'
+
+
+class FragmentCache:
+    """Rendered fragments by key and version, bounded by total size in bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """Fragment cached under `key` at `version`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, version, html):
+        """Cache `html` under `key` at `version`, replacing older versions."""
+
+        size = len(html.encode('UTF-8'))
+
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (version, html, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def discard(self, key):
+        """Forget the fragment under `key`, if any."""
+
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        """Forget every fragment."""
+
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def reset_stats(self):
+        """Start counting hits, misses and evictions from zero."""
+
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Hit / miss counts and current size, as a dict."""
+
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+fragment_cache = FragmentCache()
+
+
+def configure_fragment_cache(app):
+    """Set up the fragment cache from `app`'s FRAGMENT_CACHE_BYTES config."""
+
+    fragment_cache.max_bytes = app.config.get('FRAGMENT_CACHE_BYTES',
+                                              DEFAULT_BYTES)
+    fragment_cache.clear()
+
+
+def render_card(message):
+    """The viewer-independent card of `message`, from the cache if possible.
+
+    `message.user` should be loaded with AUTHOR_COLUMNS.
+    """
+
+    version = message.user.updated_at
+    html = fragment_cache.get(message.id, version)
+
+    if html is None:
+        template = current_app.jinja_env.get_template(CARD_TEMPLATE)
+        html = template.render(message=message)
+        fragment_cache.set(message.id, version, html)
+
+    return Markup(html)
+
+
+##############################################################################
+# Dropping the cards of deleted messages.
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_deleted_messages(session, flush_context):
+    """Note the messages this flush deleted."""
+
+    for obj in session.deleted:
+        if isinstance(obj, Message):
+            session.info.setdefault(PENDING_KEY, set()).add(obj.id)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def collect_bulk_delete(delete_context):
+    """A bulk delete of messages may remove any of them."""
+
+    if delete_context.mapper.class_ is Message:
+        session = delete_context.session
+        session.info.setdefault(PENDING_KEY, set()).add(None)
+
+
+@event.listens_for(Session, 'after_commit')
+def discard_deleted_messages(session):
+    """Forget the cards of messages deleted by the committed transaction."""
+
+    for message_id in session.info.pop(PENDING_KEY, ()):
+        if message_id is None:
+            fragment_cache.clear()
+        else:
+            fragment_cache.discard(message_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_pending(session):
+    """Forget deletions that were rolled back."""
+
+    session.info.pop(PENDING_KEY, None)
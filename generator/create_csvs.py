@@ -2,29 +2,49 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --likes 20000000 --processes 8
+
+Generation is offline and reproducible: the same --seed always gives the
+same files, however many processes are used. Rows are generated and
+written a chunk at a time, so memory use doesn't grow with the data.
+
+Follows and likes are skewed like real social graphs: who gets followed,
+who writes and which messages get liked follow power laws (see --alpha),
+so a few celebrities have huge followings while most users have few.
+likes.csv is only written when --likes is given.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import io
+import os
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import PowerLaw, get_random_datetime
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 0
 
-fake = Faker()
+# bcrypt hash of "password", shared by every generated user.
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Profile and header image URLs to choose from (never fetched here).
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +52,214 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
+    f"https://picsum.photos/seed/warbler{i}/1280/400"
     for i in range(1, 46)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+# Messages are dated between these.
+START = datetime(2022, 1, 1)
+END = datetime(2024, 1, 1)
+
+
+def chunk_rng(options, table, index):
+    """Random number generator for a chunk, seeded by its table and index."""
+
+    return Random(f"{options.seed}:{table}:{index}")
+
+
+def chunk_faker(rng):
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(64))
+    return fake
+
+
+def quotas(total, start, end, count):
+    """Split `total` rows over ids 1..count; the share of ids start..end-1."""
+
+    def before(i):
+        return total * (i - 1) // count
+
+    return before(end) - before(start)
+
+
+def distinct_draws(rng, draw, k, exclude, n):
+    """`k` distinct ids from `draw(rng)`, avoiding `exclude`.
+
+    Falls back to uniform draws if the skewed ones keep repeating.
+    """
+
+    chosen = set()
+    attempts = 0
+
+    while len(chosen) < k:
+        if attempts < 20 * k:
+            id = draw(rng)
+        else:
+            id = rng.randint(1, n)
+
+        attempts += 1
+
+        if id != exclude:
+            chosen.add(id)
+
+    return chosen
+
+
+def per_owner(rng, total, start, end, cap):
+    """How many rows each of ids start..end-1 owns, `total` in all."""
+
+    counts = {}
+
+    for _ in range(total):
+        owner = rng.randrange(start, end)
+        counts[owner] = counts.get(owner, 0) + 1
+
+    return sorted((owner, min(count, cap)) for owner, count in counts.items())
+
+
+##############################################################################
+# Generating each table, a chunk of ids at a time
+
+
+def users_chunk(options, index, start, end):
+    rng = chunk_rng(options, 'users', index)
+    fake = chunk_faker(rng)
+
+    for i in range(start, end):
+        # The id suffix keeps usernames and emails unique at any scale.
+        yield [
+            f"{fake.user_name()}{i}@{fake.free_email_domain()}",
+            f"{fake.user_name()}{i}",
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
+        ]
+
+
+def messages_chunk(options, index, start, end):
+    rng = chunk_rng(options, 'messages', index)
+    fake = chunk_faker(rng)
+    # Scattered differently from follows, so that the most prolific
+    # authors aren't also the most followed.
+    authors = PowerLaw(options.users, options.alpha, scatter=40503,
+                       offset=options.users // 2)
+
+    for _ in range(start, end):
+        yield [
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng, START, END),
+            authors.draw(rng),
+        ]
+
+
+def follows_chunk(options, index, start, end):
+    """Follows by users start..end-1, of power-law-popular users."""
+
+    rng = chunk_rng(options, 'follows', index)
+    popular = PowerLaw(options.users, options.alpha)
+    total = quotas(options.follows, start, end, options.users)
+    cap = (options.users - 1) // 2
+
+    for follower, count in per_owner(rng, total, start, end, cap):
+        for followed in sorted(distinct_draws(rng, popular.draw, count,
+                                              follower, options.users)):
+            yield [followed, follower]
+
+
+def likes_chunk(options, index, start, end):
+    """Likes by users start..end-1, of power-law-popular messages."""
+
+    rng = chunk_rng(options, 'likes', index)
+    popular = PowerLaw(options.messages, options.alpha)
+    total = quotas(options.likes, start, end, options.users)
+    cap = options.messages // 2
+
+    for user, count in per_owner(rng, total, start, end, cap):
+        for message in sorted(distinct_draws(rng, popular.draw, count,
+                                             None, options.messages)):
+            yield [user, message]
+
+
+# (file name, headers, chunk generator, option giving the number of ids to
+# split into chunks)
+TABLES = [
+    ('users.csv', USERS_CSV_HEADERS, users_chunk, 'users'),
+    ('messages.csv', MESSAGES_CSV_HEADERS, messages_chunk, 'messages'),
+    ('follows.csv', FOLLOWS_CSV_HEADERS, follows_chunk, 'users'),
+    ('likes.csv', LIKES_CSV_HEADERS, likes_chunk, 'users'),
+]
+
+
+def render_chunk(job):
+    """(CSV text, rows) of one chunk of a table; runs in a worker process."""
+
+    options, filename, index, start, end = job
+    generate = {name: fn for name, _, fn, _ in TABLES}[filename]
+
+    rows = list(generate(options, index, start, end))
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+
+    return buffer.getvalue(), len(rows)
+
+
+def write_table(pool, options, filename, headers, ids):
+    """Write a table's CSV, a chunk of ids at a time; return rows written."""
+
+    jobs = [(options, filename, index, start, min(start + options.chunk_size,
+                                                  ids + 1))
+            for index, start in enumerate(
+                range(1, ids + 1, options.chunk_size))]
+
+    chunks = pool.imap(render_chunk, jobs) if pool else map(render_chunk, jobs)
+    rows = 0
+
+    with open(os.path.join(options.out_dir, filename), 'w', newline='') as f:
+        csv.writer(f).writerow(headers)
+
+        for text, count in chunks:
+            f.write(text)
+            rows += count
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--alpha', type=float, default=1.1,
+                        help="power-law exponent of popularity (higher is "
+                             "more skewed)")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help="ids generated per chunk")
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--out-dir', default='generator')
+    options = parser.parse_args()
+
+    pool = Pool(options.processes) if options.processes > 1 else None
+
+    try:
+        for filename, headers, _, ids_option in TABLES:
+            if filename == 'likes.csv' and not options.likes:
+                continue
+
+            rows = write_table(pool, options, filename, headers,
+                               getattr(options, ids_option))
+            print(f"{filename}: {rows} rows")
+
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,46 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import timedelta
+from math import exp, gcd, log
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(rng, start, end):
+    """Get a random datetime between `start` and `end`, using `rng`."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    return start + timedelta(
+        seconds=rng.uniform(0, (end - start).total_seconds()))
 
-    return datetime.fromtimestamp(random_timestamp)
+
+class PowerLaw:
+    """Draws ids 1..n with a power-law (Zipf-like) skew, in O(1) memory.
+
+    Ranks are drawn from a truncated continuous power law with exponent
+    `alpha`, so rank 1 is the most likely. Ranks are then scattered over
+    the ids by multiplying by a number coprime to n (and shifting by
+    `offset`), so that the most popular ids aren't simply the lowest ones.
+    """
+
+    def __init__(self, n, alpha, scatter=2654435761, offset=0):
+        self.n = n
+        self.alpha = alpha
+        self.offset = offset
+
+        while gcd(scatter, n) != 1:
+            scatter += 1
+        self.scatter = scatter
+
+    def rank(self, rng):
+        u = rng.random()
+
+        if abs(self.alpha - 1) < 1e-9:
+            x = exp(u * log(self.n + 1))
+        else:
+            e = 1 - self.alpha
+            x = (((self.n + 1) ** e - 1) * u + 1) ** (1 / e)
+
+        return min(int(x), self.n)
+
+    def draw(self, rng):
+        """A random id in 1..n."""
+
+        return ((self.rank(rng) - 1) * self.scatter + self.offset) % self.n + 1
@@ -0,0 +1,141 @@
+"""HTTP caching policies for Warbler's responses.
+
+Every response gets a Cache-Control header chosen by its route:
+
+- By default pages are `private, no-cache`: browsers may keep them, but
+  must check back with the server before reusing them.
+- Routes decorated with `cache_policy(anonymous_max_age=...)` are
+  `public` for logged-out visitors, so shared caches can serve them too.
+  They `Vary: Cookie`, so those caches never serve them to anyone logged
+  in.
+- Templates link to static files with `static_url`, which fingerprints
+  the URL with the file's contents (`?v=...`) so that a changed file gets
+  a new URL. Fingerprinted requests are cached for a year
+  (STATIC_FINGERPRINTED_MAX_AGE). Static files requested without one,
+  such as images named in the stylesheet or as database defaults, keep
+  the short SEND_FILE_MAX_AGE_DEFAULT, so that changes to them show up.
+- Responses to anything but GET / HEAD, and responses that change the
+  session (such as pages showing flashed messages), are `no-store`.
+
+Pages whose content is determined by a few known values (ids, updated_at
+timestamps, counters) can be rendered with `conditional`, which tags them
+with an ETag derived from those values and answers a matching
+If-None-Match with a 304, without rendering the page.
+"""
+
+import hashlib
+import os
+from time import time
+
+from flask import current_app, g, make_response, request, session, url_for
+
+NO_STORE = 'no-store'
+REVALIDATE = 'private, no-cache'
+
+
+def cache_policy(anonymous_max_age):
+    """Let shared caches keep the view's pages for logged-out visitors.
+
+    Apply beneath `@app.route`:
+
+        @app.route('/')
+        @cache_policy(anonymous_max_age=300)
+        def homepage():
+            ...
+    """
+
+    def decorator(view):
+        view.anonymous_max_age = anonymous_max_age
+        return view
+
+    return decorator
+
+
+def page_etag(*versions):
+    """ETag of the current page, given the values its content depends on.
+
+    The page's URL and the viewer (who appears in the navbar) are always
+    part of the tag.
+    """
+
+    viewer = (g.user.id, g.user.updated_at) if g.user else None
+    raw = repr((request.full_path, viewer, versions)).encode('UTF-8')
+
+    return hashlib.sha1(raw).hexdigest()
+
+
+def conditional(render, *versions):
+    """Response for a page determined by `versions`, rendered by `render()`.
+
+    Answers 304 Not Modified if the client already has this version of the
+    page, unless there are flashed messages waiting to be shown on it.
+    """
+
+    etag = page_etag(*versions)
+
+    if request.if_none_match.contains(etag) and '_flashes' not in session:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+    return response
+
+
+_fingerprints = {}
+
+
+def static_url(filename):
+    """URL of a static file, fingerprinted with a hash of its contents."""
+
+    path = os.path.join(current_app.static_folder, filename)
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return url_for('static', filename=filename)
+
+    cached = _fingerprints.get(path)
+
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()[:12]
+        cached = _fingerprints[path] = (mtime, digest)
+
+    return url_for('static', filename=filename, v=cached[1])
+
+
+def init_http_caching(app):
+    """Set Cache-Control on every response from `app` by its route's policy."""
+
+    app.add_template_global(static_url)
+
+    @app.after_request
+    def set_cache_control(response):
+        if request.endpoint == 'static':
+            if request.args.get('v') and response.status_code in (200, 304):
+                max_age = app.config['STATIC_FINGERPRINTED_MAX_AGE']
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+                response.expires = time() + max_age
+
+            return response
+
+        view = app.view_functions.get(request.endpoint)
+        anonymous_max_age = getattr(view, 'anonymous_max_age', None)
+
+        if request.method not in ('GET', 'HEAD') or session.modified:
+            response.headers['Cache-Control'] = NO_STORE
+
+        elif (anonymous_max_age is not None and not g.get('user') and
+                response.status_code in (200, 304)):
+            response.headers['Cache-Control'] = (
+                f'public, max-age={anonymous_max_age}')
+            # Logged-in visitors, who have a session cookie, get another
+            # page at the same URL.
+            response.vary.add('Cookie')
+
+        else:
+            response.headers['Cache-Control'] = REVALIDATE
+
+        return response
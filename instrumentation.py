@@ -0,0 +1,312 @@
+"""Counting and timing the work each request does.
+
+Routes declare how many statements they should need with `query_budget`.
+Every request's statements are counted, and a request that goes over its
+route's budget is logged, so that N+1 query patterns show up early. Tests
+can count the statements of any block of code with `count_queries`.
+
+Each request's time is also broken down into time spent in the database,
+rendering templates and hashing passwords (blocks wrapped in `timed`).
+The breakdown is sent back in a Server-Timing header, and recorded in
+per-route histograms that `metrics.render()` exposes in Prometheus text
+format. All of this is a few counter updates per request, cheap enough to
+leave on in production. Histograms are per process.
+"""
+
+import threading
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import before_render_template, g, has_request_context, request
+from flask import template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryCounter:
+    """Running count and time of the SQL statements executed while active."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+
+    def record(self, statement):
+        self.count += 1
+        self.statements.append(statement)
+
+
+def _active_counters():
+    if not hasattr(_local, 'counters'):
+        _local.counters = []
+    return _local.counters
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements run on this thread inside the `with` block."""
+
+    counter = QueryCounter()
+    _active_counters().append(counter)
+
+    try:
+        yield counter
+    finally:
+        _active_counters().remove(counter)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    for counter in _active_counters():
+        counter.record(statement)
+
+    conn.info.setdefault('statement_starts', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _time_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    seconds = perf_counter() - conn.info['statement_starts'].pop()
+
+    for counter in _active_counters():
+        counter.seconds += seconds
+
+
+@event.listens_for(Engine, 'handle_error')
+def _forget_failed_statement(context):
+    starts = context.connection.info.get('statement_starts')
+
+    if starts:
+        starts.pop()
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the `with` block to the request's `name` timing."""
+
+    start = perf_counter()
+
+    try:
+        yield
+    finally:
+        if has_request_context() and 'timings' in g:
+            g.timings[name] += perf_counter() - start
+
+
+##############################################################################
+# Per-route histograms, in Prometheus text format
+
+
+DURATION_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    """Prometheus-style histogram of observations, by route."""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, route, value):
+        series = self._series.get(route)
+
+        if series is None:
+            series = self._series[route] = [[0] * len(self.buckets), 0, 0.0]
+
+        index = bisect_left(self.buckets, value)
+
+        if index < len(self.buckets):
+            series[0][index] += 1
+
+        series[1] += 1
+        series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+
+        for route, (counts, count, total) in sorted(self._series.items()):
+            cumulative = 0
+
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{route="{route}",'
+                             f'le="{bound}"}} {cumulative}')
+
+            lines.append(
+                f'{self.name}_bucket{{route="{route}",le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{route="{route}"}} {total}')
+            lines.append(f'{self.name}_count{{route="{route}"}} {count}')
+
+        return lines
+
+
+class Metrics:
+    """The request histograms of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {
+            'total': Histogram('warbler_request_duration_seconds',
+                               'Time to handle a request.',
+                               DURATION_BUCKETS),
+            'queries': Histogram('warbler_request_queries',
+                                 'SQL statements issued per request.',
+                                 QUERY_BUCKETS),
+            'db': Histogram('warbler_request_db_seconds',
+                            'Time spent in the database per request.',
+                            DURATION_BUCKETS),
+            'render': Histogram('warbler_request_render_seconds',
+                                'Time spent rendering templates per request.',
+                                DURATION_BUCKETS),
+            'bcrypt': Histogram('warbler_request_bcrypt_seconds',
+                                'Time spent hashing passwords per request.',
+                                DURATION_BUCKETS),
+        }
+
+    def observe(self, route, values):
+        """Record a request to `route`, with values by histogram key."""
+
+        with self._lock:
+            for key, value in values.items():
+                self.histograms[key].observe(route, value)
+
+    def render(self):
+        """Every histogram, in Prometheus text format."""
+
+        with self._lock:
+            lines = [line for histogram in self.histograms.values()
+                     for line in histogram.render()]
+
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            for histogram in self.histograms.values():
+                histogram._series.clear()
+
+
+metrics = Metrics()
+
+
+def server_timing(timings, counter, total):
+    """Server-Timing header value for a request's timings."""
+
+    parts = [f'db;dur={counter.seconds * 1000:.1f};'
+             f'desc="{counter.count} queries"']
+
+    for name, seconds in sorted(timings.items()):
+        parts.append(f'{name};dur={seconds * 1000:.1f}')
+
+    parts.append(f'total;dur={total * 1000:.1f}')
+
+    return ', '.join(parts)
+
+
+def query_budget(limit):
+    """Declare the most SQL statements a view should issue per request.
+
+    Apply beneath `@app.route`:
+
+        @app.route('/')
+        @query_budget(4)
+        def homepage():
+            ...
+
+    Routes that write follows should count a statement for the follow
+    graph catching up with its change feed on commit.
+    """
+
+    def decorator(view):
+        view.query_budget = limit
+        return view
+
+    return decorator
+
+
+def budget_for(app, endpoint):
+    """The query budget declared by the view for `endpoint`, or None."""
+
+    return getattr(app.view_functions.get(endpoint), 'query_budget', None)
+
+
+def init_instrumentation(app):
+    """Count and time the statements of every request made to `app`.
+
+    Call this before registering other `before_request` hooks, so that their
+    queries are counted too.
+    """
+
+    @app.before_request
+    def start_counting_queries():
+        g.request_start = perf_counter()
+        g.timings = Counter()
+        g.query_counter = QueryCounter()
+        _active_counters().append(g.query_counter)
+
+    @app.teardown_request
+    def stop_counting_queries(exc):
+        counter = g.pop('query_counter', None)
+
+        if counter in _active_counters():
+            _active_counters().remove(counter)
+
+    @app.after_request
+    def check_query_budget(response):
+        counter = g.get('query_counter')
+        budget = budget_for(app, request.endpoint)
+
+        if counter and budget is not None and counter.count > budget:
+            app.logger.warning(
+                "%s issued %d queries, over its budget of %d",
+                request.endpoint, counter.count, budget)
+
+        return response
+
+    @app.after_request
+    def record_timings(response):
+        counter = g.get('query_counter')
+
+        if counter is None:
+            return response
+
+        total = perf_counter() - g.request_start
+        timings = g.timings
+
+        response.headers['Server-Timing'] = server_timing(
+            timings, counter, total)
+
+        metrics.observe(request.endpoint or 'unknown', {
+            'total': total,
+            'queries': counter.count,
+            'db': counter.seconds,
+            'render': timings['render'],
+            'bcrypt': timings['bcrypt'],
+        })
+
+        return response
+
+    @before_render_template.connect_via(app)
+    def start_render_timer(sender, template, context, **extra):
+        if 'timings' in g:
+            g.setdefault('render_starts', []).append(perf_counter())
+
+    @template_rendered.connect_via(app)
+    def stop_render_timer(sender, template, context, **extra):
+        starts = g.get('render_starts')
+
+        if starts:
+            start = starts.pop()
+
+            # Only the outermost template counts, so nested renders
+            # aren't counted twice.
+            if not starts:
+                g.timings['render'] += perf_counter() - start
@@ -0,0 +1,50 @@
+"""Per-request lookup of which displayed messages the viewer has liked.
+
+Rather than loading the viewer's whole likes collection and scanning it
+for every message on a page, views `prime` the request's LikeState with
+the messages they are about to render. That runs one
+``message_id IN (...)`` query, after which templates check `msg.id in
+liked` against a set.
+"""
+
+from flask import g
+
+from models import Likes
+
+
+class LikeState:
+    """Which of the messages shown on this request `user_id` has liked."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.liked = set()
+        self.resolved = set()
+
+    def prime(self, messages):
+        """Look up the like state of `messages` in a single query."""
+
+        ids = {msg.id for msg in messages} - self.resolved
+
+        if self.user_id and ids:
+            rows = (Likes
+                    .query
+                    .with_entities(Likes.message_id)
+                    .filter(Likes.user_id == self.user_id,
+                            Likes.message_id.in_(ids)))
+            self.liked.update(message_id for (message_id,) in rows)
+
+        self.resolved.update(ids)
+        return messages
+
+    def __contains__(self, message_id):
+        return message_id in self.liked
+
+
+def get_like_state():
+    """Get the LikeState for the current viewer, creating it if needed."""
+
+    if 'like_state' not in g:
+        user = g.get('user')
+        g.like_state = LikeState(user.id if user else None)
+
+    return g.like_state
@@ -0,0 +1,64 @@
+"""Liking and unliking messages.
+
+A like is toggled in a single statement: it deletes the like if there is
+one and inserts it otherwise, and moves the user's and the message's
+`likes_count` by the difference. Doing it all in one round trip keeps the
+counters in step with the likes table even when toggles race, without
+loading the user's likes to find out which way to go.
+"""
+
+from sqlalchemy import text
+
+from models import db
+
+TOGGLE_LIKE = text("""
+    WITH target AS (
+        SELECT messages.id
+        FROM messages JOIN users ON users.id = messages.user_id
+        WHERE messages.id = :message_id AND users.deleted_at IS NULL
+    ), removed AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id
+          AND message_id IN (SELECT id FROM target)
+        RETURNING message_id
+    ), added AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, id
+        FROM target
+        WHERE NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT DO NOTHING
+        RETURNING message_id
+    ), delta AS (
+        SELECT (SELECT count(*) FROM added)
+               - (SELECT count(*) FROM removed) AS n
+    ), liker AS (
+        UPDATE users
+        SET likes_count = users.likes_count + delta.n
+        FROM delta
+        WHERE users.id = :user_id AND delta.n <> 0
+    ), message AS (
+        UPDATE messages
+        SET likes_count = messages.likes_count + delta.n
+        FROM delta
+        WHERE messages.id IN (SELECT id FROM target)
+        RETURNING messages.likes_count
+    )
+    SELECT NOT EXISTS (SELECT 1 FROM removed) AS liked, likes_count
+    FROM message
+""")
+
+
+def toggle_like(user_id, message_id):
+    """Like `message_id` as `user_id`, or unlike it if they already do.
+
+    Returns (liked, the message's new like count), or None if there is no
+    such message (or its author was deleted). The caller commits.
+    """
+
+    row = db.session.execute(TOGGLE_LIKE, {'user_id': user_id,
+                                           'message_id': message_id}).first()
+
+    if row is None:
+        return None
+
+    return row.liked, row.likes_count
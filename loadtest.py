@@ -0,0 +1,207 @@
+"""Load test: replay a mix of requests against Warbler and time them.
+
+    python loadtest.py [--mix mix.jsonl] [--requests 2000] [--concurrency 8]
+                       [--seed-dir generator] [--out results.json]
+
+Requests are sent through `app.test_client()` from `--concurrency` threads,
+each logged in as a random user, against the database in DATABASE_URL.
+`--seed-dir` first reseeds that database from a directory of CSVs (see
+seed.py and generator/create_csvs.py), to test at a given dataset size.
+
+A mix is a JSONL file with one kind of request per line, e.g.
+
+    {"name": "home", "path": "/", "weight": 40, "login": true}
+    {"name": "post", "method": "POST", "path": "/messages/new",
+     "data": {"text": "Load test"}, "weight": 5, "login": true}
+
+`{user_id}` and `{message_id}` in paths are replaced with random existing
+ids. Without `--mix`, the built-in MIX below is used.
+
+For each kind of request, the report gives its count, latency percentiles
+(p50 / p95 / p99, in ms), requests per second and mean SQL statements per
+request, and is printed and (with `--out`) written as JSON so runs can be
+compared. CSRF checks are turned off so that form posts go through.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+from time import perf_counter
+
+from sqlalchemy import func
+
+from app import app, CURR_USER_KEY
+from instrumentation import count_queries
+from models import db, User, Message
+
+MIX = [
+    {'name': 'home', 'path': '/', 'weight': 40, 'login': True},
+    {'name': 'profile', 'path': '/users/{user_id}', 'weight': 25},
+    {'name': 'message', 'path': '/messages/{message_id}', 'weight': 15},
+    {'name': 'like', 'method': 'POST',
+     'path': '/users/add_like/{message_id}', 'weight': 10, 'login': True},
+    {'name': 'post', 'method': 'POST', 'path': '/messages/new',
+     'data': {'text': 'Load test warble'}, 'weight': 5, 'login': True},
+    {'name': 'search', 'path': '/users?q=a', 'weight': 5},
+]
+
+
+def read_mix(path):
+    """The request kinds in a JSONL mix file."""
+
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, p):
+    """The `p`th percentile of sorted `values` (nearest rank)."""
+
+    if not values:
+        return None
+
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+class Recorder:
+    """Latencies and statement counts of each kind of request."""
+
+    def __init__(self):
+        self.samples = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, queries, status):
+        with self._lock:
+            self.samples.setdefault(name, []).append((seconds, queries))
+            counts = self.statuses.setdefault(name, {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def report(self, elapsed):
+        """Summary of every kind of request, as a JSON-able dict."""
+
+        routes = {}
+
+        for name, samples in sorted(self.samples.items()):
+            latencies = sorted(seconds * 1000 for seconds, _ in samples)
+
+            routes[name] = {
+                'count': len(samples),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'rps': len(samples) / elapsed,
+                'queries_per_request': (
+                    sum(queries for _, queries in samples) / len(samples)),
+                'statuses': {str(status): count for status, count
+                             in sorted(self.statuses[name].items())},
+            }
+
+        total = sum(route['count'] for route in routes.values())
+
+        return {'requests': total,
+                'seconds': elapsed,
+                'rps': total / elapsed if elapsed else 0,
+                'routes': routes}
+
+
+def sample_ids(column, size=1000):
+    """Up to `size` random values of `column`."""
+
+    return [id for id, in (db.session
+                           .query(column)
+                           .order_by(func.random())
+                           .limit(size))]
+
+
+def worker(mix, weights, count, user_ids, message_ids, recorder, rng):
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = rng.choice(user_ids)
+
+    for kind in rng.choices(mix, weights, k=count):
+        path = kind['path'].format(user_id=rng.choice(user_ids),
+                                   message_id=rng.choice(message_ids))
+
+        with count_queries() as queries:
+            start = perf_counter()
+            resp = client.open(path,
+                               method=kind.get('method', 'GET'),
+                               data=kind.get('data'))
+            seconds = perf_counter() - start
+
+        recorder.record(kind['name'], seconds, queries.count, resp.status_code)
+        resp.close()
+
+
+def run(mix, requests, concurrency, seed=None):
+    """Send `requests` requests from `mix` over `concurrency` threads.
+
+    Returns the report as a dict.
+    """
+
+    user_ids = sample_ids(User.id)
+    message_ids = sample_ids(Message.id)
+    db.session.remove()
+
+    if not user_ids or not message_ids:
+        raise ValueError("The database needs users and messages to test with")
+
+    weights = [kind.get('weight', 1) for kind in mix]
+    recorder = Recorder()
+    rng = random.Random(seed)
+
+    threads = [
+        threading.Thread(
+            target=worker,
+            args=(mix, weights,
+                  requests // concurrency + (i < requests % concurrency),
+                  user_ids, message_ids, recorder,
+                  random.Random(rng.random())))
+        for i in range(concurrency)]
+
+    start = perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return recorder.report(perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a mix of requests against Warbler and time them.")
+    parser.add_argument('--mix', help="JSONL file of request kinds")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, help="random seed for the mix")
+    parser.add_argument('--seed-dir',
+                        help="reseed the database from these CSVs first")
+    parser.add_argument('--out', help="write the report here as JSON")
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    mix = read_mix(args.mix) if args.mix else MIX
+
+    if args.seed_dir:
+        from seed import seed
+        seed(args.seed_dir)
+
+    report = run(mix, args.requests, args.concurrency, seed=args.seed)
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
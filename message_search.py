@@ -0,0 +1,188 @@
+"""Full-text search over message text.
+
+Two interchangeable backends find the messages matching a query:
+
+- PostgresSearch matches `to_tsvector(text) @@ plainto_tsquery(q)`, served
+  by the GIN index defined in models.py. PostgreSQL keeps the index up to
+  date itself.
+
+- InvertedIndex keeps a word -> message ids index in memory, for databases
+  without full-text search (and tests). It is built from the messages
+  table on first use and then updated as messages are added and removed.
+
+Either way, a search is a query on Message, so it can be filtered further
+and paged with cursors like any other feed.
+"""
+
+import re
+from datetime import datetime, timedelta
+from threading import Lock
+
+from flask import abort
+from sqlalchemy import false, func
+from sqlalchemy.orm import joinedload
+
+from models import db, Message, Timelines, User, AUTHOR_COLUMNS
+from models import tombstoned_user_ids
+from pagination import paginate
+
+SEARCH_CONFIG = 'english'
+
+WORD = re.compile(r"\w+")
+
+
+class PostgresSearch:
+    """Full-text search using PostgreSQL's tsvector / tsquery."""
+
+    def matching(self, q):
+        """SQL criterion for messages matching every word of `q`."""
+
+        return (func.to_tsvector(SEARCH_CONFIG, Message.text)
+                .op('@@')(func.plainto_tsquery(SEARCH_CONFIG, q)))
+
+    def add(self, msg):
+        """Nothing to do: PostgreSQL maintains the index."""
+
+    def remove(self, message_id):
+        """Nothing to do: PostgreSQL maintains the index."""
+
+
+class InvertedIndex:
+    """Full-text search using an in-process inverted index."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._postings = None
+        self._words = None
+
+    @staticmethod
+    def words(text):
+        """The distinct, lowercased words of `text`."""
+
+        return set(WORD.findall(text.lower()))
+
+    def _ensure_loaded(self):
+        if self._postings is not None:
+            return
+
+        self._postings = {}
+        self._words = {}
+
+        for id, text in db.session.query(Message.id, Message.text):
+            self._index(id, text)
+
+    def _index(self, message_id, text):
+        words = self.words(text)
+        self._words[message_id] = words
+
+        for word in words:
+            self._postings.setdefault(word, set()).add(message_id)
+
+    def matching(self, q):
+        """SQL criterion for messages matching every word of `q`."""
+
+        with self._lock:
+            self._ensure_loaded()
+
+            postings = [self._postings.get(word, set())
+                        for word in self.words(q)]
+
+            if not postings:
+                return false()
+
+            ids = set.intersection(*postings)
+
+        return Message.id.in_(ids) if ids else false()
+
+    def add(self, msg):
+        """Index a new message."""
+
+        with self._lock:
+            if self._postings is not None:
+                self._index(msg.id, msg.text)
+
+    def remove(self, message_id):
+        """Drop a deleted message from the index."""
+
+        with self._lock:
+            if self._postings is None:
+                return
+
+            for word in self._words.pop(message_id, ()):
+                ids = self._postings[word]
+                ids.discard(message_id)
+
+                if not ids:
+                    del self._postings[word]
+
+    def clear(self):
+        """Drop the index, so that it is rebuilt on next use."""
+
+        with self._lock:
+            self._postings = None
+            self._words = None
+
+
+_backends = {}
+
+
+def message_search():
+    """The search backend configured for the current app."""
+
+    name = (db.get_app().config.get('MESSAGE_SEARCH_BACKEND') or
+            ('postgres' if db.engine.dialect.name == 'postgresql'
+             else 'memory'))
+
+    if name not in _backends:
+        _backends[name] = {'postgres': PostgresSearch,
+                           'memory': InvertedIndex}[name]()
+
+    return _backends[name]
+
+
+def parse_date(value):
+    """Parse a YYYY-MM-DD query param; 400 if malformed."""
+
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+
+def search_messages(q, author=None, since=None, until=None, timeline_of=None,
+                    before=None, after=None):
+    """Find a Page of messages matching `q`, newest first.
+
+    Messages by deleted users are left out.
+
+    - author: only messages by the user with this username
+    - since / until: only messages posted on or between these dates
+      (YYYY-MM-DD, inclusive)
+    - timeline_of: only messages in this user id's home timeline, i.e. by
+      them or by people they follow
+    - before / after: cursors from a previous Page
+    """
+
+    query = (Message
+             .query
+             .filter(message_search().matching(q))
+             .filter(Message.user_id.notin_(tombstoned_user_ids()))
+             .options(joinedload(Message.user).load_only(*AUTHOR_COLUMNS)))
+
+    if author:
+        query = query.filter(Message.user.has(User.username == author))
+
+    if since:
+        query = query.filter(Message.timestamp >= parse_date(since))
+
+    if until:
+        query = query.filter(
+            Message.timestamp < parse_date(until) + timedelta(days=1))
+
+    if timeline_of:
+        query = (query
+                 .join(Timelines, Timelines.message_id == Message.id)
+                 .filter(Timelines.user_id == timeline_of))
+
+    return paginate(query, Message.timestamp, Message.id,
+                    before=before, after=after)
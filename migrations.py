@@ -0,0 +1,271 @@
+"""Schema migrations for existing Warbler databases (PostgreSQL).
+
+`db.create_all()` creates missing tables at the current schema, but never
+alters tables that already exist. MIGRATIONS brings a database created from
+an earlier schema up to date, a step at a time:
+
+    flask migrate
+
+Steps are applied in order, and recorded in the schema_migrations table so
+that each runs only once. Every step is also written to be harmless on a
+database that already has its change, so that a database made by
+`create_all()` can be migrated too (its steps are then simply recorded).
+
+Add new steps to the end of the list; never edit or reorder applied ones.
+"""
+
+from sqlalchemy import text
+
+# (name, SQL) of each step, oldest first.
+MIGRATIONS = [
+    ('0001_timelines', """
+        CREATE TABLE IF NOT EXISTS timelines (
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            message_id INTEGER NOT NULL
+                REFERENCES messages (id) ON DELETE CASCADE,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (user_id, message_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS ix_timelines_user_timestamp
+            ON timelines (user_id, timestamp, message_id);
+
+        INSERT INTO timelines (user_id, message_id, timestamp)
+        SELECT user_id, id, timestamp FROM messages
+        UNION
+        SELECT f.user_following_id, m.id, m.timestamp
+        FROM follows f JOIN messages m ON m.user_id = f.user_being_followed_id
+        ON CONFLICT DO NOTHING;
+    """),
+
+    ('0002_counters', """
+        ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS messages_count INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0;
+
+        ALTER TABLE messages
+            ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0;
+
+        UPDATE users SET
+            messages_count = (SELECT count(*) FROM messages m
+                              WHERE m.user_id = users.id),
+            following_count = (SELECT count(*) FROM follows f
+                               WHERE f.user_following_id = users.id),
+            followers_count = (SELECT count(*) FROM follows f
+                               WHERE f.user_being_followed_id = users.id),
+            likes_count = (SELECT count(*) FROM likes l
+                           WHERE l.user_id = users.id);
+
+        UPDATE messages SET
+            likes_count = (SELECT count(*) FROM likes l
+                           WHERE l.message_id = messages.id);
+    """),
+
+    ('0003_username_search_indexes', """
+        CREATE INDEX IF NOT EXISTS ix_users_username_prefix
+            ON users (username text_pattern_ops);
+
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_available_extensions
+                       WHERE name = 'pg_trgm') THEN
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+                    ON users USING gin (username gin_trgm_ops);
+            END IF;
+        END
+        $$;
+    """),
+
+    ('0004_message_text_search_index', """
+        CREATE INDEX IF NOT EXISTS ix_messages_text_fts
+            ON messages USING gin (to_tsvector('english', text));
+    """),
+
+    ('0005_users_updated_at', """
+        ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITHOUT TIME ZONE
+                NOT NULL DEFAULT timezone('utc', now());
+    """),
+
+    # Likes were keyed on a surrogate id, with message_id unique (so each
+    # message could only be liked once).
+    ('0006_likes_composite_key', """
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_schema = current_schema()
+                         AND table_name = 'likes'
+                         AND column_name = 'id') THEN
+                DELETE FROM likes
+                WHERE user_id IS NULL OR message_id IS NULL;
+
+                ALTER TABLE likes
+                    DROP CONSTRAINT IF EXISTS likes_message_id_key,
+                    DROP CONSTRAINT likes_pkey,
+                    DROP COLUMN id,
+                    ADD PRIMARY KEY (user_id, message_id);
+            END IF;
+        END
+        $$;
+
+        CREATE INDEX IF NOT EXISTS ix_likes_message_user
+            ON likes (message_id, user_id);
+    """),
+
+    ('0007_timestamp_defaults', """
+        ALTER TABLE messages
+            ALTER COLUMN timestamp SET DEFAULT timezone('utc', now());
+
+        ALTER TABLE users
+            ALTER COLUMN updated_at SET DEFAULT timezone('utc', now());
+    """),
+
+    ('0008_hot_query_indexes', """
+        CREATE INDEX IF NOT EXISTS ix_messages_user_timestamp
+            ON messages (user_id, timestamp DESC, id DESC);
+
+        CREATE INDEX IF NOT EXISTS ix_follows_following_followed
+            ON follows (user_following_id, user_being_followed_id);
+
+        CREATE INDEX IF NOT EXISTS ix_timelines_message
+            ON timelines (message_id);
+
+        ANALYZE messages;
+        ANALYZE follows;
+        ANALYZE timelines;
+    """),
+
+    ('0009_user_tombstones', """
+        ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITHOUT TIME ZONE;
+
+        CREATE INDEX IF NOT EXISTS ix_users_tombstoned
+            ON users (id) WHERE deleted_at IS NOT NULL;
+
+        CREATE TABLE IF NOT EXISTS user_purges (
+            user_id INTEGER PRIMARY KEY,
+            step TEXT,
+            rows_deleted INTEGER NOT NULL DEFAULT 0,
+            requested_at TIMESTAMP WITHOUT TIME ZONE
+                NOT NULL DEFAULT timezone('utc', now()),
+            finished_at TIMESTAMP WITHOUT TIME ZONE
+        );
+    """),
+
+    ('0010_recommendations', """
+        CREATE TABLE IF NOT EXISTS recommendations (
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            candidate_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            score DOUBLE PRECISION NOT NULL,
+            mutuals INTEGER NOT NULL,
+            PRIMARY KEY (user_id, candidate_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS ix_recommendations_candidate
+            ON recommendations (candidate_id);
+
+        CREATE TABLE IF NOT EXISTS stale_recommendations (
+            user_id INTEGER PRIMARY KEY
+                REFERENCES users (id) ON DELETE CASCADE
+        );
+
+        -- Everyone who follows anyone has recommendations to compute.
+        INSERT INTO stale_recommendations (user_id)
+        SELECT DISTINCT user_following_id FROM follows
+        ON CONFLICT DO NOTHING;
+    """),
+
+    ('0011_follow_changes', """
+        CREATE TABLE IF NOT EXISTS follow_changes (
+            id BIGSERIAL PRIMARY KEY,
+            follower_id INTEGER NOT NULL,
+            followed_id INTEGER NOT NULL,
+            following BOOLEAN NOT NULL,
+            changed_at TIMESTAMP WITH TIME ZONE NOT NULL
+        );
+
+        CREATE OR REPLACE FUNCTION record_follow_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO follow_changes
+                    (follower_id, followed_id, following, changed_at)
+                VALUES (NEW.user_following_id, NEW.user_being_followed_id,
+                        true, clock_timestamp());
+            ELSE
+                INSERT INTO follow_changes
+                    (follower_id, followed_id, following, changed_at)
+                VALUES (OLD.user_following_id, OLD.user_being_followed_id,
+                        false, clock_timestamp());
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS follows_record_change ON follows;
+        CREATE TRIGGER follows_record_change
+            AFTER INSERT OR DELETE ON follows
+            FOR EACH ROW EXECUTE PROCEDURE record_follow_change();
+    """),
+
+    ('0012_likes_liked_at', """
+        ALTER TABLE likes
+            ADD COLUMN IF NOT EXISTS liked_at TIMESTAMP WITHOUT TIME ZONE;
+
+        -- When older likes were made isn't known; they can't have been
+        -- before the message was posted.
+        UPDATE likes
+        SET liked_at = messages.timestamp
+        FROM messages
+        WHERE messages.id = likes.message_id AND likes.liked_at IS NULL;
+
+        ALTER TABLE likes
+            ALTER COLUMN liked_at SET DEFAULT timezone('utc', now()),
+            ALTER COLUMN liked_at SET NOT NULL;
+
+        CREATE INDEX IF NOT EXISTS ix_likes_user_liked
+            ON likes (user_id, liked_at, message_id);
+    """),
+]
+
+
+def applied(conn):
+    """Names of the migrations already applied over `conn`."""
+
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMP WITHOUT TIME ZONE
+                NOT NULL DEFAULT timezone('utc', now())
+        )
+    """))
+
+    return {name for name, in conn.execute(
+        text("SELECT name FROM schema_migrations"))}
+
+
+def migrate(conn):
+    """Apply every pending migration over `conn`; return their names.
+
+    Run this in a transaction (e.g. `engine.begin()`), so that a failed
+    step leaves the schema as it was.
+    """
+
+    done = applied(conn)
+    names = []
+
+    for name, sql in MIGRATIONS:
+        if name in done:
+            continue
+
+        conn.execute(text(sql))
+        conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"),
+                     name=name)
+        names.append(name)
+
+    return names
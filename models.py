@@ -2,11 +2,35 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, select, DDL, DateTime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import password_hasher
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
+
+
+class utcnow(FunctionElement):
+    """The current time in UTC, as a timestamp without time zone.
+
+    Used as the server default of timestamp columns, which hold UTC (as the
+    `datetime.utcnow` defaults set by the ORM do).
+    """
+
+    type = DateTime()
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "timezone('utc', now())"
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    # SQLite's CURRENT_TIMESTAMP is already UTC.
+    return "CURRENT_TIMESTAMP"
 
 
 class Follows(db.Model):
@@ -26,26 +50,141 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "who follows this user"; this serves "who does
+    # this user follow", with both columns in the index so that it can be
+    # answered from the index alone.
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+
+class FollowChange(db.Model):
+    """A follow or unfollow, recorded by a trigger on follows (PostgreSQL).
+
+    The feed that each process's follow graph index catches up from (see
+    follow_graph.py), however the change was written.
+    """
+
+    __tablename__ = 'follow_changes'
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    follower_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    followed_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # True for a follow, False for an unfollow.
+    following = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+    changed_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+    )
+
+
+# Every follow and unfollow is appended to follow_changes, in the
+# transaction that makes it. Created once every table exists.
+event.listen(db.Model.metadata, 'after_create', DDL('''
+CREATE OR REPLACE FUNCTION record_follow_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO follow_changes
+            (follower_id, followed_id, following, changed_at)
+        VALUES (NEW.user_following_id, NEW.user_being_followed_id, true,
+                clock_timestamp());
+    ELSE
+        INSERT INTO follow_changes
+            (follower_id, followed_id, following, changed_at)
+        VALUES (OLD.user_following_id, OLD.user_being_followed_id, false,
+                clock_timestamp());
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS follows_record_change ON follows;
+CREATE TRIGGER follows_record_change
+    AFTER INSERT OR DELETE ON follows
+    FOR EACH ROW EXECUTE PROCEDURE record_follow_change();
+''').execute_if(dialect='postgresql'))
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
+    user_id = db.Column(
         db.Integer,
-        primary_key=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    liked_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+    # Also lets a flush insert new messages before likes of them.
+    message = db.relationship('Message')
+
+    # The primary key serves "has this user liked this"; the indexes serve
+    # "what has this user liked", most recently first, and "who liked this
+    # message" (and cascading deletes of messages).
+    __table_args__ = (
+        db.Index('ix_likes_user_liked', 'user_id', 'liked_at', 'message_id'),
+        db.Index('ix_likes_message_user', 'message_id', 'user_id'),
+    )
+
+
+class Timelines(db.Model):
+    """A message delivered to a user's home timeline."""
+
+    __tablename__ = 'timelines'
+
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        # Serves retracting a message from every timeline.
+        db.Index('ix_timelines_message', 'message_id'),
     )
 
 
@@ -94,7 +233,56 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts, kept up to date by counters.py so that
+    # profiles don't need to load whole relationships to count them.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # When the user last edited their profile. Cached message cards are
+    # versioned by their author's updated_at (see fragment_cache.py), so
+    # this must be set whenever a column shown on them changes.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+    # When the user deleted their account. Their rows are then purged in
+    # the background (see purge.py); until then, they are hidden from reads.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Let the database's ON DELETE CASCADE remove a deleted user's messages,
+    # rather than the ORM loading them and nulling out their user_id.
+    messages = db.relationship('Message', cascade='all', passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -115,29 +303,53 @@ class User(db.Model):
         secondary="likes"
     )
 
+    __table_args__ = (
+        # Serves username prefix searches (`LIKE 'q%'`) on PostgreSQL.
+        db.Index('ix_users_username_prefix', 'username',
+                 postgresql_ops={'username': 'text_pattern_ops'}),
+        # Serves finding the (few) deleted users, to hide and purge them.
+        db.Index('ix_users_tombstoned', 'id',
+                 postgresql_where=deleted_at.isnot(None)),
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+        """Is this user followed by `other_user`?
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        Answered from the follow graph index, unless this user's followers
+        are already loaded (and so may hold changes not yet committed).
+        """
+
+        if 'followers' in self.__dict__:
+            return other_user in self.followers
+
+        from follow_graph import follow_graph
+        return follow_graph.is_following(other_user.id, self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_user`?"""
+        """Is this user following `other_user`?
+
+        Answered from the follow graph index, unless the users this user
+        follows are already loaded (and so may hold uncommitted changes).
+        """
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        if 'following' in self.__dict__:
+            return other_user in self.following
+
+        from follow_graph import follow_graph
+        return follow_graph.is_following(self.id, other_user.id)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password and adds user to system. Hashing runs in the
+        password worker pool, and may raise PasswordPoolBusy.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -173,18 +385,136 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the user's hash was made with a different bcrypt cost than is now
+        configured, it is replaced with a fresh hash (for the caller to
+        commit).
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
                 return user
 
         return False
 
 
+def tombstoned_user_ids():
+    """Select of the ids of deleted users not yet purged."""
+
+    return select([User.id]).where(User.deleted_at.isnot(None))
+
+
+class UserPurge(db.Model):
+    """Progress of purging a deleted user's rows (see purge.py).
+
+    Not a foreign key of users, so that it outlives the user it records.
+    """
+
+    __tablename__ = 'user_purges'
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    # The step being worked through; None once the purge has finished.
+    step = db.Column(
+        db.Text,
+    )
+
+    # Rows deleted by the steps so far; the likes and timeline entries of
+    # the user's messages go with them, uncounted.
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+
+class Recommendation(db.Model):
+    """A user suggested to another to follow (see recommendations.py)."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    candidate_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # How many of the users user_id follows follow the candidate.
+    mutuals = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # Serves cascading deletes of candidates.
+        db.Index('ix_recommendations_candidate', 'candidate_id'),
+    )
+
+
+class StaleRecommendations(db.Model):
+    """A user whose follows changed.
+
+    Their recommendations, and their followers', are to be recomputed.
+    """
+
+    __tablename__ = 'stale_recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+        autoincrement=False,
+    )
+
+
+# Substring username searches (`LIKE '%q%'`) are served by a trigram index,
+# where the pg_trgm extension is available.
+event.listen(User.__table__, 'after_create', DDL('''
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions
+               WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+            ON users USING gin (username gin_trgm_ops);
+    END IF;
+END
+$$;
+''').execute_if(dialect='postgresql'))
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -203,7 +533,8 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -212,9 +543,37 @@ class Message(db.Model):
         nullable=False,
     )
 
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
 
+# Serves a user's messages newest first (profiles, the API, timeline
+# backfills) and cascading deletes of users' messages.
+db.Index('ix_messages_user_timestamp',
+         Message.user_id, Message.timestamp.desc(), Message.id.desc())
+
+
+# Full-text searches of message text (see message_search.py) are served by
+# a GIN index over its tsvector, on PostgreSQL.
+event.listen(Message.__table__, 'after_create', DDL('''
+CREATE INDEX IF NOT EXISTS ix_messages_text_fts
+    ON messages USING gin (to_tsvector('english', text));
+''').execute_if(dialect='postgresql'))
+
+
+# Columns needed to show a user as the author of a message.
+AUTHOR_COLUMNS = ('id', 'username', 'image_url', 'updated_at')
+
+# Columns needed to show a user on a card in a listing of users.
+CARD_COLUMNS = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
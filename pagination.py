@@ -0,0 +1,122 @@
+"""Keyset (cursor) pagination for Warbler's message feeds.
+
+Feeds are ordered newest-first on (timestamp, id). Instead of OFFSET, each
+page hands out opaque `before` / `after` cursors encoding the (timestamp, id)
+of its last / first row, so fetching any page is a single indexed range
+read no matter how deep into the feed it is.
+"""
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import tuple_
+
+PAGE_SIZE = 100
+
+
+def encode_token(values):
+    """Make an opaque, URL-safe token from a list of JSON-able values."""
+
+    raw = json.dumps(values, separators=(',', ':')).encode('UTF-8')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_token(token):
+    """Turn a token back into its list of values; 400 if malformed."""
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(urlsafe_b64decode(padded).decode('UTF-8'))
+
+    except (DecodeError, UnicodeDecodeError, ValueError):
+        abort(400)
+
+    if not isinstance(values, list):
+        abort(400)
+
+    return values
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque cursor token for the row at (timestamp, id)."""
+
+    return encode_token([timestamp.isoformat(), id])
+
+
+def decode_cursor(token):
+    """Turn a cursor token back into (timestamp, id); 400 if malformed."""
+
+    try:
+        timestamp, id = decode_token(token)
+        return datetime.fromisoformat(timestamp), int(id)
+
+    except (TypeError, ValueError):
+        abort(400)
+
+
+class Page:
+    """One page of a feed, with cursors for its neighbouring pages.
+
+    `older` / `newer` are cursor tokens (or None at either end of the feed),
+    to be passed back as `before` / `after` respectively.
+    """
+
+    def __init__(self, items, older=None, newer=None):
+        self.items = items
+        self.older = older
+        self.newer = newer
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def message_key(msg):
+    """Sort key of a message in a feed."""
+
+    return msg.timestamp, msg.id
+
+
+def paginate(query, timestamp_col, id_col, before=None, after=None,
+             per_page=PAGE_SIZE, key=message_key):
+    """Return a Page of `query`, newest-first on (timestamp_col, id_col).
+
+    `before` / `after` are cursor tokens from a previous Page; at most one
+    should be given. `key` maps a result row to its (timestamp, id).
+    """
+
+    position = tuple_(timestamp_col, id_col)
+
+    if after:
+        rows = (query
+                .filter(position > tuple_(*decode_cursor(after)))
+                .order_by(timestamp_col.asc(), id_col.asc())
+                .limit(per_page + 1)
+                .all())
+
+        has_newer = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        has_older = bool(items)
+
+    else:
+        if before:
+            query = query.filter(position < tuple_(*decode_cursor(before)))
+
+        rows = (query
+                .order_by(timestamp_col.desc(), id_col.desc())
+                .limit(per_page + 1)
+                .all())
+
+        has_older = len(rows) > per_page
+        items = rows[:per_page]
+        has_newer = bool(before) and bool(items)
+
+    older = encode_cursor(*key(items[-1])) if has_older else None
+    newer = encode_cursor(*key(items[0])) if has_newer else None
+
+    return Page(items, older=older, newer=newer)
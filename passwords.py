@@ -0,0 +1,145 @@
+"""Password hashing and checking, off the request thread.
+
+bcrypt is deliberately slow, and a burst of logins hashing inline would
+starve every other request of CPU. Instead, hashes are computed in a
+bounded pool of worker processes. If more than `max_queue` jobs are
+already waiting, new ones are refused with PasswordPoolBusy rather than
+queued indefinitely; so is a job not done within `timeout` seconds (its
+slot stays taken until it finishes).
+
+The bcrypt cost factor is configurable, and `needs_rehash` tells when a
+stored hash was made with a different cost than the current one, so that
+it can be upgraded the next time its owner logs in.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+from instrumentation import timed
+
+DEFAULT_ROUNDS = 12
+DEFAULT_QUEUE = 64
+DEFAULT_TIMEOUT = 30
+
+
+class PasswordPoolBusy(Exception):
+    """Too many password hashing jobs are already waiting (or running)."""
+
+
+def hash_password(password, rounds):
+    """bcrypt hash of `password` at cost `rounds`, as a string."""
+
+    salt = bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode('UTF-8'), salt).decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return bcrypt.checkpw(password.encode('UTF-8'), hashed.encode('UTF-8'))
+
+
+def hash_rounds(hashed):
+    """The cost factor a bcrypt hash was made with, e.g. 12 for $2b$12$..."""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded process pool (or inline, with no workers)."""
+
+    def __init__(self, workers=0, max_queue=DEFAULT_QUEUE,
+                 rounds=DEFAULT_ROUNDS, timeout=DEFAULT_TIMEOUT):
+        self.configure(workers, max_queue, rounds, timeout)
+
+    def configure(self, workers=0, max_queue=DEFAULT_QUEUE,
+                  rounds=DEFAULT_ROUNDS, timeout=DEFAULT_TIMEOUT):
+        """(Re)configure the hasher; any existing pool is shut down."""
+
+        self.shutdown()
+        self.workers = workers
+        self.rounds = rounds
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(workers + max_queue)
+        self._pool = None
+        self._pool_lock = Lock()
+
+    def shutdown(self):
+        """Stop the worker processes, if they were started."""
+
+        pool = getattr(self, '_pool', None)
+
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def _get_pool(self):
+        # Started lazily, so that worker processes aren't forked at import.
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _run(self, fn, *args):
+        with timed('bcrypt'):
+            if not self.workers:
+                return fn(*args)
+
+            if not self._slots.acquire(blocking=False):
+                raise PasswordPoolBusy()
+
+            try:
+                future = self._get_pool().submit(fn, *args)
+            except BaseException:
+                self._slots.release()
+                raise
+
+            # The slot is held until the job is done, even if we stop
+            # waiting for it.
+            future.add_done_callback(lambda _: self._slots.release())
+
+            try:
+                return future.result(timeout=self.timeout)
+            except TimeoutError:
+                future.cancel()
+                raise PasswordPoolBusy()
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost."""
+
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?
+
+        Raises ValueError if `hashed` is not a bcrypt hash.
+        """
+
+        return self._run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+
+password_hasher = PasswordHasher()
+
+
+def configure_passwords(app):
+    """Set up the password hasher from `app`'s config.
+
+    - PASSWORD_POOL_WORKERS: worker processes (0 hashes inline)
+    - PASSWORD_POOL_QUEUE: jobs that may wait for a worker
+    - BCRYPT_LOG_ROUNDS: bcrypt cost factor for new hashes
+    """
+
+    password_hasher.configure(
+        workers=app.config.get('PASSWORD_POOL_WORKERS', os.cpu_count() or 1),
+        max_queue=app.config.get('PASSWORD_POOL_QUEUE', DEFAULT_QUEUE),
+        rounds=app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS))
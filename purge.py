@@ -0,0 +1,264 @@
+"""Deleting user accounts (PostgreSQL).
+
+Deleting a user in one go would delete every message, like, follow and
+timeline entry of theirs in the request, holding locks on all of them (and
+on the counters of everyone they touched) until it's done. Instead, an
+account is deleted in two parts:
+
+- `tombstone` marks the user deleted, in the request. From then on they
+  can't log in, and their profile, messages and likes are hidden from
+  feeds, searches and listings (see `models.tombstoned_user_ids`).
+
+- `purge_user` deletes their rows in the background, in batches of
+  `batch_size` rows, committing after each:
+
+      flask purge-users [--watch SECONDS]
+
+Each batch is a single statement that deletes its rows and adjusts the
+counters of the users and messages they were counted in, so the counters
+stay in step with the tables however far a purge has got. Progress is kept
+in the user_purges table, in the same transaction as each batch, so a purge
+that is interrupted picks up where it left off. Batches only ever delete
+rows that still exist, so running a purge twice, or twice at once, is
+harmless.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from follow_graph import mark_pending
+from message_search import message_search
+from models import db, UserPurge
+
+# Rows deleted per statement (and transaction).
+PURGE_BATCH = 1000
+
+DELETE_LIKES = text("""
+    WITH batch AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id
+          AND message_id IN (SELECT message_id FROM likes
+                             WHERE user_id = :user_id
+                             LIMIT :batch_size)
+        RETURNING message_id
+    ), uncounted AS (
+        UPDATE messages
+        SET likes_count = messages.likes_count - 1
+        FROM batch
+        WHERE messages.id = batch.message_id
+    )
+    SELECT message_id FROM batch
+""")
+
+DELETE_MESSAGE_TIMELINES = text("""
+    DELETE FROM timelines
+    WHERE (user_id, message_id) IN (
+        SELECT timelines.user_id, timelines.message_id
+        FROM timelines
+        JOIN messages ON messages.id = timelines.message_id
+        WHERE messages.user_id = :user_id
+        LIMIT :batch_size)
+    RETURNING message_id
+""")
+
+DELETE_MESSAGE_LIKES = text("""
+    WITH batch AS (
+        DELETE FROM likes
+        WHERE (user_id, message_id) IN (
+            SELECT likes.user_id, likes.message_id
+            FROM likes
+            JOIN messages ON messages.id = likes.message_id
+            WHERE messages.user_id = :user_id
+            LIMIT :batch_size)
+        RETURNING user_id, message_id
+    ), uncounted_users AS (
+        UPDATE users
+        SET likes_count = users.likes_count - lost.n
+        FROM (SELECT user_id, count(*) AS n
+              FROM batch GROUP BY user_id) AS lost
+        WHERE users.id = lost.user_id
+    ), uncounted_messages AS (
+        UPDATE messages
+        SET likes_count = messages.likes_count - lost.n
+        FROM (SELECT message_id, count(*) AS n
+              FROM batch GROUP BY message_id) AS lost
+        WHERE messages.id = lost.message_id
+    )
+    SELECT message_id FROM batch
+""")
+
+# By now their messages are on no timelines and have no likes, so each
+# batch deletes just `batch_size` messages. Any like that has slipped in
+# since is still uncounted, and its timeline entries cascade.
+DELETE_MESSAGES = text("""
+    WITH batch AS (
+        SELECT id FROM messages
+        WHERE user_id = :user_id
+        LIMIT :batch_size
+    ), unliked AS (
+        DELETE FROM likes
+        WHERE message_id IN (SELECT id FROM batch)
+        RETURNING user_id
+    ), uncounted AS (
+        UPDATE users
+        SET likes_count = users.likes_count - lost.n
+        FROM (SELECT user_id, count(*) AS n
+              FROM unliked GROUP BY user_id) AS lost
+        WHERE users.id = lost.user_id
+    )
+    DELETE FROM messages
+    WHERE id IN (SELECT id FROM batch)
+    RETURNING id
+""")
+
+DELETE_FOLLOWING = text("""
+    WITH batch AS (
+        DELETE FROM follows
+        WHERE user_following_id = :user_id
+          AND user_being_followed_id IN (
+              SELECT user_being_followed_id FROM follows
+              WHERE user_following_id = :user_id
+              LIMIT :batch_size)
+        RETURNING user_being_followed_id
+    ), uncounted AS (
+        UPDATE users
+        SET followers_count = users.followers_count - 1
+        FROM batch
+        WHERE users.id = batch.user_being_followed_id
+    )
+    SELECT user_being_followed_id FROM batch
+""")
+
+DELETE_FOLLOWERS = text("""
+    WITH batch AS (
+        DELETE FROM follows
+        WHERE user_being_followed_id = :user_id
+          AND user_following_id IN (
+              SELECT user_following_id FROM follows
+              WHERE user_being_followed_id = :user_id
+              LIMIT :batch_size)
+        RETURNING user_following_id
+    ), uncounted AS (
+        UPDATE users
+        SET following_count = users.following_count - 1
+        FROM batch
+        WHERE users.id = batch.user_following_id
+    )
+    SELECT user_following_id FROM batch
+""")
+
+DELETE_TIMELINE = text("""
+    DELETE FROM timelines
+    WHERE user_id = :user_id
+      AND message_id IN (SELECT message_id FROM timelines
+                         WHERE user_id = :user_id
+                         LIMIT :batch_size)
+    RETURNING message_id
+""")
+
+DELETE_USER = text("""
+    DELETE FROM users
+    WHERE id = :user_id AND deleted_at IS NOT NULL
+    RETURNING id
+""")
+
+
+def unindex_messages(user_id, message_ids):
+    for message_id in message_ids:
+        message_search().remove(message_id)
+
+
+def unrecord_follows(user_id, user_ids):
+    if user_ids:
+        mark_pending()
+
+
+# (name, statement, what to do with the ids it returns) of each step, in
+# order. A message can be on any number of timelines and have any number
+# of likes, so those are deleted in batches of their own before the
+# messages are. Their messages go before their follows, so that they
+# needn't be pruned from their followers' timelines; their follows go
+# before their own timeline, so that no more is fanned out to it.
+STEPS = [
+    ('likes', DELETE_LIKES, None),
+    ('message_timelines', DELETE_MESSAGE_TIMELINES, None),
+    ('message_likes', DELETE_MESSAGE_LIKES, None),
+    ('messages', DELETE_MESSAGES, unindex_messages),
+    ('following', DELETE_FOLLOWING, unrecord_follows),
+    ('followers', DELETE_FOLLOWERS, unrecord_follows),
+    ('timeline', DELETE_TIMELINE, None),
+    ('user', DELETE_USER, None),
+]
+
+STEP_NAMES = [name for name, _, _ in STEPS]
+
+
+def tombstone(user):
+    """Mark `user` deleted, and queue the purge of their rows.
+
+    The caller commits.
+    """
+
+    user.deleted_at = datetime.utcnow()
+    db.session.add(UserPurge(user_id=user.id, step=STEP_NAMES[0]))
+
+
+def purge_user(user_id, batch_size=PURGE_BATCH, max_batches=None):
+    """Purge a tombstoned user's rows, from where their purge left off.
+
+    Commits after each batch. Stops after `max_batches` batches if given,
+    so that a worker can share its time between users. Returns True if the
+    purge has finished.
+    """
+
+    purge = UserPurge.query.get(user_id)
+    batches = 0
+
+    while purge is not None and purge.step is not None:
+        if max_batches is not None and batches >= max_batches:
+            return False
+
+        index = STEP_NAMES.index(purge.step)
+        name, statement, then = STEPS[index]
+
+        ids = [id for id, in db.session.execute(
+            statement, {'user_id': user_id, 'batch_size': batch_size})]
+
+        if then:
+            then(user_id, ids)
+
+        purge.rows_deleted += len(ids)
+
+        # A short batch means the step has nothing left.
+        if len(ids) < batch_size:
+            if index + 1 < len(STEPS):
+                purge.step = STEP_NAMES[index + 1]
+            else:
+                purge.step = None
+                purge.finished_at = datetime.utcnow()
+
+        db.session.commit()
+        batches += 1
+
+    return True
+
+
+def pending_purges():
+    """Ids of the users whose purge hasn't finished, oldest first."""
+
+    return [user_id for user_id, in (db.session
+                                     .query(UserPurge.user_id)
+                                     .filter(UserPurge.step.isnot(None))
+                                     .order_by(UserPurge.requested_at))]
+
+
+def purge_pending(batch_size=PURGE_BATCH):
+    """Purge every tombstoned user; return the ids purged."""
+
+    purged = pending_purges()
+
+    for user_id in purged:
+        purge_user(user_id, batch_size=batch_size)
+
+    return purged
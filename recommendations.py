@@ -0,0 +1,198 @@
+"""“Who to follow” recommendations.
+
+Users are recommended the friends of their friends: the people followed by
+the people they follow, scored by how many of those follow them (their
+mutuals) plus a bonus for having posted recently. The top TOP_K candidates
+of each user are computed by a batch job and stored in the recommendations
+table, so that showing them on the home page is a single indexed read.
+
+The job scores a batch of users at once, in the database. Their candidates
+are the rows of the follows matrix squared, restricted to the batch: a
+join of follows with itself, counted per (user, candidate) pair, scored and
+cut to the top TOP_K of each user in the same statement. Its cost grows
+with how many people the batch's users are two follows away from, not with
+the size of the whole graph.
+
+Recommendations are refreshed incrementally. Following or unfollowing
+someone changes the friends-of-friends of the follower and of everyone
+following them. `mark_stale` queues just the follower in the
+stale_recommendations table, a single row however many followers they
+have, and `refresh_recommendations` recomputes the queued users and their
+followers:
+
+    flask refresh-recommendations [--all] [--watch SECONDS]
+
+Users are claimed from the queue before the graph is read, so a follow
+made during a refresh queues its users again. If a refresh fails part way,
+the users it claimed keep their old recommendations until they are next
+queued, or until a refresh of `--all` users.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import load_only
+
+from follow_graph import follow_graph
+from models import (db, Follows, Recommendation, StaleRecommendations, User,
+                    CARD_COLUMNS)
+
+# Candidates stored per user.
+TOP_K = 20
+
+# Candidates shown on the home page.
+SHOWN = 5
+
+# Messages posted in the last ACTIVITY_DAYS count towards a candidate's
+# score, log-scaled: with a weight of 0.5, a candidate who posted seven
+# times outranks one with one more mutual who hasn't posted at all.
+ACTIVITY_DAYS = 30
+ACTIVITY_WEIGHT = 0.5
+
+# Users whose recommendations are written per transaction.
+REFRESH_BATCH = 500
+
+recommendations = Recommendation.__table__
+stale = StaleRecommendations.__table__
+
+# Recomputes the recommendations of the users in :user_ids. Deleted users
+# aren't recommended, nor are users that are already followed.
+SCORE_CANDIDATES = text("""
+    WITH pairs AS (
+        SELECT friends.user_following_id AS user_id,
+               fof.user_being_followed_id AS candidate_id,
+               count(*) AS mutuals
+        FROM follows AS friends
+        JOIN follows AS fof
+          ON fof.user_following_id = friends.user_being_followed_id
+        WHERE friends.user_following_id = ANY(:user_ids)
+          AND fof.user_being_followed_id <> friends.user_following_id
+        GROUP BY friends.user_following_id, fof.user_being_followed_id
+    ), fresh AS (
+        SELECT pairs.*
+        FROM pairs
+        JOIN users ON users.id = pairs.candidate_id
+        WHERE users.deleted_at IS NULL
+          AND NOT EXISTS (SELECT 1 FROM follows
+                          WHERE user_following_id = pairs.user_id
+                            AND user_being_followed_id = pairs.candidate_id)
+    ), activity AS (
+        SELECT candidate_id,
+               (SELECT count(*) FROM messages
+                WHERE messages.user_id = candidate_id
+                  AND messages.timestamp >= :since) AS posted
+        FROM (SELECT DISTINCT candidate_id FROM fresh) AS candidates
+    ), ranked AS (
+        SELECT user_id, candidate_id, mutuals,
+               mutuals + :weight * ln(1 + posted) AS score,
+               row_number() OVER (
+                   PARTITION BY user_id
+                   ORDER BY mutuals + :weight * ln(1 + posted) DESC,
+                            mutuals DESC, candidate_id DESC) AS rank
+        FROM fresh
+        JOIN activity USING (candidate_id)
+    )
+    INSERT INTO recommendations (user_id, candidate_id, score, mutuals)
+    SELECT user_id, candidate_id, score, mutuals
+    FROM ranked
+    WHERE rank <= :top_k
+""")
+
+
+def mark_stale(follower_id):
+    """Queue `follower_id`, whose follows have changed. The caller commits.
+
+    Their followers' candidates change too; they are found at refresh time.
+    """
+
+    db.session.execute(insert(stale)
+                       .values(user_id=follower_id)
+                       .on_conflict_do_nothing())
+
+
+def claim_stale(everyone=False):
+    """Empty the queue of stale users, returning their ids.
+
+    With `everyone`, returns the ids of every (undeleted) user instead.
+    Commits, so that users queued from now on stay queued.
+    """
+
+    user_ids = [user_id for user_id, in db.session.execute(
+        stale.delete().returning(stale.c.user_id))]
+
+    if everyone:
+        live = db.session.query(User.id).filter(User.deleted_at.is_(None))
+        user_ids = [user_id for user_id, in live]
+
+    db.session.commit()
+    return sorted(user_ids)
+
+
+def with_followers(user_ids):
+    """`user_ids` and everyone following any of them, sorted.
+
+    Deleted users are left out.
+    """
+
+    followers = (db.session
+                 .query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id.in_(user_ids)))
+
+    return [user_id for user_id, in (db.session
+                                     .query(User.id)
+                                     .filter(User.id.in_(user_ids) |
+                                             User.id.in_(followers))
+                                     .filter(User.deleted_at.is_(None))
+                                     .order_by(User.id))]
+
+
+def refresh_recommendations(everyone=False, batch_size=REFRESH_BATCH):
+    """Recompute the recommendations of the stale users (or `everyone`).
+
+    The users queued are refreshed along with their followers. Commits
+    every `batch_size` users. Returns how many were refreshed.
+    """
+
+    user_ids = claim_stale(everyone)
+
+    if user_ids and not everyone:
+        user_ids = with_followers(user_ids)
+
+    since = datetime.utcnow() - timedelta(days=ACTIVITY_DAYS)
+
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+
+        db.session.execute(recommendations.delete()
+                           .where(recommendations.c.user_id.in_(batch)))
+        db.session.execute(SCORE_CANDIDATES, {
+            'user_ids': batch, 'since': since, 'weight': ACTIVITY_WEIGHT,
+            'top_k': TOP_K})
+        db.session.commit()
+
+    return len(user_ids)
+
+
+def recommended_users(user_id, limit=SHOWN):
+    """Up to `limit` users recommended to `user_id`, best first.
+
+    Returns (user, mutuals) pairs. Users deleted, or followed, since the
+    recommendations were computed are left out.
+    """
+
+    rows = (db.session
+            .query(User, Recommendation.mutuals)
+            .join(Recommendation, Recommendation.candidate_id == User.id)
+            .filter(Recommendation.user_id == user_id)
+            .filter(User.deleted_at.is_(None))
+            .options(load_only(*CARD_COLUMNS))
+            .order_by(Recommendation.score.desc(), User.id)
+            .limit(TOP_K)
+            .all())
+
+    followed = follow_graph.following_among(user_id,
+                                            [user.id for user, _ in rows])
+
+    return [(user, mutuals) for user, mutuals in rows
+            if user.id not in followed][:limit]
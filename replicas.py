@@ -0,0 +1,97 @@
+"""Sending read-only requests to read replicas.
+
+Replica URIs from SQLALCHEMY_REPLICA_URIS become extra binds, and each GET
+or HEAD request picks one of them for its session's reads. Everything else
+stays on the primary: other requests, flushes and Core INSERT / UPDATE /
+DELETE statements, and any work outside a request (CLI commands, tests).
+
+Replicas lag the primary slightly, so after a user makes a request that
+may write, their requests are pinned to the primary for
+PRIMARY_PIN_SECONDS. That way they always see their own new warble or
+follow, while everyone else's reads stay on the replicas.
+"""
+
+import random
+from time import time
+
+from flask import request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND_PREFIX = 'replica_'
+
+# Key in the SQLAlchemy session's info of the replica engine to read from.
+REPLICA_KEY = 'replica'
+
+# Key in the Flask session of when the user's pin to the primary expires.
+PIN_KEY = 'primary_until'
+
+DEFAULT_PIN_SECONDS = 10
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from its request's replica, if it was given one."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get(REPLICA_KEY)
+
+        if (replica is None or self._flushing or
+                isinstance(clause, UpdateBase)):
+            return super().get_bind(mapper, clause)
+
+        return replica
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose sessions are RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_binds(app):
+    """The bind keys of `app`'s replicas."""
+
+    binds = app.config.get('SQLALCHEMY_BINDS') or {}
+    return [key for key in binds if key.startswith(REPLICA_BIND_PREFIX)]
+
+
+def init_replicas(app, db):
+    """Route `app`'s read-only requests to its replicas.
+
+    Call this after `connect_db`, and before registering `before_request`
+    hooks that query, so that they read from the replica too.
+    """
+
+    binds = app.config.get('SQLALCHEMY_BINDS') or {}
+
+    for i, uri in enumerate(app.config.get('SQLALCHEMY_REPLICA_URIS') or ()):
+        binds[f'{REPLICA_BIND_PREFIX}{i}'] = uri
+
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+    @app.before_request
+    def choose_replica():
+        keys = replica_binds(app)
+
+        if (keys and request.method in READ_METHODS and
+                session.get(PIN_KEY, 0) <= time()):
+            db.session.info[REPLICA_KEY] = db.get_engine(
+                app, bind=random.choice(keys))
+
+    @app.after_request
+    def pin_writers_to_primary(response):
+        if (replica_binds(app) and request.method not in READ_METHODS and
+                response.status_code < 400):
+            seconds = app.config.get('PRIMARY_PIN_SECONDS',
+                                     DEFAULT_PIN_SECONDS)
+            session[PIN_KEY] = time() + seconds
+
+        return response
+
+    @app.teardown_request
+    def forget_replica(exc):
+        db.session.info.pop(REPLICA_KEY, None)
@@ -1,20 +1,247 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+    python seed.py [--data-dir generator] [--batch-size 50000]
+                   [--method auto|copy|insert]
+
+On PostgreSQL, CSVs are streamed into their tables with COPY FROM STDIN,
+`--batch-size` rows at a time. Secondary indexes are dropped for the load
+and recreated afterwards (building an index once is much cheaper than
+updating it row by row), triggers are disabled (so that the follows loaded
+aren't written to the follow change feed too), and id sequences are moved
+past the loaded ids.
+Other databases (such as SQLite, in tests) fall back to batched INSERTs.
+
+likes.csv is loaded too, if the data directory has one. Timelines and
+counters are rebuilt from the loaded data at the end.
+"""
+
+import argparse
+import csv
+import io
+import os
+from datetime import datetime
+from time import perf_counter
+
+from sqlalchemy import DateTime, Integer, text
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from models import User, Message, Follows, Likes
+from timelines import rebuild_timelines
+from counters import reconcile_counters
+
+# Tables to load, in dependency order, and the CSV file each is loaded from.
+SOURCES = [
+    (User.__table__, 'users.csv'),
+    (Message.__table__, 'messages.csv'),
+    (Follows.__table__, 'follows.csv'),
+    (Likes.__table__, 'likes.csv'),
+]
+
+DEFAULT_BATCH_SIZE = 50000
+
+
+def read_batches(path, batch_size):
+    """Read a CSV file as its header and an iterator of batches of rows."""
+
+    f = open(path, newline='')
+    reader = csv.reader(f)
+    header = next(reader)
+
+    def batches():
+        with f:
+            batch = []
+
+            for row in reader:
+                batch.append(row)
+
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+
+            if batch:
+                yield batch
+
+    return header, batches()
+
+
+def copy_batches(conn, table, header, batches):
+    """Load batches of CSV rows into `table` with COPY; return the row count."""
+
+    cursor = conn.connection.cursor()
+    statement = (f"COPY {table.name} ({', '.join(header)}) "
+                 f"FROM STDIN WITH (FORMAT csv)")
+    count = 0
+
+    for batch in batches:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+
+        cursor.copy_expert(statement, buffer)
+        count += len(batch)
+
+    return count
+
+
+def coerce(table, header):
+    """Function converting a CSV row's strings to `table`'s column types."""
+
+    converters = []
+
+    for name in header:
+        column_type = table.c[name].type
+
+        if isinstance(column_type, DateTime):
+            converters.append(datetime.fromisoformat)
+        elif isinstance(column_type, Integer):
+            converters.append(int)
+        else:
+            converters.append(str)
+
+    def convert(row):
+        return {name: to_type(value) if value != '' else None
+                for name, to_type, value in zip(header, converters, row)}
+
+    return convert
+
+
+def insert_batches(conn, table, header, batches):
+    """Load batches of CSV rows into `table` with executemany INSERTs."""
+
+    convert = coerce(table, header)
+    count = 0
+
+    for batch in batches:
+        conn.execute(table.insert(), [convert(row) for row in batch])
+        count += len(batch)
+
+    return count
+
+
+def drop_indexes(conn, table):
+    """Drop `table`'s indexes that don't back a constraint.
+
+    Returns the statements to recreate them.
+    """
+
+    indexes = conn.execute(text("""
+        SELECT indexname, indexdef
+        FROM pg_indexes i
+        WHERE schemaname = current_schema()
+          AND tablename = :table
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                          WHERE c.conname = i.indexname)
+    """), table=table.name).fetchall()
+
+    for name, _ in indexes:
+        conn.execute(text(f'DROP INDEX "{name}"'))
+
+    return [definition for _, definition in indexes]
+
+
+def fix_sequence(conn, table):
+    """Move `table`'s id sequence past the highest loaded id."""
+
+    if 'id' not in table.c:
+        return
+
+    conn.execute(text(f"""
+        SELECT setval(pg_get_serial_sequence('{table.name}', 'id'),
+                      COALESCE(MAX(id), 0) + 1,
+                      false)
+        FROM {table.name}
+    """))
+
+
+def load(conn, data_dir, batch_size=DEFAULT_BATCH_SIZE, method='auto'):
+    """Load every CSV in `data_dir` into its table over `conn`.
+
+    `method` is 'copy' (PostgreSQL only), 'insert', or 'auto' to pick by
+    database. Returns a list of (table name, rows, seconds).
+    """
+
+    if method == 'auto':
+        method = 'copy' if conn.dialect.name == 'postgresql' else 'insert'
+
+    postgres = conn.dialect.name == 'postgresql'
+    load_batches = copy_batches if method == 'copy' else insert_batches
+    results = []
+
+    for table, filename in SOURCES:
+        path = os.path.join(data_dir, filename)
+
+        if not os.path.exists(path):
+            continue
+
+        start = perf_counter()
+        header, batches = read_batches(path, batch_size)
+        indexes = drop_indexes(conn, table) if postgres else []
+
+        if postgres:
+            conn.execute(text(f"ALTER TABLE {table.name} DISABLE TRIGGER USER"))
+
+        count = load_batches(conn, table, header, batches)
+
+        for definition in indexes:
+            conn.execute(text(definition))
+
+        if postgres:
+            conn.execute(text(f"ALTER TABLE {table.name} ENABLE TRIGGER USER"))
+
+        if postgres:
+            fix_sequence(conn, table)
+            conn.execute(text(f"ANALYZE {table.name}"))
+
+        results.append((table.name, count, perf_counter() - start))
+
+    return results
+
+
+def report(name, rows, seconds):
+    rate = rows / seconds if seconds else 0
+    print(f"{name:>10}: {rows:>10,} rows in {seconds:7.2f}s "
+          f"({rate:,.0f} rows/s)")
+
+
+def seed(data_dir, batch_size=DEFAULT_BATCH_SIZE, method='auto'):
+    """Recreate the database from the CSVs in `data_dir`.
+
+    Returns a list of (table name, rows, seconds), timelines included.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+    with db.engine.begin() as conn:
+        results = load(conn, data_dir, batch_size, method)
+
+    start = perf_counter()
+    timeline_rows = rebuild_timelines()
+    reconcile_counters()
+    db.session.commit()
+
+    return results + [('timelines', timeline_rows, perf_counter() - start)]
+
 
+def main():
+    parser = argparse.ArgumentParser(description="Seed the Warbler database.")
+    parser.add_argument('--data-dir', default='generator',
+                        help="directory of users.csv, messages.csv, ...")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="rows sent to the database at a time")
+    parser.add_argument('--method', choices=('auto', 'copy', 'insert'),
+                        default='auto')
+    args = parser.parse_args()
 
-db.drop_all()
-db.create_all()
+    results = seed(args.data_dir, args.batch_size, args.method)
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    for name, rows, seconds in results:
+        report(name, rows, seconds)
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    report('total',
+           sum(rows for _, rows, _ in results),
+           sum(seconds for _, _, seconds in results))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+if __name__ == '__main__':
+    main()
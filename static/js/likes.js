@@ -0,0 +1,21 @@
+// Toggle likes in place, rather than posting the form and reloading the
+// page. If the request fails, fall back to posting the form.
+$(document).on('submit', '.like-form', function (evt) {
+  evt.preventDefault();
+  const form = this;
+
+  $.ajax({
+    url: form.action,
+    method: 'POST',
+    dataType: 'json',
+    headers: {Accept: 'application/json'},
+  })
+    .done(function (data) {
+      $(form).find('button')
+        .toggleClass('btn-primary', data.liked)
+        .toggleClass('btn-secondary', !data.liked);
+    })
+    .fail(function () {
+      form.submit();
+    });
+});
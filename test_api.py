@@ -0,0 +1,189 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from timelines import rebuild_timelines
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def ndjson(resp):
+    """The lines of an NDJSON response, decoded."""
+
+    return [json.loads(line) for line in resp.data.decode().splitlines()]
+
+
+class APITestCase(TestCase):
+    """Test the streaming NDJSON API."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=f"user{i}",
+                             email=f"user{i}@test.com",
+                             password="password",
+                             image_url=None)
+                 for i in range(4)]
+        db.session.commit()
+
+        author, reader = users[0], users[1]
+        reader.following.append(author)
+        for follower in users[2:]:
+            follower.following.append(reader)
+
+        start = datetime(2020, 1, 1)
+        msgs = [Message(text=f"warble {i}", user_id=author.id,
+                        timestamp=start + timedelta(minutes=i))
+                for i in range(5)]
+        db.session.add_all(msgs)
+        db.session.flush()
+
+        db.session.add(Likes(user_id=reader.id, message_id=msgs[0].id))
+        rebuild_timelines()
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+        self.follower_ids = sorted(u.id for u in users[2:])
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_user_messages(self):
+        """Are a user's messages streamed newest first?"""
+
+        resp = self.client.get(f"/api/v1/users/{self.author_id}/messages")
+
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = ndjson(resp)
+        self.assertEqual([m['text'] for m in lines],
+                         [f"warble {i}" for i in range(4, -1, -1)])
+        self.assertEqual(lines[0]['user']['username'], "user0")
+
+    def test_cursor(self):
+        """Does a limited stream end with a cursor for the rest?"""
+
+        url = f"/api/v1/users/{self.author_id}/messages"
+        lines = ndjson(self.client.get(url, query_string={'limit': 3}))
+
+        self.assertEqual(len(lines), 4)
+        self.assertIn('next', lines[-1])
+
+        rest = ndjson(self.client.get(
+            url, query_string={'limit': 3, 'before': lines[-1]['next']}))
+        self.assertEqual([m['text'] for m in rest], ["warble 1", "warble 0"])
+
+    def test_bad_limit(self):
+        """Is an out-of-range limit a 400?"""
+
+        resp = self.client.get(f"/api/v1/users/{self.author_id}/messages",
+                               query_string={'limit': 0})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_timeline(self):
+        """Is the logged-in user's timeline streamed, and 401 otherwise?"""
+
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            lines = ndjson(c.get("/api/v1/timeline"))
+
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[0]['text'], "warble 4")
+
+    def test_likes(self):
+        """Are a user's liked messages streamed?"""
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            lines = ndjson(c.get(f"/api/v1/users/{self.reader_id}/likes"))
+
+        self.assertEqual([m['text'] for m in lines], ["warble 0"])
+
+    def test_followers_and_following(self):
+        """Are followers / following streamed by id, with cursors?"""
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+
+            lines = ndjson(c.get(f"/api/v1/users/{self.reader_id}/followers",
+                                 query_string={'limit': 1}))
+            self.assertEqual(lines[0]['id'], self.follower_ids[0])
+            self.assertEqual(set(lines[0]), {'id', 'username', 'image_url',
+                                             'header_image_url', 'bio'})
+
+            rest = ndjson(c.get(f"/api/v1/users/{self.reader_id}/followers",
+                                query_string={'after': lines[1]['next']}))
+            self.assertEqual([u['id'] for u in rest], self.follower_ids[1:])
+
+            lines = ndjson(c.get(f"/api/v1/users/{self.reader_id}/following"))
+            self.assertEqual([u['id'] for u in lines], [self.author_id])
+
+    def test_bulk_follow(self):
+        """Can many users be followed and unfollowed in one request?"""
+
+        resp = self.client.post("/api/v1/follows",
+                                json={'user_ids': self.follower_ids})
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as c:
+            self.login(c, self.author_id)
+
+            resp = c.post("/api/v1/follows",
+                          json={'user_ids': self.follower_ids
+                                            + [self.author_id, 0]})
+            self.assertEqual(resp.json, {'followed': self.follower_ids})
+
+            resp = c.post("/api/v1/follows",
+                          json={'user_ids': self.follower_ids})
+            self.assertEqual(resp.json, {'followed': []})
+
+            author = User.query.get(self.author_id)
+            self.assertEqual(author.following_count, 2)
+            self.assertEqual(User.query.get(self.follower_ids[0])
+                             .followers_count, 1)
+
+            resp = c.delete("/api/v1/follows",
+                            json={'user_ids': [self.follower_ids[0],
+                                               self.reader_id]})
+            self.assertEqual(resp.json, {'unfollowed': [self.follower_ids[0]]})
+
+            lines = ndjson(c.get(f"/api/v1/users/{self.author_id}/following"))
+            self.assertEqual([u['id'] for u in lines], self.follower_ids[1:])
+
+    def test_bulk_follow_validation(self):
+        """Are malformed or oversized bulk follows a 400?"""
+
+        with self.client as c:
+            self.login(c, self.author_id)
+
+            for body in ({}, {'user_ids': "1,2"}, {'user_ids': ["1"]},
+                         {'user_ids': list(range(1001))}):
+                resp = c.post("/api/v1/follows", json=body)
+                self.assertEqual(resp.status_code, 400, body)
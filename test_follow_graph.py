@@ -0,0 +1,184 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import follow_graph as follow_graph_module
+from follow_graph import Adjacency, follow_edges, follow_graph
+
+db.create_all()
+
+
+class AdjacencyTestCase(TestCase):
+    """Test the packed adjacency lists."""
+
+    def test_adjacency(self):
+        """Are membership and degree answered from the packed arrays?"""
+
+        adjacency = Adjacency([(1, 2), (1, 5), (3, 1), (3, 2), (3, 9)])
+
+        self.assertTrue(adjacency.has(1, 5))
+        self.assertTrue(adjacency.has(3, 9))
+        self.assertFalse(adjacency.has(1, 3))
+        self.assertFalse(adjacency.has(2, 1))
+        self.assertFalse(adjacency.has(100, 1))
+
+        self.assertEqual(adjacency.degree(3), 3)
+        self.assertEqual(adjacency.degree(2), 0)
+        self.assertEqual(list(adjacency.neighbours(1)), [2, 5])
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the follow graph index against the database."""
+
+    def setUp(self):
+        """Create sample users."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.u1 = User(email="one@test.com", username="one", password="x")
+        self.u2 = User(email="two@test.com", username="two", password="x")
+        self.u3 = User(email="three@test.com", username="three", password="x")
+
+        db.session.add_all([self.u1, self.u2, self.u3])
+        db.session.commit()
+
+        self.ids = (self.u1.id, self.u2.id, self.u3.id)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_load_from_database(self):
+        """Is the graph loaded from the follows table?"""
+
+        one, two, three = self.ids
+        db.session.add_all([Follows(user_following_id=one,
+                                    user_being_followed_id=two),
+                            Follows(user_following_id=three,
+                                    user_being_followed_id=two)])
+        db.session.commit()
+
+        self.assertTrue(follow_graph.is_following(one, two))
+        self.assertFalse(follow_graph.is_following(two, one))
+        self.assertEqual(follow_graph.followers_count(two), 2)
+        self.assertEqual(follow_graph.follower_ids(two), [one, three])
+        self.assertEqual(follow_graph.following_among(one, self.ids), {two})
+
+    def test_incremental_updates(self):
+        """Are committed follows and unfollows applied without reloading?"""
+
+        one, two, three = self.ids
+        follow_graph.rebuild()
+        index = follow_graph._following
+
+        self.u1.following.append(self.u2)
+        db.session.commit()
+
+        self.assertTrue(follow_graph.is_following(one, two))
+        self.assertEqual(follow_graph.following_count(one), 1)
+
+        self.u1.following.remove(self.u2)
+        db.session.commit()
+
+        self.assertFalse(follow_graph.is_following(one, two))
+        self.assertEqual(follow_graph.following_count(one), 0)
+
+        db.session.add(Follows(user_following_id=three,
+                               user_being_followed_id=one))
+        db.session.commit()
+
+        self.assertEqual(follow_graph.followers_among(one, self.ids), {three})
+        self.assertIs(follow_graph._following, index)
+
+    def test_rollback_discards_changes(self):
+        """Are follows that are rolled back left out of the index?"""
+
+        one, two, three = self.ids
+        follow_graph.rebuild()
+
+        db.session.execute(Follows.__table__.insert(), {
+            'user_following_id': one, 'user_being_followed_id': three})
+        db.session.rollback()
+        follow_graph.sync()
+
+        self.assertFalse(follow_graph.is_following(one, three))
+
+    def follow_elsewhere(self, follower_id, followed_id):
+        """Follow on a connection of its own, as another process would."""
+
+        with db.engine.begin() as conn:
+            conn.execute(Follows.__table__.insert(), {
+                'user_following_id': follower_id,
+                'user_being_followed_id': followed_id})
+
+    def test_changes_from_other_processes(self):
+        """Are follows made by other processes picked up from the feed?"""
+
+        one, two, three = self.ids
+        follow_graph.rebuild()
+
+        self.follow_elsewhere(two, three)
+        follow_graph.sync()
+        self.assertTrue(follow_graph.is_following(two, three))
+        self.assertEqual(follow_graph.follower_ids(three), [two])
+
+        # Applying the feed again changes nothing.
+        follow_graph.sync()
+        self.assertEqual(follow_graph.followers_count(three), 1)
+
+        with db.engine.begin() as conn:
+            conn.execute(Follows.__table__.delete())
+
+        follow_graph.sync()
+        self.assertFalse(follow_graph.is_following(two, three))
+
+    def test_rebuild_keeps_changes_made_meanwhile(self):
+        """Are follows applied during a reload kept once it's swapped in?"""
+
+        one, two, three = self.ids
+        follow_graph.rebuild()
+
+        def edges_then_follow():
+            edges = follow_edges()
+            self.follow_elsewhere(three, one)
+            follow_graph.sync()
+
+            # The old index keeps answering meanwhile.
+            self.assertTrue(follow_graph.is_following(three, one))
+            return edges
+
+        with patch.object(follow_graph_module, 'follow_edges',
+                          edges_then_follow):
+            follow_graph.rebuild()
+
+        self.assertTrue(follow_graph.is_following(three, one))
+        self.assertEqual(follow_graph.following_ids(three), [one])
+
+    def test_model_methods(self):
+        """Do is_following / is_followed_by use the index?"""
+
+        one, two, three = self.ids
+        db.session.add(Follows(user_following_id=one,
+                               user_being_followed_id=two))
+        db.session.commit()
+
+        u1 = User.query.get(one)
+        u2 = User.query.get(two)
+
+        self.assertTrue(u1.is_following(u2))
+        self.assertTrue(u2.is_followed_by(u1))
+        self.assertNotIn('following', u1.__dict__)
+        self.assertNotIn('followers', u2.__dict__)
@@ -0,0 +1,164 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragment_cache.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from fragment_cache import FragmentCache, fragment_cache
+from timelines import fan_out
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test the byte-bounded LRU fragment store."""
+
+    def test_versions(self):
+        """Is a fragment only returned at the version it was cached at?"""
+
+        cache = FragmentCache()
+        cache.set(1, 'v1', '<p>one</p>')
+
+        self.assertEqual(cache.get(1, 'v1'), '<p>one</p>')
+        self.assertIsNone(cache.get(1, 'v2'))
+
+        cache.set(1, 'v2', '<p>uno</p>')
+        self.assertEqual(cache.get(1, 'v2'), '<p>uno</p>')
+        self.assertEqual(len(cache), 1)
+
+    def test_byte_bound(self):
+        """Are least recently used fragments evicted to stay under the bound?"""
+
+        cache = FragmentCache(max_bytes=10)
+        cache.set(1, 0, 'aaaa')
+        cache.set(2, 0, 'bbbb')
+        cache.get(1, 0)
+        cache.set(3, 0, 'cccc')
+
+        self.assertEqual(cache.get(1, 0), 'aaaa')
+        self.assertIsNone(cache.get(2, 0))
+        self.assertEqual(cache.bytes, 8)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_stats(self):
+        """Are hits and misses counted?"""
+
+        cache = FragmentCache()
+        cache.get(1, 0)
+        cache.set(1, 0, 'x')
+        cache.get(1, 0)
+        cache.get(1, 0)
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3)
+
+
+class CardCacheViewsTestCase(TestCase):
+    """Test caching message cards in feeds."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        fragment_cache.clear()
+        fragment_cache.reset_stats()
+        self.client = app.test_client()
+
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="password",
+                             image_url=None)
+        viewer = User.signup(username="viewer",
+                             email="viewer@test.com",
+                             password="password",
+                             image_url=None)
+        db.session.commit()
+
+        viewer.following.append(author)
+        msg = Message(text="Cached warble", user_id=author.id)
+        db.session.add(msg)
+        db.session.flush()
+        fan_out(msg)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.viewer_id = viewer.id
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_cards_are_reused(self):
+        """Is a card rendered once and then served from the cache?"""
+
+        with self.client as c:
+            self.login(c, self.viewer_id)
+
+            c.get("/")
+            self.assertEqual(fragment_cache.stats()['misses'], 1)
+
+            resp = c.get(f"/users/{self.author_id}")
+            self.assertEqual(fragment_cache.stats()['hits'], 1)
+            self.assertIn("Cached warble", str(resp.data))
+
+    def test_like_state_is_per_viewer(self):
+        """Does the cached card still show each viewer's own like state?"""
+
+        db.session.add(Likes(user_id=self.viewer_id, message_id=self.msg_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.viewer_id)
+            resp = c.get(f"/users/{self.author_id}")
+            self.assertIn("btn-primary", str(resp.data))
+
+            self.login(c, self.author_id)
+            resp = c.get("/")
+            self.assertNotIn("btn-primary", str(resp.data))
+            self.assertIn("Cached warble", str(resp.data))
+
+        self.assertEqual(fragment_cache.stats()['hits'], 1)
+
+    def test_profile_edit_invalidates(self):
+        """Does editing the author's profile re-render their cards?"""
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.get("/")
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "author@test.com",
+                                           "password": "password"})
+
+            resp = c.get("/")
+            self.assertIn("@renamed", str(resp.data))
+            self.assertEqual(fragment_cache.stats()['hits'], 0)
+
+    def test_delete_invalidates(self):
+        """Is a deleted message's card dropped?"""
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.get("/")
+            self.assertEqual(len(fragment_cache), 1)
+
+            c.post(f"/messages/{self.msg_id}/delete")
+            self.assertEqual(len(fragment_cache), 0)
@@ -0,0 +1,109 @@
+"""CSV generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import csv
+import os
+import subprocess
+import sys
+from collections import Counter
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+USERS = 500
+FOLLOWS = 10000
+
+
+def generate(out_dir, processes=1, alpha=1.1):
+    """Run the generator into `out_dir`, small and in many chunks."""
+
+    subprocess.run(
+        [sys.executable, GENERATOR, '--users', str(USERS),
+         '--messages', '50', '--follows', str(FOLLOWS), '--likes', '200',
+         '--chunk-size', '64', '--alpha', str(alpha),
+         '--processes', str(processes), '--out-dir', out_dir],
+        check=True, capture_output=True)
+
+
+def read_follows(out_dir):
+    with open(os.path.join(out_dir, 'follows.csv'), newline='') as f:
+        return [(int(row['user_following_id']),
+                 int(row['user_being_followed_id']))
+                for row in csv.DictReader(f)]
+
+
+def top_share(follows, fraction):
+    """Share of all follows going to the most followed `fraction` of users."""
+
+    in_degree = sorted(Counter(followed for _, followed in follows).values(),
+                       reverse=True)
+    return sum(in_degree[:int(USERS * fraction)]) / len(follows)
+
+
+def expected_top_share(alpha, fraction):
+    """The same share, for ranks drawn from the generator's power law."""
+
+    e = 1 - alpha
+    k = int(USERS * fraction)
+    return ((k + 1) ** e - 1) / ((USERS + 1) ** e - 1)
+
+
+class GeneratorTestCase(TestCase):
+    """Test that generated data is reproducible, valid and skewed."""
+
+    def test_same_seed_same_files(self):
+        """Does a seed give the same CSVs however many processes run?"""
+
+        with TemporaryDirectory() as one, TemporaryDirectory() as three:
+            generate(one, processes=1)
+            generate(three, processes=3)
+
+            for filename in ('users.csv', 'messages.csv', 'follows.csv',
+                             'likes.csv'):
+                with self.subTest(filename=filename):
+                    with open(os.path.join(one, filename), 'rb') as a, \
+                            open(os.path.join(three, filename), 'rb') as b:
+                        self.assertEqual(a.read(), b.read())
+
+    def test_follows_valid(self):
+        """Are there no self-follows or repeated follows?"""
+
+        for alpha in (1.1, 2):
+            with self.subTest(alpha=alpha), TemporaryDirectory() as out:
+                generate(out, alpha=alpha)
+                follows = read_follows(out)
+
+                self.assertEqual(len(follows), FOLLOWS)
+                self.assertEqual(len(set(follows)), len(follows))
+                self.assertFalse([pair for pair in follows
+                                  if pair[0] == pair[1]])
+                self.assertTrue(all(1 <= id <= USERS
+                                    for pair in follows for id in pair))
+
+    def test_follows_skewed(self):
+        """Does the followers' in-degree have the requested skew?"""
+
+        shares = {}
+
+        for alpha in (0, 1.1, 2):
+            with TemporaryDirectory() as out:
+                generate(out, alpha=alpha)
+                shares[alpha] = top_share(read_follows(out), 0.1)
+
+        # With no skew, the top tenth of users get about a tenth of the
+        # follows; with more, they get about what the power law predicts
+        # (a little less, as nobody can be followed twice by one user).
+        self.assertLess(shares[0], 0.2)
+
+        for alpha in (1.1, 2):
+            self.assertAlmostEqual(shares[alpha],
+                                   expected_top_share(alpha, 0.1), delta=0.15)
+
+        self.assertLess(shares[0], shares[1.1])
+        self.assertLess(shares[1.1], shares[2])
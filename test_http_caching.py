@@ -0,0 +1,151 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_caching.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HTTPCachingTestCase(TestCase):
+    """Test cache headers, ETags and 304s."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="password",
+                             image_url=None)
+        viewer = User.signup(username="viewer",
+                             email="viewer@test.com",
+                             password="password",
+                             image_url=None)
+        msg = Message(text="Hello", user=author)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.viewer_id = viewer.id
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_anonymous_pages_are_public(self):
+        """Can shared caches keep pages for logged-out visitors?"""
+
+        for path, max_age in (("/", 300), (f"/users/{self.author_id}", 60),
+                              (f"/messages/{self.msg_id}", 300)):
+            resp = self.client.get(path)
+            self.assertEqual(resp.headers['Cache-Control'],
+                             f'public, max-age={max_age}')
+            self.assertIn('Cookie', resp.vary)
+
+    def test_user_pages_are_private(self):
+        """Are logged-in pages kept out of shared caches?"""
+
+        with self.client as c:
+            self.login(c, self.viewer_id)
+
+            resp = c.get("/")
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+            resp = c.post(f"/users/follow/{self.author_id}")
+            self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+    def test_static_files(self):
+        """Are fingerprinted static files cached for a long time?"""
+
+        resp = self.client.get("/")
+        html = str(resp.data)
+        self.assertIn("/static/stylesheets/style.css?v=", html)
+
+        start = html.index("/static/stylesheets/style.css?v=")
+        url = html[start:html.index('"', start)]
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        resp.close()
+
+        # Files linked without a fingerprint may change under the same URL.
+        for url in ("/static/stylesheets/style.css",
+                    "/static/images/default-pic.png"):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('max-age=3600', resp.headers['Cache-Control'])
+            resp.close()
+
+    def test_message_not_modified(self):
+        """Is a 304 returned until the viewer's view of the message changes?"""
+
+        url = f"/messages/{self.msg_id}"
+
+        with self.client as c:
+            self.login(c, self.viewer_id)
+
+            etag = c.get(url).headers['ETag']
+            resp = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            c.post(f"/users/add_like/{self.msg_id}")
+
+            resp = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_profile_not_modified(self):
+        """Does a new message change the profile's ETag?"""
+
+        url = f"/users/{self.author_id}"
+        etag = self.client.get(url).headers['ETag']
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "Another"})
+
+        self.client = app.test_client()
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_no_304_with_flashes(self):
+        """Are pending flashed messages shown rather than a 304?"""
+
+        url = f"/messages/{self.msg_id}"
+
+        with self.client as c:
+            etag = c.get(url).headers['ETag']
+
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('success', 'Flashed!')]
+
+            resp = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Flashed!", str(resp.data))
+            self.assertEqual(resp.headers['Cache-Control'], 'no-store')
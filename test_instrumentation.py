@@ -0,0 +1,146 @@
+"""Request timing and metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import os
+import re
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from instrumentation import Histogram, metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def timings(resp):
+    """The Server-Timing header of `resp`, as {name: (ms, desc)}."""
+
+    result = {}
+
+    for part in resp.headers['Server-Timing'].split(', '):
+        match = re.match(r'(\w+);dur=([\d.]+)(?:;desc="(.*)")?$', part)
+        result[match[1]] = (float(match[2]), match[3])
+
+    return result
+
+
+class InstrumentationTestCase(TestCase):
+    """Test Server-Timing headers and the /metrics endpoint."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="password",
+                           image_url=None)
+        db.session.commit()
+
+        self.user_id = user.id
+        metrics.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_server_timing(self):
+        """Does a page's Server-Timing break down its time?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get(f"/users/{self.user_id}")
+
+        parts = timings(resp)
+
+        self.assertGreater(parts['db'][0], 0)
+        self.assertRegex(parts['db'][1], r'^\d+ queries$')
+        self.assertIn('render', parts)
+        self.assertGreaterEqual(parts['total'][0], parts['render'][0])
+
+    def test_bcrypt_timing(self):
+        """Is password hashing timed on login?"""
+
+        resp = self.client.post("/login", data={"username": "testuser",
+                                                "password": "password"})
+
+        self.assertIn('bcrypt', timings(resp))
+
+    def test_metrics(self):
+        """Are requests recorded in per-route histograms?"""
+
+        self.client.get(f"/users/{self.user_id}")
+        self.client.get(f"/users/{self.user_id}")
+
+        resp = self.client.get("/metrics")
+        text = resp.data.decode()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        self.assertIn("# TYPE warbler_request_duration_seconds histogram", text)
+        self.assertIn(
+            'warbler_request_duration_seconds_count{route="users_show"} 2',
+            text)
+        self.assertIn(
+            'warbler_request_queries_bucket{route="users_show",le="+Inf"} 2',
+            text)
+
+    def test_metrics_token(self):
+        """Does /metrics require the token, when one is configured?"""
+
+        app.config['METRICS_TOKEN'] = "sesame"
+
+        try:
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+
+            resp = self.client.get(
+                "/metrics", headers={'Authorization': "Bearer sesame"})
+            self.assertEqual(resp.status_code, 200)
+
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
+    def test_metrics_loopback_only(self):
+        """Is /metrics refused to other machines when there's no token?"""
+
+        resp = self.client.get("/metrics",
+                               environ_base={'REMOTE_ADDR': '203.0.113.5'})
+        self.assertEqual(resp.status_code, 403)
+
+        resp = self.client.get("/metrics",
+                               environ_base={'REMOTE_ADDR': '::1'})
+        self.assertEqual(resp.status_code, 200)
+
+
+class HistogramTestCase(TestCase):
+    """Test the Prometheus histogram."""
+
+    def test_cumulative_buckets(self):
+        """Are buckets cumulative, with a sum and count?"""
+
+        histogram = Histogram('h', "Test.", (1, 5))
+
+        for value in (0.5, 3, 3, 10):
+            histogram.observe('r', value)
+
+        self.assertEqual(histogram.render()[2:], [
+            'h_bucket{route="r",le="1"} 1',
+            'h_bucket{route="r",le="5"} 3',
+            'h_bucket{route="r",le="+Inf"} 4',
+            'h_sum{route="r"} 16.5',
+            'h_count{route="r"} 4',
+        ])
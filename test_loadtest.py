@@ -0,0 +1,66 @@
+"""Load test harness tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loadtest.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from loadtest import MIX, percentile, run
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LoadTestTestCase(TestCase):
+    """Test replaying a request mix."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None)
+        db.session.commit()
+
+        db.session.add(Message(text="Hello", user_id=user.id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_percentile(self):
+        """Are percentiles taken by nearest rank?"""
+
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_run(self):
+        """Does a run report every request, by kind?"""
+
+        report = run(MIX, requests=30, concurrency=3, seed=1)
+
+        self.assertEqual(report['requests'], 30)
+        self.assertEqual(sum(route['count']
+                             for route in report['routes'].values()), 30)
+
+        for route in report['routes'].values():
+            self.assertLessEqual(route['p50_ms'], route['p99_ms'])
+            self.assertGreater(route['queries_per_request'], 0)
+            self.assertNotIn('500', route['statuses'])
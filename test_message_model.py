@@ -73,3 +73,23 @@ class MessageModelTestCase(TestCase):
         self.assertEqual(l.message_id, 5)
         self.assertEqual(len(m.user.likes), 1)
 
+
+
+    def test_message_timestamps(self):
+        """Is each message stamped with the time it was created?"""
+
+        m1 = Message(text="First", user_id=self.u.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        m2 = Message(text="Second", user_id=self.u.id)
+        db.session.add(m2)
+        db.session.commit()
+
+        self.assertLess(m1.timestamp, m2.timestamp)
+
+        # Rows inserted without the ORM are stamped by the database.
+        db.session.execute(Message.__table__.insert().values(
+            text="Third", user_id=self.u.id))
+        m3 = Message.query.filter_by(text="Third").one()
+        self.assertGreaterEqual(m3.timestamp, m2.timestamp)
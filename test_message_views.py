@@ -8,7 +8,9 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from datetime import datetime
+
+from models import db, connect_db, Message, User, Follows, Timelines
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from message_search import InvertedIndex, search_messages
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -75,6 +78,33 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_add_message_fans_out(self):
+        """Is a new message delivered to the author's and followers' timelines?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        db.session.commit()
+
+        follower_id = follower.id
+        testuser_id = self.testuser.id
+
+        db.session.add(Follows(user_being_followed_id=testuser_id,
+                               user_following_id=follower_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+            msg = Message.query.one()
+            timeline_users = {t.user_id for t in
+                              Timelines.query.filter_by(message_id=msg.id)}
+            self.assertEqual(timeline_users, {testuser_id, follower_id})
+
     def test_add_message_not_logged_in(self):
         """Is unauthorized user prevented from adding messages?"""
 
@@ -130,6 +160,23 @@ class MessageViewTestCase(TestCase):
 
             mess = Message.query.get(3)
             self.assertIsNone(mess)
+            self.assertEqual(Timelines.query.filter_by(message_id=3).count(), 0)
+
+    def test_message_counters(self):
+        """Do posting and deleting a message keep the author's count current?"""
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Count me"})
+            self.assertEqual(User.query.get(testuser_id).messages_count, 1)
+
+            msg_id = Message.query.one().id
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertEqual(User.query.get(testuser_id).messages_count, 0)
 
 
     def test_prevent_delete_message(self):
@@ -178,4 +225,65 @@ class MessageViewTestCase(TestCase):
             self.assertIn("Access unauthorized", str(resp.data))
 
             m = Message.query.get(7)
-            self.assertIsNotNone(m)
\ No newline at end of file
+            self.assertIsNotNone(m)
+
+    def setup_search(self):
+        """Add messages to search, from testuser and from another user."""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.add(other)
+        db.session.commit()
+
+        db.session.add_all([
+            Message(id=61, text="Birds sing in the morning.",
+                    timestamp=datetime(2021, 5, 1), user_id=self.testuser.id),
+            Message(id=62, text="The morning bird catches the worm.",
+                    timestamp=datetime(2021, 6, 1), user_id=other.id),
+            Message(id=63, text="Nothing to see here.",
+                    timestamp=datetime(2021, 7, 1), user_id=other.id),
+        ])
+        db.session.commit()
+
+    def test_search_messages(self):
+        """Does full-text search find matching messages, with filters?"""
+
+        self.setup_search()
+
+        with self.client as c:
+            page = search_messages("morning")
+            self.assertEqual([m.id for m in page], [62, 61])
+
+            page = search_messages("morning", author="testuser")
+            self.assertEqual([m.id for m in page], [61])
+
+            page = search_messages("morning", since="2021-05-15")
+            self.assertEqual([m.id for m in page], [62])
+
+            page = search_messages("morning", until="2021-05-01")
+            self.assertEqual([m.id for m in page], [61])
+
+            page = search_messages("morning", timeline_of=self.testuser.id)
+            self.assertEqual(list(page), [])
+
+            resp = c.get("/messages/search?q=worm")
+            self.assertIn("The morning bird catches the worm.", str(resp.data))
+            self.assertNotIn("Birds sing", str(resp.data))
+
+    def test_inverted_index(self):
+        """Does the in-memory index find messages and track changes?"""
+
+        self.setup_search()
+        index = InvertedIndex()
+
+        ids = Message.query.filter(index.matching("MORNING bird")).all()
+        self.assertEqual([m.id for m in ids], [62])
+
+        index.add(Message(id=64, text="Good morning, the world."))
+        index.remove(62)
+
+        ids = {m.id for m in Message.query.filter(index.matching("morning"))}
+        self.assertEqual(ids, {61})
+
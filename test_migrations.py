@@ -0,0 +1,249 @@
+"""Schema migration and query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import feeds
+from migrations import MIGRATIONS, migrate
+from timelines import rebuild_timelines
+
+db.create_all()
+
+# The schema Warbler started with, before any migration.
+BASELINE_SCHEMA = """
+    CREATE TABLE users (
+        id SERIAL PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL UNIQUE,
+        image_url TEXT,
+        header_image_url TEXT,
+        bio TEXT,
+        location TEXT,
+        password TEXT NOT NULL
+    );
+
+    CREATE TABLE messages (
+        id SERIAL PRIMARY KEY,
+        text VARCHAR(140) NOT NULL,
+        timestamp TIMESTAMP NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE
+    );
+
+    CREATE TABLE follows (
+        user_being_followed_id INTEGER REFERENCES users ON DELETE CASCADE,
+        user_following_id INTEGER REFERENCES users ON DELETE CASCADE,
+        PRIMARY KEY (user_being_followed_id, user_following_id)
+    );
+
+    CREATE TABLE likes (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users ON DELETE CASCADE,
+        message_id INTEGER UNIQUE REFERENCES messages ON DELETE CASCADE
+    );
+
+    INSERT INTO users (id, email, username, password) VALUES
+        (1, 'a@test.com', 'a', 'x'),
+        (2, 'b@test.com', 'b', 'x');
+    INSERT INTO messages (id, text, timestamp, user_id) VALUES
+        (1, 'Hello', '2020-01-01', 1),
+        (2, 'Hi', '2020-01-02', 2);
+    INSERT INTO follows VALUES (1, 2);
+    INSERT INTO likes (user_id, message_id) VALUES (2, 1);
+"""
+
+
+class MigrationTestCase(TestCase):
+    """Test migrating a baseline database to the current schema."""
+
+    def setUp(self):
+        self.conn = db.engine.connect()
+        self.transaction = self.conn.begin()
+        self.conn.execute(text("""
+            CREATE SCHEMA migration_test;
+            SET LOCAL search_path = migration_test, public;
+        """))
+
+    def tearDown(self):
+        self.transaction.rollback()
+        self.conn.close()
+
+    def indexes(self, table):
+        return {name for name, in self.conn.execute(text(
+            "SELECT indexname FROM pg_indexes "
+            "WHERE schemaname = 'migration_test' AND tablename = :table"),
+            table=table)}
+
+    def test_migrate_baseline(self):
+        """Does a baseline database migrate, keeping and deriving its data?"""
+
+        self.conn.execute(text(BASELINE_SCHEMA))
+
+        names = migrate(self.conn)
+        self.assertEqual(names, [name for name, _ in MIGRATIONS])
+
+        self.assertEqual(
+            self.conn.execute(text(
+                "SELECT id, messages_count, following_count, "
+                "followers_count, likes_count FROM users ORDER BY id"))
+            .fetchall(),
+            [(1, 1, 0, 1, 0), (2, 1, 1, 0, 1)])
+
+        self.assertEqual(
+            self.conn.execute(text(
+                "SELECT user_id, message_id FROM timelines "
+                "ORDER BY user_id, message_id")).fetchall(),
+            [(1, 1), (2, 1), (2, 2)])
+
+        # Likes are keyed on (user_id, message_id), so a message can be
+        # liked by more than one user.
+        self.conn.execute(text(
+            "INSERT INTO likes (user_id, message_id) VALUES (1, 1)"))
+        self.assertIn('ix_likes_message_user', self.indexes('likes'))
+
+        # Messages get a timestamp from the database.
+        self.conn.execute(text(
+            "INSERT INTO messages (id, text, user_id) VALUES (3, 'Now', 1)"))
+        self.assertEqual(
+            self.conn.execute(text(
+                "SELECT count(*) FROM messages WHERE timestamp IS NULL"))
+            .scalar(), 0)
+
+        self.assertIn('ix_messages_user_timestamp', self.indexes('messages'))
+        self.assertIn('ix_follows_following_followed',
+                      self.indexes('follows'))
+        self.assertIn('ix_timelines_message', self.indexes('timelines'))
+        self.assertIn('ix_users_tombstoned', self.indexes('users'))
+        self.assertIn('ix_likes_user_liked', self.indexes('likes'))
+
+        # Existing likes are dated no earlier than the message they like.
+        self.assertEqual(
+            self.conn.execute(text(
+                "SELECT liked_at FROM likes WHERE user_id = 2")).scalar(),
+            datetime(2020, 1, 1))
+
+        # Followers are queued to have their recommendations computed.
+        self.assertEqual(
+            self.conn.execute(text(
+                "SELECT user_id FROM stale_recommendations")).fetchall(),
+            [(2,)])
+        self.assertEqual(self.conn.execute(text(
+            "SELECT count(*) FROM users WHERE deleted_at IS NOT NULL"))
+            .scalar(), 0)
+
+        # Follows are recorded in the change feed from now on.
+        self.conn.execute(text(
+            "DELETE FROM follows WHERE user_following_id = 2"))
+        self.assertEqual(
+            self.conn.execute(text(
+                "SELECT follower_id, followed_id, following "
+                "FROM follow_changes")).fetchall(),
+            [(2, 1, False)])
+
+        self.assertEqual(migrate(self.conn), [])
+
+    def test_migrate_current_schema(self):
+        """Does migrating a database made by create_all change nothing?"""
+
+        db.metadata.create_all(self.conn, checkfirst=False)
+        before = {table: self.indexes(table)
+                  for table in ('users', 'messages', 'follows', 'likes',
+                                'timelines', 'user_purges',
+                                'recommendations', 'stale_recommendations',
+                                'follow_changes')}
+
+        migrate(self.conn)
+
+        self.assertEqual(before, {table: self.indexes(table)
+                                  for table in before})
+
+
+class QueryPlanTestCase(TestCase):
+    """Test that the feeds' queries are served by their indexes.
+
+    The test data is small enough that the planner would rather scan whole
+    tables and sort, so sequential scans and sorts are turned off to see
+    whether an index can serve each query, as it must on a large database.
+    """
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="x")
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.flush()
+
+        users[0].following.append(users[1])
+        start = datetime(2020, 1, 1)
+        db.session.add_all([Message(text=f"warble {i}",
+                                    user_id=users[i % 3].id,
+                                    timestamp=start + timedelta(minutes=i))
+                            for i in range(30)])
+        db.session.flush()
+        rebuild_timelines()
+        db.session.commit()
+
+        self.user_id = users[0].id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def plan(self, query):
+        """EXPLAIN output of `query`, with sequential scans and sorts off."""
+
+        sql = query.statement.compile(dialect=postgresql.dialect(),
+                                      compile_kwargs={'literal_binds': True})
+
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        db.session.execute(text("SET LOCAL enable_sort = off"))
+        rows = db.session.execute(text(f"EXPLAIN {sql}"))
+        return '\n'.join(row for row, in rows)
+
+    def test_home_feed_plan(self):
+        """Is the home timeline read in order from its index?"""
+
+        plan = self.plan(feeds.home_feed(self.user_id).rows(limit=20))
+
+        self.assertIn("ix_timelines_user_timestamp", plan)
+        self.assertNotIn("Sort", plan)
+
+    def test_user_messages_plan(self):
+        """Are a user's messages read in order from their index?"""
+
+        plan = self.plan(feeds.user_messages(self.user_id).rows(limit=20))
+
+        self.assertIn("ix_messages_user_timestamp", plan)
+        self.assertNotIn("Sort", plan)
+
+    def test_user_likes_plan(self):
+        """Are a user's likes read in like order from their index?"""
+
+        plan = self.plan(feeds.user_likes(self.user_id).rows(limit=20))
+
+        self.assertIn("ix_likes_user_liked", plan)
+        self.assertNotIn("Sort", plan)
+
+    def test_following_plan(self):
+        """Are the users someone follows found from the reverse index?"""
+
+        plan = self.plan(feeds.following(self.user_id))
+
+        self.assertIn("ix_follows_following_followed", plan)
@@ -0,0 +1,175 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+import os
+from time import monotonic, sleep
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from passwords import (PasswordHasher, PasswordPoolBusy, configure_passwords,
+                       hash_rounds, password_hasher)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def slow_job(seconds):
+    """A stand-in for a hash that takes `seconds` (run in a worker)."""
+
+    sleep(seconds)
+    return seconds
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing inline and in the worker pool."""
+
+    def test_inline(self):
+        """Can passwords be hashed and checked without a pool?"""
+
+        hasher = PasswordHasher(workers=0, rounds=4)
+        hashed = hasher.hash("secret")
+
+        self.assertEqual(hash_rounds(hashed), 4)
+        self.assertTrue(hasher.check(hashed, "secret"))
+        self.assertFalse(hasher.check(hashed, "wrong"))
+
+    def test_pool(self):
+        """Can passwords be hashed and checked in worker processes?"""
+
+        hasher = PasswordHasher(workers=2, rounds=4)
+
+        try:
+            hashed = hasher.hash("secret")
+            self.assertTrue(hasher.check(hashed, "secret"))
+            self.assertFalse(hasher.check(hashed, "wrong"))
+        finally:
+            hasher.shutdown()
+
+    def test_busy(self):
+        """Are jobs refused once the queue is full?"""
+
+        hasher = PasswordHasher(workers=1, max_queue=0, rounds=4)
+
+        # Take the only slot, as a running job would.
+        hasher._slots.acquire()
+
+        try:
+            with self.assertRaises(PasswordPoolBusy):
+                hasher.hash("secret")
+        finally:
+            hasher._slots.release()
+            hasher.shutdown()
+
+    def test_timeout(self):
+        """Is a job that overruns refused as busy, keeping its slot?"""
+
+        hasher = PasswordHasher(workers=1, max_queue=0, rounds=4,
+                                timeout=0.2)
+
+        try:
+            with self.assertRaises(PasswordPoolBusy):
+                hasher._run(slow_job, 2)
+
+            # The job is still running, so the pool is still full.
+            with self.assertRaises(PasswordPoolBusy):
+                hasher.hash("secret")
+
+            # Once it finishes, its slot is free again.
+            hasher.timeout = 30
+            deadline = monotonic() + 30
+
+            while True:
+                try:
+                    hashed = hasher.hash("secret")
+                    break
+                except PasswordPoolBusy:
+                    if monotonic() > deadline:
+                        raise
+                    sleep(0.1)
+
+            self.assertTrue(hasher.check(hashed, "secret"))
+        finally:
+            hasher.shutdown()
+
+    def test_needs_rehash(self):
+        """Are hashes at a different cost flagged for rehashing?"""
+
+        hasher = PasswordHasher(rounds=4)
+
+        self.assertFalse(hasher.needs_rehash(hasher.hash("secret")))
+        self.assertTrue(hasher.needs_rehash(
+            PasswordHasher(rounds=5).hash("secret")))
+        self.assertTrue(hasher.needs_rehash("not a hash"))
+
+
+class PasswordViewsTestCase(TestCase):
+    """Test signup and login with the password hasher."""
+
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        password_hasher.configure(workers=0, rounds=4)
+
+        User.signup(username="testuser",
+                    email="test@test.com",
+                    password="testuser",
+                    image_url=None)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        configure_passwords(app)
+
+    def test_rehash_on_login(self):
+        """Is the password rehashed at the new cost on login?"""
+
+        password_hasher.configure(workers=0, rounds=5)
+
+        resp = self.client.post("/login", data={"username": "testuser",
+                                                "password": "testuser"})
+        self.assertEqual(resp.status_code, 302)
+
+        user = User.query.filter_by(username="testuser").one()
+        self.assertEqual(hash_rounds(user.password), 5)
+        self.assertTrue(User.authenticate("testuser", "testuser"))
+
+    def test_login_wrong_password(self):
+        """Is a wrong password refused, and the hash left alone?"""
+
+        password_hasher.configure(workers=0, rounds=5)
+
+        resp = self.client.post("/login", data={"username": "testuser",
+                                                "password": "wrongpassword"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Invalid credentials", str(resp.data))
+
+        user = User.query.filter_by(username="testuser").one()
+        self.assertEqual(hash_rounds(user.password), 4)
+
+    def test_login_busy(self):
+        """Is a 503 returned when the pool is saturated?"""
+
+        password_hasher.configure(workers=1, max_queue=0, rounds=4)
+        password_hasher._slots.acquire()
+
+        try:
+            resp = self.client.post("/login", data={"username": "testuser",
+                                                    "password": "testuser"})
+        finally:
+            password_hasher._slots.release()
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn("try again", str(resp.data))
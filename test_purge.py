@@ -0,0 +1,224 @@
+"""Account deletion tests: tombstoning and purging."""
+
+# run these tests like:
+#
+#    python -m unittest test_purge.py
+
+
+import os
+from unittest import TestCase
+
+from models import (db, User, Message, Follows, Likes, Timelines,
+                    UserPurge)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from counters import reconcile_counters
+from follow_graph import follow_graph
+from purge import pending_purges, purge_pending, purge_user
+from timelines import rebuild_timelines
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PurgeTestCase(TestCase):
+    """Test deleting an account, and purging it in batches."""
+
+    def setUp(self):
+        UserPurge.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        gone = User.signup(username="gone", email="gone@test.com",
+                           password="password", image_url=None)
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password=gone.password)
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.flush()
+
+        # gone follows and is followed by everyone, and has liked and been
+        # liked by them.
+        for user in users:
+            gone.following.append(user)
+            user.following.append(gone)
+
+        messages = [Message(text=f"going {i}", user_id=gone.id)
+                    for i in range(5)]
+        theirs = [Message(text=f"staying {i}", user_id=user.id)
+                  for i, user in enumerate(users)]
+        db.session.add_all(messages + theirs)
+        db.session.flush()
+
+        db.session.add_all(
+            [Likes(user_id=user.id, message_id=msg.id)
+             for user in users for msg in messages[:2]] +
+            [Likes(user_id=gone.id, message_id=msg.id) for msg in theirs] +
+            [Likes(user_id=users[0].id, message_id=theirs[1].id)])
+
+        db.session.flush()
+        rebuild_timelines()
+        reconcile_counters()
+        db.session.commit()
+        follow_graph.invalidate()
+
+        self.gone_id = gone.id
+        self.user_ids = [user.id for user in users]
+        self.message_id = messages[0].id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def delete_account(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.gone_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+    def counters(self):
+        """The counters of every user but the deleted one, and of messages.
+
+        The deleted user's own counters aren't kept up as they're purged.
+        """
+
+        return (db.session.query(User.id, User.messages_count,
+                                 User.following_count, User.followers_count,
+                                 User.likes_count)
+                .filter(User.id != self.gone_id)
+                .order_by(User.id).all(),
+                db.session.query(Message.id, Message.likes_count)
+                .order_by(Message.id).all())
+
+    def test_delete_tombstones(self):
+        """Is a deleted user hidden at once, with their rows left to purge?"""
+
+        self.delete_account()
+
+        gone = User.query.get(self.gone_id)
+        self.assertIsNotNone(gone.deleted_at)
+        self.assertEqual(pending_purges(), [self.gone_id])
+        self.assertEqual(Message.query.filter_by(user_id=self.gone_id).count(),
+                         5)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_ids[0]
+
+            self.assertEqual(c.get(f"/users/{self.gone_id}").status_code, 404)
+            self.assertEqual(c.get(f"/messages/{self.message_id}").status_code,
+                             404)
+            self.assertEqual(
+                c.post(f"/users/add_like/{self.message_id}").status_code, 404)
+
+            home = c.get("/").get_data(as_text=True)
+            self.assertIn("staying", home)
+            self.assertNotIn("going", home)
+
+            self.assertIn("no messages found",
+                          c.get("/messages/search?q=going")
+                          .get_data(as_text=True))
+            self.assertNotIn(f'href="/users/{self.gone_id}"',
+                             c.get("/users?q=gone").get_data(as_text=True))
+
+            resp = c.get(f"/users/{self.user_ids[0]}/followers?format=json")
+            self.assertNotIn(self.gone_id,
+                             [u['id'] for u in resp.get_json()['users']])
+
+        # They can't log back in, or use a session they're still logged into.
+        self.assertFalse(User.authenticate("gone", "password"))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.gone_id
+
+            self.assertEqual(c.post("/users/delete").status_code, 302)
+            self.assertEqual(UserPurge.query.count(), 1)
+
+    def test_purge(self):
+        """Does a purge delete everything of the user's, keeping counters?"""
+
+        self.delete_account()
+        self.assertEqual(purge_pending(), [self.gone_id])
+
+        self.assertIsNone(User.query.get(self.gone_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.gone_id).count(),
+                         0)
+        self.assertEqual(Likes.query.filter_by(user_id=self.gone_id).count(),
+                         0)
+        self.assertEqual(Timelines.query.filter_by(user_id=self.gone_id)
+                         .count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertFalse(follow_graph.is_following(self.user_ids[0],
+                                                   self.gone_id))
+
+        counted = self.counters()
+        reconcile_counters()
+        self.assertEqual(counted, self.counters())
+
+        purge = UserPurge.query.get(self.gone_id)
+        self.assertIsNone(purge.step)
+        self.assertIsNotNone(purge.finished_at)
+        # 4 likes, 25 timeline entries and 8 likes of their messages, 5
+        # messages, 8 follows, 4 timeline entries and the user.
+        self.assertEqual(purge.rows_deleted, 4 + 25 + 8 + 5 + 8 + 4 + 1)
+        self.assertEqual(pending_purges(), [])
+
+    def test_purge_resumes(self):
+        """Does an interrupted purge pick up where it left off?"""
+
+        self.delete_account()
+
+        self.assertFalse(purge_user(self.gone_id, batch_size=2,
+                                    max_batches=3))
+
+        purge = UserPurge.query.get(self.gone_id)
+        self.assertEqual(purge.step, 'message_timelines')
+        self.assertEqual(purge.rows_deleted, 4)
+
+        # Counters are right however far the purge has got.
+        counted = self.counters()
+        reconcile_counters()
+        self.assertEqual(counted, self.counters())
+        db.session.rollback()
+
+        self.assertTrue(purge_user(self.gone_id, batch_size=2))
+        self.assertIsNone(User.query.get(self.gone_id))
+        self.assertTrue(purge_user(self.gone_id, batch_size=2))
+
+    def test_purge_batches_smaller_than_a_message(self):
+        """Is a message's fan-out deleted in batches, not with the message?"""
+
+        self.delete_account()
+
+        # Each of their messages is on 5 timelines, and some have 4 likes.
+        deleted = []
+        part_way = False
+
+        while not purge_user(self.gone_id, batch_size=3, max_batches=1):
+            purge = UserPurge.query.get(self.gone_id)
+            deleted.append(purge.rows_deleted - sum(deleted))
+
+            if purge.step == 'message_likes' and purge.rows_deleted == 32:
+                part_way = True
+                self.assertEqual(
+                    Message.query.filter_by(user_id=self.gone_id).count(), 5)
+
+                counted = self.counters()
+                reconcile_counters()
+                self.assertEqual(counted, self.counters())
+                db.session.rollback()
+
+        self.assertTrue(part_way)
+        self.assertLessEqual(max(deleted), 3)
+        self.assertIsNone(User.query.get(self.gone_id))
+        self.assertEqual(UserPurge.query.get(self.gone_id).rows_deleted,
+                         4 + 25 + 8 + 5 + 8 + 4 + 1)
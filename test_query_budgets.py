@@ -0,0 +1,204 @@
+"""Query budget tests for every route."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_budgets.py
+
+
+import os
+from datetime import datetime, timedelta
+from random import Random
+from unittest import TestCase
+
+from flask import request
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from instrumentation import count_queries, budget_for
+from timelines import rebuild_timelines
+from counters import reconcile_counters
+from recommendations import refresh_recommendations
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_USERS = 60
+NUM_MESSAGES = 600
+FOLLOWS_PER_USER = 30
+LIKES_PER_USER = 40
+
+# Every route, as (endpoint, method, path, form data). Paths may use
+# {me} (the logged-in user), {other} (a user followed by everyone),
+# {stranger} (a user {me} doesn't follow), {message} (one of {other}'s)
+# and {own_message} (one of {me}'s). API routes are sent their data as
+# JSON, in which "{everyone}" stands for the ids of every user.
+CASES = [
+    ('signup', 'GET', "/signup", None),
+    ('signup', 'POST', "/signup",
+     {'username': "newuser", 'email': "new@test.com",
+      'password': "password"}),
+    ('login', 'GET', "/login", None),
+    ('login', 'POST', "/login",
+     {'username': "user0", 'password': "password"}),
+    ('logout', 'GET', "/logout", None),
+    ('list_users', 'GET', "/users", None),
+    ('list_users', 'GET', "/users?q=user1", None),
+    ('users_typeahead', 'GET', "/users/typeahead?q=user", None),
+    ('users_show', 'GET', "/users/{other}", None),
+    ('show_following', 'GET', "/users/{me}/following", None),
+    ('users_followers', 'GET', "/users/{other}/followers", None),
+    ('add_follow', 'POST', "/users/follow/{stranger}", None),
+    ('stop_following', 'POST', "/users/stop-following/{other}", None),
+    ('profile', 'GET', "/users/profile", None),
+    ('profile', 'POST', "/users/profile",
+     {'username': "user0", 'email': "user0@test.com",
+      'password': "password", 'bio': "Updated"}),
+    ('add_like', 'POST', "/users/add_like/{message}", None),
+    ('show_likes', 'GET', "/users/{me}/likes", None),
+    ('delete_user', 'POST', "/users/delete", None),
+    ('messages_add', 'GET', "/messages/new", None),
+    ('messages_add', 'POST', "/messages/new", {'text': "Budgeted"}),
+    ('messages_search', 'GET', "/messages/search?q=warble", None),
+    ('messages_show', 'GET', "/messages/{message}", None),
+    ('messages_destroy', 'POST', "/messages/{own_message}/delete", None),
+    ('api_timeline', 'GET', "/api/v1/timeline", None),
+    ('api_user_messages', 'GET', "/api/v1/users/{other}/messages", None),
+    ('api_user_likes', 'GET', "/api/v1/users/{me}/likes", None),
+    ('api_user_followers', 'GET', "/api/v1/users/{other}/followers", None),
+    ('api_user_following', 'GET', "/api/v1/users/{me}/following", None),
+    ('api_follows', 'POST', "/api/v1/follows", {'user_ids': "{everyone}"}),
+    ('api_follows', 'DELETE', "/api/v1/follows", {'user_ids': "{everyone}"}),
+    ('homepage', 'GET', "/", None),
+    ('metrics_show', 'GET', "/metrics", None),
+]
+
+
+class QueryBudgetTestCase(TestCase):
+    """Test that every route stays within its query budget.
+
+    Routes are requested by a logged-in user against a dataset with many
+    follows and likes, so that a query per row shows up as a failure.
+    """
+
+    def setUp(self):
+        self.seed()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def seed(self):
+        """Replace the data with a fixed graph of users, follows and likes."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        rng = Random(19)
+
+        me = User.signup(username="user0",
+                         email="user0@test.com",
+                         password="password",
+                         image_url=None)
+        db.session.add_all([User(username=f"user{i}",
+                                 email=f"user{i}@test.com",
+                                 password=me.password)
+                            for i in range(1, NUM_USERS)])
+        db.session.commit()
+
+        user_ids = [id for id, in db.session.query(User.id).order_by(User.id)]
+        other = user_ids[1]
+
+        start = datetime(2020, 1, 1)
+        db.session.execute(Message.__table__.insert(), [
+            {'text': f"warble {i}",
+             'timestamp': start + timedelta(minutes=i),
+             'user_id': other if i % 3 == 0 else rng.choice(user_ids)}
+            for i in range(NUM_MESSAGES)])
+
+        message_ids = [id for id, in db.session.query(Message.id)]
+
+        db.session.execute(Follows.__table__.insert(), [
+            {'user_following_id': follower, 'user_being_followed_id': followed}
+            for follower in user_ids
+            for followed in {other} | set(rng.sample(user_ids,
+                                                     FOLLOWS_PER_USER))
+            if followed != follower])
+
+        db.session.execute(Likes.__table__.insert(), [
+            {'user_id': user, 'message_id': message}
+            for user in user_ids
+            for message in rng.sample(message_ids, LIKES_PER_USER)])
+
+        rebuild_timelines()
+        reconcile_counters()
+        db.session.commit()
+        refresh_recommendations(everyone=True)
+
+        followed = {id for id, in (db.session
+                                   .query(Follows.user_being_followed_id)
+                                   .filter_by(user_following_id=user_ids[0]))}
+
+        self.ids = {
+            'me': user_ids[0],
+            'other': other,
+            'stranger': min(set(user_ids[1:]) - followed),
+            'everyone': user_ids,
+            'message': (Message.query
+                        .filter_by(user_id=other)
+                        .order_by(Message.id)
+                        .first().id),
+            'own_message': (Message.query
+                            .filter_by(user_id=user_ids[0])
+                            .order_by(Message.id)
+                            .first().id),
+        }
+
+    def test_every_route_has_a_budget(self):
+        """Does every route declare a budget, and have a case here?"""
+
+        endpoints = {rule.endpoint for rule in app.url_map.iter_rules()
+                     if rule.endpoint != 'static'}
+
+        self.assertEqual(endpoints, {case[0] for case in CASES})
+
+        for endpoint in endpoints:
+            self.assertIsNotNone(budget_for(app, endpoint), endpoint)
+
+    def test_routes_within_budget(self):
+        """Does every route stay within its budget on a full dataset?"""
+
+        for endpoint, method, path, data in CASES:
+            path = path.format(**self.ids)
+
+            if data and path.startswith('/api/'):
+                body = {'json': {key: self.ids['everyone']
+                                 if value == "{everyone}" else value
+                                 for key, value in data.items()}}
+            else:
+                body = {'data': data}
+
+            with self.subTest(method=method, path=path):
+                with self.client as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.ids['me']
+
+                    with count_queries() as queries:
+                        resp = c.open(path, method=method, **body)
+                        resp.get_data()
+
+                    self.assertEqual(request.endpoint, endpoint)
+                    self.assertLess(resp.status_code, 400)
+                    self.assertLessEqual(queries.count,
+                                         budget_for(app, endpoint),
+                                         queries.statements)
+
+                # Start each change from the same data.
+                if method != 'GET':
+                    db.session.remove()
+                    self.seed()
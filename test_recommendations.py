@@ -0,0 +1,219 @@
+"""Who to follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+from datetime import datetime, timedelta
+from math import log1p
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import (db, User, Message, Follows, Likes, Recommendation,
+                    StaleRecommendations)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from counters import reconcile_counters
+from follow_graph import follow_graph
+import recommendations
+from recommendations import ACTIVITY_WEIGHT, refresh_recommendations
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ScoringTestCase(TestCase):
+    """Test scoring friends-of-friends, a batch of users at a time."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="x")
+                 for i in range(7)]
+        db.session.add_all(users)
+        db.session.flush()
+        self.ids = [user.id for user in users]
+
+        # 1 follows 2 and 3; 2 follows 4 and 5; 3 follows 1, 4 and 6; 6 has
+        # been posting.
+        edges = [(1, 2), (1, 3), (2, 4), (2, 5), (3, 1), (3, 4), (3, 6)]
+        db.session.execute(Follows.__table__.insert(), [
+            {'user_following_id': self.ids[a],
+             'user_being_followed_id': self.ids[b]}
+            for a, b in edges])
+
+        db.session.add_all([Message(text=f"busy {i}", user_id=self.ids[6])
+                            for i in range(50)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def scored(self, user_id):
+        return [(id, mutuals, round(score, 6))
+                for id, mutuals, score in (db.session
+                                           .query(Recommendation.candidate_id,
+                                                  Recommendation.mutuals,
+                                                  Recommendation.score)
+                                           .filter_by(user_id=user_id)
+                                           .order_by(Recommendation.score
+                                                     .desc()))]
+
+    def test_scores(self):
+        """Are friends-of-friends ranked by their blended score?"""
+
+        u = self.ids
+        refresh_recommendations(everyone=True, batch_size=2)
+
+        self.assertEqual(self.scored(u[1]), [
+            (u[6], 1, round(1 + ACTIVITY_WEIGHT * log1p(50), 6)),
+            (u[4], 2, 2),
+            (u[5], 1, 1)])
+
+        # The user and the users they follow are left out.
+        self.assertEqual([id for id, _, _ in self.scored(u[3])], [u[2]])
+        self.assertEqual(self.scored(u[4]), [])
+
+    def test_top_k(self):
+        """Are only the best TOP_K candidates kept?"""
+
+        u = self.ids
+
+        with patch.object(recommendations, 'TOP_K', 1):
+            refresh_recommendations(everyone=True)
+
+        self.assertEqual([id for id, _, _ in self.scored(u[1])], [u[6]])
+
+    def test_deleted_candidates(self):
+        """Are deleted users left out?"""
+
+        u = self.ids
+        User.query.get(u[5]).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        refresh_recommendations(everyone=True)
+        self.assertEqual([id for id, _, _ in self.scored(u[1])], [u[6], u[4]])
+
+
+class RecommendationViewTestCase(TestCase):
+    """Test refreshing recommendations and showing them on the home page."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="x")
+                 for i in range(6)]
+        db.session.add_all(users)
+        db.session.flush()
+
+        # user0 follows user1 and user2, who both follow user3; user2 also
+        # follows user4 and user5, and user5 has been posting (though not
+        # enough to outrank user3's extra mutual).
+        edges = [(0, 1), (0, 2), (1, 3), (2, 3), (2, 4), (2, 5)]
+        db.session.execute(Follows.__table__.insert(), [
+            {'user_following_id': users[a].id,
+             'user_being_followed_id': users[b].id}
+            for a, b in edges])
+
+        db.session.add_all([Message(text=f"busy {i}", user_id=users[5].id,
+                                    timestamp=datetime.utcnow() -
+                                    timedelta(days=i))
+                            for i in range(5)])
+
+        reconcile_counters()
+        db.session.commit()
+        follow_graph.invalidate()
+
+        self.ids = [user.id for user in users]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def recommended(self, user_id):
+        return [id for id, in (db.session
+                               .query(Recommendation.candidate_id)
+                               .filter_by(user_id=user_id)
+                               .order_by(Recommendation.score.desc()))]
+
+    def mutuals(self, user_id):
+        return dict(db.session
+                    .query(Recommendation.candidate_id, Recommendation.mutuals)
+                    .filter_by(user_id=user_id))
+
+    def test_refresh_all(self):
+        """Are everyone's friends-of-friends stored, best first?"""
+
+        self.assertEqual(refresh_recommendations(everyone=True), 6)
+
+        u = self.ids
+        self.assertEqual(self.recommended(u[0]), [u[3], u[5], u[4]])
+        self.assertEqual(self.recommended(u[1]), [])
+        self.assertEqual(StaleRecommendations.query.count(), 0)
+
+    def test_refresh_on_follow(self):
+        """Are only the users whose candidates changed refreshed?"""
+
+        u = self.ids
+        refresh_recommendations(everyone=True)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u[1]
+
+            c.post(f"/users/follow/{u[4]}")
+
+        # Only user1 is queued; their follower user0 is refreshed with them.
+        self.assertEqual(
+            [id for id, in db.session.query(StaleRecommendations.user_id)],
+            [u[1]])
+
+        self.assertEqual(refresh_recommendations(), 2)
+        self.assertEqual(self.mutuals(u[0]), {u[3]: 2, u[4]: 2, u[5]: 1})
+        self.assertEqual(refresh_recommendations(), 0)
+
+    def test_homepage(self):
+        """Are recommendations shown on the home page, without followees?"""
+
+        u = self.ids
+        refresh_recommendations(everyone=True)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u[0]
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn("@user3", html)
+            self.assertIn("Followed by 2 people you follow", html)
+            self.assertIn(f'action="/users/follow/{u[5]}"', html)
+
+            # Followed since the last refresh.
+            c.post(f"/users/follow/{u[3]}")
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn(f'action="/users/follow/{u[3]}"', html)
+            self.assertIn(f'action="/users/follow/{u[5]}"', html)
+
+    def test_deleted_users_not_recommended(self):
+        """Are deleted users left out of recommendations?"""
+
+        u = self.ids
+        User.query.get(u[3]).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        refresh_recommendations(everyone=True)
+        self.assertEqual(self.recommended(u[0]), [u[5], u[4]])
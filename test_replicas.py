@@ -0,0 +1,124 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from replicas import PIN_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test sending reads to a replica and pinning writers to the primary.
+
+    The "replica" is a second engine on the test database, so that the
+    statements sent to each can be told apart.
+    """
+
+    def setUp(self):
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica_0': app.config['SQLALCHEMY_DATABASE_URI']}
+
+        self.replica_statements = []
+        self.replica = db.get_engine(app, bind='replica_0')
+        event.listen(self.replica, 'before_cursor_execute', self.record)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        event.remove(self.replica, 'before_cursor_execute', self.record)
+        app.config['SQLALCHEMY_BINDS'] = {}
+        db.session.rollback()
+
+    def record(self, conn, cursor, statement, *args):
+        self.replica_statements.append(statement)
+
+    def test_reads_use_replica(self):
+        """Are GET requests' queries sent to the replica?"""
+
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.replica_statements)
+
+    def test_writes_use_primary(self):
+        """Do POST requests write to the primary, and pin the user there?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": "Fresh warble"})
+            self.assertEqual(self.replica_statements, [])
+
+            with c.session_transaction() as sess:
+                self.assertIn(PIN_KEY, sess)
+
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertIn("Fresh warble", str(resp.data))
+            self.assertEqual(self.replica_statements, [])
+
+    def test_pin_expires(self):
+        """Do reads go back to the replica once the pin expires?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[PIN_KEY] = 0
+
+            c.get(f"/users/{self.user_id}")
+            self.assertTrue(self.replica_statements)
+
+
+class PoolSettingsTestCase(TestCase):
+    """Test the connection pool settings for each kind of database."""
+
+    def test_sqlite(self):
+        """Does the app still start on SQLite, whose pools aren't sized?"""
+
+        # A fresh interpreter, as the app reads its database URL on import.
+        script = ("from app import app, db\n"
+                  "with app.app_context():\n"
+                  "    print(db.engine.execute('SELECT 1').scalar())\n")
+
+        result = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={**os.environ, 'DATABASE_URL': 'sqlite://'},
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '1')
+
+    def test_postgres(self):
+        """Are other databases' pools sized?"""
+
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['max_overflow'], 10)
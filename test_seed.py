@@ -0,0 +1,76 @@
+"""Seeding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from seed import load
+
+db.create_all()
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'generator')
+
+COUNTS = {'users': 300, 'messages': 1000, 'follows': 5000}
+
+
+class SeedTestCase(TestCase):
+    """Test loading the generator's CSVs."""
+
+    def test_copy(self):
+        """Are the CSVs COPYed in, with indexes restored?"""
+
+        with db.engine.connect() as conn:
+            trans = conn.begin()
+
+            try:
+                # The CSVs refer to users by id, counting from 1.
+                conn.execute(text(
+                    "TRUNCATE " +
+                    ", ".join(t.name for t in db.metadata.sorted_tables) +
+                    " RESTART IDENTITY"))
+
+                indexes = conn.execute(text(
+                    "SELECT count(*) FROM pg_indexes "
+                    "WHERE schemaname = current_schema()")).scalar()
+
+                results = load(conn, DATA_DIR, batch_size=400, method='copy')
+
+                self.assertEqual(
+                    {name: rows for name, rows, _ in results}, COUNTS)
+
+                for name, count in COUNTS.items():
+                    self.assertEqual(conn.execute(text(
+                        f"SELECT count(*) FROM {name}")).scalar(), count)
+
+                self.assertEqual(conn.execute(text(
+                    "SELECT count(*) FROM pg_indexes "
+                    "WHERE schemaname = current_schema()")).scalar(),
+                    indexes)
+
+            finally:
+                trans.rollback()
+
+    def test_sqlite_fallback(self):
+        """Are the CSVs loaded with INSERTs on SQLite?"""
+
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+
+        with engine.begin() as conn:
+            results = load(conn, DATA_DIR, batch_size=400)
+
+            self.assertEqual(
+                {name: rows for name, rows, _ in results}, COUNTS)
+            self.assertEqual(conn.execute(text(
+                "SELECT count(*) FROM messages")).scalar(), 1000)
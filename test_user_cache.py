@@ -0,0 +1,142 @@
+"""User cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_cache.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from instrumentation import count_queries
+from user_cache import LocalCache, UserCache, user_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeClock:
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LocalCacheTestCase(TestCase):
+    """Test the in-process TTL + LRU cache."""
+
+    def test_ttl(self):
+        """Do entries expire after the TTL?"""
+
+        clock = FakeClock()
+        cache = LocalCache(ttl=10, clock=clock)
+        cache.set(1, 'one')
+
+        clock.now = 9
+        self.assertEqual(cache.get(1), 'one')
+
+        clock.now = 10
+        self.assertIsNone(cache.get(1))
+
+    def test_lru(self):
+        """Is the least recently used entry evicted first?"""
+
+        cache = LocalCache(size=2)
+        cache.set(1, 'one')
+        cache.set(2, 'two')
+        cache.get(1)
+        cache.set(3, 'three')
+
+        self.assertEqual(cache.get(1), 'one')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(len(cache), 2)
+
+    def test_shared_backend(self):
+        """Are shared backend entries used and invalidated?"""
+
+        shared = LocalCache()
+        cache = UserCache(shared=shared)
+
+        cache.set(1, {'id': 1})
+        cache.local.clear()
+        self.assertEqual(cache.get(1), {'id': 1})
+
+        cache.invalidate(1)
+        self.assertIsNone(shared.get(1))
+
+
+class CurrentUserCacheTestCase(TestCase):
+    """Test caching the logged-in user across requests."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_cached_user_needs_no_query(self):
+        """Is g.user attached without a query once cached?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with count_queries() as first:
+                c.get("/messages/new")
+
+            with count_queries() as second:
+                resp = c.get("/messages/new")
+
+            self.assertEqual(first.count, 1)
+            self.assertEqual(second.count, 0)
+            self.assertIn('alt="testuser"', str(resp.data))
+
+    def test_profile_edit_invalidates(self):
+        """Does editing the profile drop the cached user?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/messages/new")
+            self.assertIsNotNone(user_cache.get(self.testuser_id))
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser"})
+            self.assertIsNone(user_cache.get(self.testuser_id))
+
+            resp = c.get("/messages/new")
+            self.assertIn('alt="renamed"', str(resp.data))
+
+    def test_delete_user_invalidates(self):
+        """Does deleting the account drop the cached user?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/messages/new")
+            c.post("/users/delete")
+
+            self.assertIsNone(user_cache.get(self.testuser_id))
@@ -1,7 +1,18 @@
+import json
 import os
+from flask import request
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Likes, Follows
+from models import db, connect_db, Message, User, Likes, Follows, Timelines
+from timelines import rebuild_timelines
+from pagination import encode_token, paginate, PAGE_SIZE
+import counters
+import feeds
+from like_state import LikeState
+from instrumentation import count_queries, budget_for
+from user_search import search_users
+from purge import purge_pending
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
@@ -86,11 +97,13 @@ class UserViewTestCase(TestCase):
         m1 = Message(text="Hello!", user_id=self.testuser.id)
         m2 = Message(text="Goodbye!", user_id=self.u2.id)
         m3 = Message(text="You say goodbye and I say hello.", user_id=self.testuser.id)
+        db.session.add_all([m1, m2, m3])
+        db.session.flush()
 
         l1 = Likes(user_id=self.testuser.id, message_id=m2.id)
         l2 = Likes(user_id=self.u2.id, message_id=m3.id)
 
-        db.session.add_all([m1, m2, m3, l1, l2])
+        db.session.add_all([l1, l2])
         db.session.commit()
 
 
@@ -202,6 +215,65 @@ class UserViewTestCase(TestCase):
             self.assertNotIn('@thirduser', str(resp.data))
             
 
+    def test_follow_lists_paged(self):
+        """Are followers listed a page at a time, as HTML and JSON?"""
+
+        testuser_id = self.testuser.id
+        u2_id = self.u2.id
+
+        fans = [User(username=f"fan{i}", email=f"fan{i}@test.com",
+                     password="x")
+                for i in range(PAGE_SIZE + 5)]
+        db.session.add_all(fans)
+        db.session.flush()
+        fan_ids = [fan.id for fan in fans]
+
+        db.session.add_all([Follows(user_being_followed_id=u2_id,
+                                    user_following_id=id)
+                            for id in fan_ids])
+        db.session.add(Follows(user_being_followed_id=fan_ids[-1],
+                               user_following_id=testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f'/users/{u2_id}/followers')
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count('class="card-link"'), PAGE_SIZE)
+            self.assertIn("More users", html)
+
+            resp = c.get(f'/users/{u2_id}/followers?format=json')
+            self.assertEqual([u['id'] for u in resp.json['users']],
+                             fan_ids[:PAGE_SIZE])
+
+            resp = c.get(f'/users/{u2_id}/followers',
+                         query_string={'after': resp.json['next']},
+                         headers={'Accept': 'application/json'})
+            self.assertEqual([(u['id'], u['following'])
+                              for u in resp.json['users']],
+                             [(id, id == fan_ids[-1])
+                              for id in fan_ids[PAGE_SIZE:]])
+            self.assertIsNone(resp.json['next'])
+
+            # Query params named like the route's arguments or url_for's
+            # options are left out of the next page's link.
+            resp = c.get(f'/users/{u2_id}/followers',
+                         query_string={'user_id': 1, 'endpoint': 'x',
+                                       '_external': 1, '_anchor': 'top',
+                                       'sort': 'keep'})
+            self.assertEqual(resp.status_code, 200)
+
+            html = resp.get_data(as_text=True)
+            start = html.index(f'href="/users/{u2_id}/followers?')
+            link = html[start:html.index('"', start + 6)]
+            self.assertIn("after=", link)
+            self.assertIn("sort=keep", link)
+            for param in ("user_id", "endpoint", "_external", "#top"):
+                self.assertNotIn(param, link)
+
+
     def test_unauthorized_access_to_followers(self):
         """Can unauthorized user view list of a user's followers?"""
 
@@ -217,4 +289,452 @@ class UserViewTestCase(TestCase):
         with self.client as c:
             resp = c.get(f'/users/{self.testuser.id}/following', follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Access unauthorized.", str(resp.data))
\ No newline at end of file
+            self.assertIn("Access unauthorized.", str(resp.data))
+
+
+    def test_follow_backfills_timeline(self):
+        """Does following a user copy their messages into the timeline?"""
+
+        m = Message(id=11, text="Backfill me.", user_id=self.u2.id)
+        db.session.add(m)
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        u2_id = self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f'/users/follow/{u2_id}')
+
+            entry = Timelines.query.get((testuser_id, 11))
+            self.assertIsNotNone(entry)
+
+            resp = c.get('/')
+            self.assertIn("Backfill me.", str(resp.data))
+
+
+    def test_unfollow_prunes_timeline(self):
+        """Does unfollowing a user remove their messages from the timeline?"""
+
+        m = Message(id=11, text="Prune me.", user_id=self.u2.id)
+        db.session.add(m)
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        u2_id = self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f'/users/follow/{u2_id}')
+            c.post(f'/users/stop-following/{u2_id}')
+
+            entry = Timelines.query.get((testuser_id, 11))
+            self.assertIsNone(entry)
+
+            resp = c.get('/')
+            self.assertNotIn("Prune me.", str(resp.data))
+
+
+    def test_rebuild_timelines(self):
+        """Does rebuilding repopulate timelines from messages and follows?"""
+
+        self.setup_follows()
+        m = Message(id=11, text="Rebuild me.", user_id=self.u2.id)
+        db.session.add(m)
+        db.session.commit()
+
+        rebuild_timelines()
+        db.session.commit()
+
+        users = {t.user_id for t in Timelines.query.filter_by(message_id=11)}
+        self.assertEqual(users, {self.u2.id, self.testuser.id})
+
+
+    def test_profile_pagination(self):
+        """Do profile pages page with cursors instead of a fixed limit?"""
+
+        testuser_id = self.testuser.id
+        messages = [Message(id=100 + i,
+                            text=f"Message number {i}.",
+                            timestamp=datetime(2020, 1, 1) + timedelta(minutes=i),
+                            user_id=testuser_id)
+                    for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        with self.client as c:
+            first = paginate(Message.query.filter_by(user_id=testuser_id),
+                             Message.timestamp, Message.id, per_page=2)
+            self.assertEqual([m.id for m in first], [104, 103])
+            self.assertIsNone(first.newer)
+
+            second = paginate(Message.query.filter_by(user_id=testuser_id),
+                              Message.timestamp, Message.id,
+                              before=first.older, per_page=2)
+            self.assertEqual([m.id for m in second], [102, 101])
+
+            back = paginate(Message.query.filter_by(user_id=testuser_id),
+                            Message.timestamp, Message.id,
+                            after=second.newer, per_page=2)
+            self.assertEqual([m.id for m in back], [104, 103])
+
+            resp = c.get(f"/users/{testuser_id}?before={first.older}")
+            self.assertIn("Message number 2.", str(resp.data))
+            self.assertNotIn("Message number 4.", str(resp.data))
+
+            resp = c.get(f"/users/{testuser_id}?before=garbage")
+            self.assertEqual(resp.status_code, 400)
+
+
+    def test_likes_page(self):
+        """Does the likes page list the user's liked messages?"""
+
+        testuser_id = self.testuser.id
+        m1 = Message(id=21, text="Hello!", user_id=testuser_id)
+        m2 = Message(id=22, text="Goodbye!", user_id=self.u2.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=testuser_id, message_id=22))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{testuser_id}/likes")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Goodbye!", str(resp.data))
+            self.assertNotIn("Hello!", str(resp.data))
+
+
+    def test_likes_in_like_order(self):
+        """Are likes paged most recently liked first, not by message age?"""
+
+        testuser_id = self.testuser.id
+        start = datetime(2020, 1, 1)
+        db.session.add_all([Message(id=30 + i, text=f"Liked {i}",
+                                    user_id=self.u2.id,
+                                    timestamp=start + timedelta(days=i))
+                            for i in range(3)])
+        db.session.flush()
+
+        # The oldest message was liked last.
+        db.session.add_all([
+            Likes(user_id=testuser_id, message_id=30,
+                  liked_at=start + timedelta(days=12)),
+            Likes(user_id=testuser_id, message_id=31,
+                  liked_at=start + timedelta(days=11)),
+            Likes(user_id=testuser_id, message_id=32,
+                  liked_at=start + timedelta(days=10)),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            first = feeds.user_likes(testuser_id).page(per_page=2)
+            self.assertEqual([m.id for m in first], [30, 31])
+
+            second = feeds.user_likes(testuser_id).page(before=first.older,
+                                                        per_page=2)
+            self.assertEqual([m.id for m in second], [32])
+
+            back = feeds.user_likes(testuser_id).page(after=second.newer,
+                                                      per_page=2)
+            self.assertEqual([m.id for m in back], [30, 31])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            lines = (c.get(f"/api/v1/users/{testuser_id}/likes?limit=1")
+                     .get_data(as_text=True).splitlines())
+            self.assertIn('"id":30', lines[0])
+
+            after = json.loads(lines[1])['next']
+            resp = c.get(f"/api/v1/users/{testuser_id}/likes",
+                         query_string={'before': after, 'limit': 1})
+            self.assertIn('"id":31', resp.get_data(as_text=True))
+
+
+    def test_follow_counters(self):
+        """Do following and unfollowing keep follow counts current?"""
+
+        testuser_id = self.testuser.id
+        u2_id = self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f'/users/follow/{u2_id}')
+            self.assertEqual(User.query.get(testuser_id).following_count, 1)
+            self.assertEqual(User.query.get(u2_id).followers_count, 1)
+
+            c.post(f'/users/stop-following/{u2_id}')
+            self.assertEqual(User.query.get(testuser_id).following_count, 0)
+            self.assertEqual(User.query.get(u2_id).followers_count, 0)
+
+
+    def test_like_counters(self):
+        """Does toggling a like keep the user's and message's counts current?"""
+
+        m4 = Message(id=7, text="This is the end.", user_id=self.u2.id)
+        db.session.add(m4)
+        db.session.commit()
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post('/users/add_like/7')
+            self.assertEqual(User.query.get(testuser_id).likes_count, 1)
+            self.assertEqual(Message.query.get(7).likes_count, 1)
+
+            c.post('/users/add_like/7')
+            self.assertEqual(User.query.get(testuser_id).likes_count, 0)
+            self.assertEqual(Message.query.get(7).likes_count, 0)
+
+
+    def test_likes_by_many_users(self):
+        """Can several users like the same message, and unlike it alone?"""
+
+        m4 = Message(id=7, text="This is the end.", user_id=self.u2.id)
+        db.session.add(m4)
+        db.session.commit()
+        testuser_id = self.testuser.id
+        u3_id = self.u3.id
+
+        for user_id in (testuser_id, u3_id, testuser_id):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                c.post('/users/add_like/7')
+
+        likes = Likes.query.filter_by(message_id=7).all()
+        self.assertEqual([like.user_id for like in likes], [u3_id])
+        self.assertEqual(Message.query.get(7).likes_count, 1)
+
+
+    def test_like_json(self):
+        """Does liking answer with JSON when asked, instead of redirecting?"""
+
+        m4 = Message(id=7, text="This is the end.", user_id=self.u2.id)
+        db.session.add(m4)
+        db.session.commit()
+        testuser_id = self.testuser.id
+
+        resp = self.client.post('/users/add_like/7',
+                                headers={'Accept': 'application/json'})
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.post('/users/add_like/7',
+                          headers={'Accept': 'application/json'})
+            self.assertEqual(resp.json,
+                             {'message_id': 7, 'liked': True, 'likes': 1})
+
+            resp = c.post('/users/add_like/7?format=json')
+            self.assertEqual(resp.json,
+                             {'message_id': 7, 'liked': False, 'likes': 0})
+
+            resp = c.post('/users/add_like/8?format=json')
+            self.assertEqual(resp.status_code, 404)
+
+
+    def test_delete_user_counters(self):
+        """Does purging a deleted user adjust the counters of those they
+        touched?"""
+
+        self.setup_follows()
+        testuser_id = self.testuser.id
+        u2_id = self.u2.id
+        u3_id = self.u3.id
+
+        db.session.add_all([Message(id=31, text="Mine", user_id=testuser_id),
+                            Message(id=32, text="Theirs", user_id=u2_id)])
+        db.session.commit()
+        db.session.add_all([Likes(user_id=u2_id, message_id=31),
+                            Likes(user_id=testuser_id, message_id=32)])
+        db.session.commit()
+        counters.reconcile_counters()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post('/users/delete')
+            purge_pending()
+
+            u2 = User.query.get(u2_id)
+            self.assertEqual(u2.followers_count, 0)
+            self.assertEqual(u2.following_count, 0)
+            self.assertEqual(u2.likes_count, 0)
+            self.assertEqual(User.query.get(u3_id).followers_count, 0)
+            self.assertEqual(Message.query.get(32).likes_count, 0)
+
+
+    def test_reconcile_counters(self):
+        """Does reconciling recompute counters from the source tables?"""
+
+        self.setup_follows()
+        testuser_id = self.testuser.id
+        db.session.add(Message(id=41, text="Counted", user_id=testuser_id))
+        db.session.commit()
+
+        counters.reconcile_counters()
+        db.session.commit()
+
+        user = User.query.get(testuser_id)
+        self.assertEqual(user.messages_count, 1)
+        self.assertEqual(user.following_count, 2)
+        self.assertEqual(user.followers_count, 1)
+        self.assertEqual(user.likes_count, 0)
+
+
+    def test_like_state(self):
+        """Does the like state resolver find the viewer's likes on a page?"""
+
+        testuser_id = self.testuser.id
+        u2_id = self.u2.id
+        db.session.add_all([Message(id=51, text="Liked", user_id=u2_id),
+                            Message(id=52, text="Not liked", user_id=u2_id)])
+        db.session.commit()
+        db.session.add(Likes(user_id=testuser_id, message_id=51))
+        db.session.commit()
+
+        state = LikeState(testuser_id)
+        state.prime(Message.query.filter(Message.id.in_([51, 52])).all())
+        self.assertIn(51, state)
+        self.assertNotIn(52, state)
+
+        anonymous = LikeState(None)
+        anonymous.prime(Message.query.all())
+        self.assertNotIn(51, anonymous)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{u2_id}")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count("btn-primary\">"), 1)
+
+
+    def test_message_lists_within_query_budget(self):
+        """Do message lists use a constant number of queries?"""
+
+        testuser_id = self.testuser.id
+        u2_id = self.u2.id
+        u3_id = self.u3.id
+
+        db.session.add_all([Follows(user_being_followed_id=u2_id,
+                                    user_following_id=testuser_id),
+                            Follows(user_being_followed_id=u3_id,
+                                    user_following_id=testuser_id)])
+        db.session.add_all([Message(id=200 + i,
+                                    text=f"Message {i}",
+                                    user_id=(u2_id, u3_id)[i % 2])
+                            for i in range(30)])
+        db.session.commit()
+        db.session.add_all([Likes(user_id=testuser_id, message_id=200 + i)
+                            for i in range(0, 30, 3)])
+        db.session.commit()
+        rebuild_timelines()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            for path in ["/",
+                         f"/users/{u2_id}",
+                         f"/users/{testuser_id}/likes",
+                         f"/users/{testuser_id}/following",
+                         f"/users/{u2_id}/followers",
+                         "/messages/201"]:
+                with count_queries() as queries:
+                    resp = c.get(path)
+
+                self.assertEqual(resp.status_code, 200)
+                budget = budget_for(app, request.endpoint)
+                self.assertLessEqual(queries.count, budget, path)
+
+
+    def test_user_search_ranking(self):
+        """Are search results ranked exact, then prefix, then substring?"""
+
+        db.session.add_all([
+            User(username="bird", email="bird@test.com", password="x"),
+            User(username="birdwatcher", email="bw@test.com", password="x"),
+            User(username="bigbird", email="bb@test.com", password="x"),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            users, cursor = search_users("bird")
+            self.assertEqual([u.username for u in users],
+                             ["bird", "birdwatcher", "bigbird"])
+            self.assertIsNone(cursor)
+
+            first, cursor = search_users("bird", per_page=2)
+            rest, _ = search_users("bird", after=cursor, per_page=2)
+            self.assertEqual([u.username for u in first + rest],
+                             ["bird", "birdwatcher", "bigbird"])
+
+            users, _ = search_users("50%_off")
+            self.assertEqual(users, [])
+
+
+    def test_user_search_bad_cursor(self):
+        """Are malformed search cursors rejected with a 400?"""
+
+        with self.client as c:
+            for values in (["a", "b"], [1, 2], [{"x": 1}, "b"], 5, [1]):
+                with self.subTest(values=values):
+                    after = encode_token(values)
+
+                    resp = c.get(f"/users?q=bird&after={after}")
+                    self.assertEqual(resp.status_code, 400)
+
+                    resp = c.get(f"/users?after={after}")
+                    self.assertEqual(resp.status_code, 400)
+
+            resp = c.get("/users?q=bird&after=garbage")
+            self.assertEqual(resp.status_code, 400)
+
+
+    def test_user_list_pagination(self):
+        """Does the user listing page through users alphabetically?"""
+
+        with self.client as c:
+            users, cursor = search_users(per_page=2)
+            self.assertEqual([u.username for u in users],
+                             ["seconduser", "testuser"])
+
+            users, cursor = search_users(after=cursor, per_page=2)
+            self.assertEqual([u.username for u in users], ["thirduser"])
+            self.assertIsNone(cursor)
+
+
+    def test_typeahead(self):
+        """Does typeahead return prefix matches as JSON?"""
+
+        with self.client as c:
+            resp = c.get('/users/typeahead?q=sec')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([u['username'] for u in resp.json['users']],
+                             ["seconduser"])
+            self.assertFalse(resp.json['timed_out'])
+
+            resp = c.get('/users/typeahead?q=user')
+            self.assertEqual(resp.json['users'], [])
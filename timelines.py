@@ -0,0 +1,129 @@
+"""Materialized home timelines for Warbler.
+
+Rather than gathering the messages of everyone a user follows when their
+home page is shown, each new message is pushed ("fanned out") into the
+`timelines` table for its author and each of their followers. The home
+page is then a single indexed range read on (user_id, timestamp).
+"""
+
+from sqlalchemy import select, literal, union, func
+
+from models import db, Follows, Message, Timelines
+
+# How many of a newly-followed user's messages to copy into the follower's
+# timeline. Older messages than this are not backfilled.
+BACKFILL_LIMIT = 1000
+
+TIMELINE_COLUMNS = ['user_id', 'message_id', 'timestamp']
+
+
+def fan_out(msg):
+    """Deliver `msg` to its author's timeline and to each follower's.
+
+    `msg` must already be flushed, so that it has an id.
+    """
+
+    author = select([
+        literal(msg.user_id),
+        literal(msg.id),
+        literal(msg.timestamp),
+    ])
+
+    followers = (select([
+        Follows.user_following_id,
+        literal(msg.id),
+        literal(msg.timestamp),
+    ])
+        .where(Follows.user_being_followed_id == msg.user_id))
+
+    db.session.execute(
+        Timelines.__table__.insert().from_select(
+            TIMELINE_COLUMNS, union(author, followers)))
+
+
+def retract(message_id):
+    """Remove a message from every timeline it was delivered to."""
+
+    (Timelines
+     .query
+     .filter(Timelines.message_id == message_id)
+     .delete(synchronize_session=False))
+
+
+def backfill(follower_id, followed_ids):
+    """Copy the recent messages of `followed_ids` into `follower_id`'s timeline.
+
+    Up to BACKFILL_LIMIT messages are copied from each followed user.
+    """
+
+    followed_ids = set(followed_ids) - {follower_id}
+
+    if not followed_ids:
+        return
+
+    ranked = (select([
+        Message.id,
+        Message.timestamp,
+        func.row_number().over(
+            partition_by=Message.user_id,
+            order_by=Message.timestamp.desc()).label('rank'),
+    ])
+        .where(Message.user_id.in_(followed_ids))
+        .alias('ranked'))
+
+    recent = (select([
+        literal(follower_id),
+        ranked.c.id,
+        ranked.c.timestamp,
+    ])
+        .where(ranked.c.rank <= BACKFILL_LIMIT)
+        .where(~ranked.c.id.in_(
+            select([Timelines.message_id])
+            .where(Timelines.user_id == follower_id))))
+
+    db.session.execute(
+        Timelines.__table__.insert().from_select(TIMELINE_COLUMNS, recent))
+
+
+def prune(follower_id, followed_ids):
+    """Remove the messages of `followed_ids` from `follower_id`'s timeline."""
+
+    followed_ids = set(followed_ids) - {follower_id}
+
+    if not followed_ids:
+        return
+
+    followed_messages = (select([Message.id])
+                         .where(Message.user_id.in_(followed_ids)))
+
+    (Timelines
+     .query
+     .filter(Timelines.user_id == follower_id,
+             Timelines.message_id.in_(followed_messages))
+     .delete(synchronize_session=False))
+
+
+def rebuild_timelines():
+    """Repopulate every timeline from the messages and follows tables.
+
+    Returns the number of timeline entries written.
+    """
+
+    Timelines.query.delete(synchronize_session=False)
+
+    own = select([Message.user_id, Message.id, Message.timestamp])
+
+    followed = (select([
+        Follows.user_following_id,
+        Message.id,
+        Message.timestamp,
+    ])
+        .select_from(Follows.__table__.join(
+            Message.__table__,
+            Message.user_id == Follows.user_being_followed_id)))
+
+    db.session.execute(
+        Timelines.__table__.insert().from_select(
+            TIMELINE_COLUMNS, union(own, followed)))
+
+    return Timelines.query.count()
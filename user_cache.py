@@ -0,0 +1,245 @@
+"""Cross-request cache of logged-in users.
+
+`add_user_to_g` runs on every request, so rather than loading the current
+user from the database each time, a snapshot of their profile columns is
+cached by user id. A cached snapshot is attached to the request's session
+with `merge(load=False)`, which issues no query; relationships and any
+columns not in the snapshot still load lazily on first use.
+
+Counter columns are left out of the snapshot, since they change whenever
+anyone follows or likes, and so is the password hash.
+
+The cache is an in-process TTL + LRU store, optionally in front of a
+shared backend (anything with `get`, `set` and `delete`, such as
+RedisBackend) so that invalidations reach every process. Entries are
+invalidated when a transaction that edits or deletes a user (as `profile`
+and `delete_user` do) commits.
+"""
+
+import json
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from models import db, User
+
+# User columns kept in the cache.
+CACHED_COLUMNS = ('id', 'email', 'username', 'image_url', 'header_image_url',
+                  'bio', 'location', 'updated_at')
+
+DEFAULT_TTL = 60
+DEFAULT_SIZE = 10000
+
+PENDING_KEY = 'user_cache_pending'
+
+
+class LocalCache:
+    """In-process cache with a time-to-live and least-recently-used eviction."""
+
+    def __init__(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE, clock=monotonic):
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Cached value for `key`, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+
+            if expires <= self.clock():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the least recently used."""
+
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Forget `key`."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Shared cache backend over a redis-py style client."""
+
+    def __init__(self, client, ttl=DEFAULT_TTL, prefix='warbler:user:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(f"{self.prefix}{key}")
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value):
+        self.client.set(f"{self.prefix}{key}", json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(f"{self.prefix}{key}")
+
+
+class UserCache:
+    """Snapshots of users' profile columns, keyed by user id.
+
+    Reads try the local cache, then the shared backend (if any); writes
+    and invalidations go to both.
+    """
+
+    def __init__(self, local=None, shared=None):
+        self.local = local or LocalCache()
+        self.shared = shared
+
+    def get(self, user_id):
+        snapshot = self.local.get(user_id)
+
+        if snapshot is None and self.shared is not None:
+            snapshot = self.shared.get(user_id)
+
+            if snapshot is not None:
+                self.local.set(user_id, snapshot)
+
+        return snapshot
+
+    def set(self, user_id, snapshot):
+        self.local.set(user_id, snapshot)
+
+        if self.shared is not None:
+            self.shared.set(user_id, snapshot)
+
+    def invalidate(self, user_id):
+        """Forget the cached snapshot of `user_id`."""
+
+        self.local.delete(user_id)
+
+        if self.shared is not None:
+            self.shared.delete(user_id)
+
+    def clear(self):
+        """Forget every locally cached user."""
+
+        self.local.clear()
+
+
+user_cache = UserCache()
+
+
+def configure_user_cache(app):
+    """Set up the user cache from `app`'s USER_CACHE_* config."""
+
+    user_cache.local = LocalCache(
+        ttl=app.config.get('USER_CACHE_TTL', DEFAULT_TTL),
+        size=app.config.get('USER_CACHE_SIZE', DEFAULT_SIZE))
+    user_cache.shared = app.config.get('USER_CACHE_BACKEND')
+
+
+def snapshot(user):
+    """The cacheable columns of `user`, as a JSON-able dict."""
+
+    values = {column: getattr(user, column) for column in CACHED_COLUMNS}
+    values['updated_at'] = values['updated_at'].isoformat()
+
+    return values
+
+
+def get_current_user(user_id):
+    """The user with `user_id`, from the cache if possible; None if no such user.
+
+    On a cache hit the user is attached to the session without a query.
+    Deleted users are never cached, so are None too.
+    """
+
+    cached = user_cache.get(user_id)
+
+    if cached is None:
+        user = User.query.get(user_id)
+
+        if user is None or user.deleted_at is not None:
+            return None
+
+        user_cache.set(user_id, snapshot(user))
+        return user
+
+    user = User(**dict(cached,
+                       updated_at=datetime.fromisoformat(cached['updated_at'])))
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+##############################################################################
+# Invalidating users as they are edited or deleted.
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_changed_users(session, flush_context):
+    """Note the users whose cached columns this flush changed or deleted."""
+
+    changed = session.info.setdefault(PENDING_KEY, set())
+
+    for obj in session.dirty:
+        if (isinstance(obj, User) and
+                session.is_modified(obj, include_collections=False)):
+            changed.add(obj.id)
+
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changed.add(obj.id)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def collect_bulk_delete(delete_context):
+    """A bulk delete of users may remove any of them."""
+
+    if delete_context.mapper.class_ is User:
+        session = delete_context.session
+        session.info.setdefault(PENDING_KEY, set()).add(None)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_changed_users(session):
+    """Forget the users changed by the committed transaction."""
+
+    for user_id in session.info.pop(PENDING_KEY, ()):
+        if user_id is None:
+            user_cache.clear()
+        else:
+            user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changed_users(session):
+    """Forget user changes that were rolled back."""
+
+    session.info.pop(PENDING_KEY, None)
+
@@ -0,0 +1,117 @@
+"""Username search for the /users listing and the typeahead endpoint.
+
+Matches are ranked exact match first, then usernames starting with the
+query, then usernames containing it, and alphabetically within each rank.
+Prefix matches are served by the `text_pattern_ops` index on username, and
+substring matches by the trigram index where pg_trgm is available (see
+models.py). Results are paged with keyset cursors on (rank, username).
+"""
+
+from flask import abort
+from sqlalchemy import case, literal_column, text, tuple_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import load_only
+
+from models import db, User, CARD_COLUMNS
+from pagination import decode_token, encode_token
+
+PAGE_SIZE = 30
+TYPEAHEAD_SIZE = 8
+
+
+def escape_like(value):
+    """Escape the LIKE wildcards in `value`, using backslash as the escape."""
+
+    return (value
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def search_users(q=None, after=None, per_page=PAGE_SIZE, prefix_only=False,
+                 columns=CARD_COLUMNS):
+    """Find a page of users whose username matches `q`.
+
+    With no `q`, pages through every user alphabetically. Deleted users
+    are left out. Returns
+    (users, cursor), where cursor is the `after` token for the next page,
+    or None if this is the last page. Only `columns` of each user are
+    loaded.
+    """
+
+    query = (User
+             .query
+             .filter(User.deleted_at.is_(None))
+             .options(load_only(*columns)))
+
+    if q:
+        pattern = escape_like(q)
+        prefix = User.username.like(f"{pattern}%", escape='\\')
+        rank = case([(User.username == q, 0), (prefix, 1)], else_=2)
+        order = [rank, User.username]
+
+        if prefix_only:
+            query = query.filter(prefix)
+        else:
+            query = query.filter(
+                User.username.like(f"%{pattern}%", escape='\\'))
+
+    else:
+        rank = literal_column('0')
+        order = [User.username]
+
+    if after:
+        try:
+            after_rank, after_username = decode_token(after)
+            after_rank = int(after_rank)
+
+            if not isinstance(after_username, str):
+                raise TypeError(after_username)
+
+        except (TypeError, ValueError):
+            abort(400)
+
+        if q:
+            query = query.filter(tuple_(rank, User.username) >
+                                 tuple_(after_rank, after_username))
+        else:
+            query = query.filter(User.username > after_username)
+
+    ranked = (query
+              .add_columns(rank.label('rank'))
+              .order_by(*order)
+              .limit(per_page + 1)
+              .all())
+
+    users = [user for user, _ in ranked[:per_page]]
+
+    if len(ranked) > per_page:
+        last_user, last_rank = ranked[per_page - 1]
+        cursor = encode_token([last_rank, last_user.username])
+    else:
+        cursor = None
+
+    return users, cursor
+
+
+def typeahead(q, budget_ms):
+    """Up to TYPEAHEAD_SIZE users whose username starts with `q`.
+
+    On PostgreSQL the lookup is cancelled if it takes longer than
+    `budget_ms`. Returns (users, timed_out).
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(
+            text(f"SET LOCAL statement_timeout = {int(budget_ms)}"))
+
+    try:
+        users, _ = search_users(q,
+                                per_page=TYPEAHEAD_SIZE,
+                                prefix_only=True,
+                                columns=('id', 'username', 'image_url'))
+        return users, False
+
+    except OperationalError:
+        db.session.rollback()
+        return [], True